@@ -1,11 +1,28 @@
 import streamlit as st
 import yfinance as yf
-from datetime import datetime
+from datetime import datetime, timedelta, time as dtime
+from zoneinfo import ZoneInfo
 import pandas as pd
+import numpy as np
 import json
+import copy
+import os
+import sys
+import random
+import zlib
+import atexit
+import bisect
+import sqlite3
 import gspread
 import time
+import threading
+from array import array
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager, ExitStack
+from itertools import zip_longest
 from google.oauth2.service_account import Credentials
+from google.auth.transport.requests import Request
 
 # ============================================
 # הגדרות ראשוניות
@@ -36,6 +53,2557 @@ st.markdown("""
 </style>
 """, unsafe_allow_html=True)
 
+TEACHER_USERNAME = "nadav"
+
+# רשימת המניות לבחירה במסך הקנייה (HEADER = כותרת קבוצה, CUSTOM = הקלדה ידנית)
+POPULAR_STOCKS = {
+    "--- מניות סל (ETFs) ---": "HEADER1",
+    "📊 SPY - S&P 500": "SPY",
+    "📊 QQQ - NASDAQ 100": "QQQ",
+    "📊 VTI - כלל שוק ארה\"ב": "VTI",
+    "📊 VXUS - כלל עולמי": "VXUS",
+    "📊 VOO - S&P 500 (Vanguard)": "VOO",
+    "--- טכנולוגיה ---": "HEADER2",
+    "🍎 Apple (AAPL)": "AAPL",
+    "💻 Microsoft (MSFT)": "MSFT",
+    "🔍 Google (GOOGL)": "GOOGL",
+    "📱 Meta/Facebook (META)": "META",
+    "🎮 NVIDIA (NVDA)": "NVDA",
+    "🌐 Amazon (AMZN)": "AMZN",
+    "🎬 Netflix (NFLX)": "NFLX",
+    "💾 Intel (INTC)": "INTC",
+    "🖥️ AMD (AMD)": "AMD",
+    "💻 IBM (IBM)": "IBM",
+    "☁️ Oracle (ORCL)": "ORCL",
+    "--- רכב וחלל ---": "HEADER3",
+    "🚗 Tesla (TSLA)": "TSLA",
+    "🚙 Ford (F)": "F",
+    "🏭 General Motors (GM)": "GM",
+    "✈️ Boeing (BA)": "BA",
+    "--- צריכה ומזון ---": "HEADER4",
+    "🥤 Coca-Cola (KO)": "KO",
+    "🍔 McDonald's (MCD)": "MCD",
+    "☕ Starbucks (SBUX)": "SBUX",
+    "🛒 Walmart (WMT)": "WMT",
+    "🎯 Target (TGT)": "TGT",
+    "--- ספורט ופיננסים ---": "HEADER5",
+    "👟 Nike (NKE)": "NKE",
+    "🏰 Disney (DIS)": "DIS",
+    "💳 Visa (V)": "V",
+    "💳 Mastercard (MA)": "MA",
+    "💰 PayPal (PYPL)": "PYPL",
+    "--- חברות ישראליות ---": "HEADER6",
+    "💊 Teva (TEVA)": "TEVA",
+    "🔒 Check Point (CHKP)": "CHKP",
+    "🌐 Wix (WIX)": "WIX",
+    "📞 Nice (NICE)": "NICE",
+    "📋 Monday.com (MNDY)": "MNDY",
+    "--- או הכנס ידנית ---": "CUSTOM"
+}
+
+# תיאורי מניות בעברית (מוצגים במסך הקנייה)
+STOCK_DESCRIPTIONS = {
+    'SPY': '📊 מניית סל העוקבת אחר מדד S&P 500 - 500 החברות הגדולות בארה"ב מכל התחומים.',
+    'QQQ': '📊 מניית סל העוקבת אחר מדד NASDAQ 100 - 100 חברות הטכנולוגיה המובילות (אפל, מיקרוסופט, גוגל ועוד).',
+    'VTI': '📊 מניית סל של Vanguard - כמעט כל השוק האמריקאי (כ-4,000 מניות!).',
+    'VXUS': '📊 מניית סל של Vanguard - חברות מכל העולם מחוץ לארה"ב (אירופה, אסיה, שווקים מתעוררים).',
+    'VOO': '📊 מניית סל של Vanguard - עוקבת אחר S&P 500, דומה ל-SPY עם עמלות נמוכות יותר.',
+    'AAPL': '🍎 אפל - מייצרת iPhone, iPad, Mac ועוד. אחת החברות הגדולות בעולם.',
+    'MSFT': '💻 מיקרוסופט - Windows, Office, Xbox, Azure ועוד. ענקית התוכנה.',
+    'GOOGL': '🔍 גוגל (אלפבית) - מנוע החיפוש, YouTube, Android, Gmail ועוד.',
+    'META': '📱 מטא (פייסבוק לשעבר) - פייסבוק, אינסטגרם, ווטסאפ.',
+    'NVDA': '🎮 אנבידיה - כרטיסי מסך, בינוי מלאכותית, מחשוב על.',
+    'AMZN': '🌐 אמזון - קניות אונליין, AWS (שירותי ענן), פריים.',
+    'NFLX': '🎬 נטפליקס - שירות סטרימינג לסרטים וסדרות.',
+    'INTC': '💾 אינטל - מעבדים ושבבים למחשבים.',
+    'AMD': '🖥️ AMD - מעבדים וכרטיסי מסך, מתחרה של אינטל ואנבידיה.',
+    'IBM': '💻 IBM - חברת טכנולוגיה ותוכנה ותיקה, מחשוב ענן ובינה מלאכותית.',
+    'ORCL': '☁️ אורקל - מסדי נתונים, תוכנה עסקית, שירותי ענן.',
+    'TSLA': '🚗 טסלה - מכוניות חשמליות, סולאריות, סוללות.',
+    'F': '🚙 פורד - אחת מיצרניות הרכב הותיקות בארה"ב.',
+    'GM': '🏭 ג\'נרל מוטורס - יצרנית רכב אמריקאית גדולה (שברולט, קדילאק).',
+    'BA': '✈️ בואינג - מטוסי נוסעים ומטוסי קרב.',
+    'KO': '🥤 קוקה קולה - משקאות קלים בעולם כולו.',
+    'MCD': '🍔 מקדונלד\'ס - רשת מזון מהיר עולמית.',
+    'SBUX': '☕ סטארבקס - רשת בתי קפה עולמית.',
+    'WMT': '🛒 וולמארט - רשת סופרמרקטים ענקית בארה"ב.',
+    'TGT': '🎯 טארגט - רשת חנויות כלבו אמריקאית.',
+    'NKE': '👟 נייקי - ביגוד וציוד ספורט.',
+    'DIS': '🏰 דיסני - סרטים, פארקי שעשועים, ערוצי טלוויזיה.',
+    'V': '💳 ויזה - כרטיסי אשראי בעולם כולו.',
+    'MA': '💳 מאסטרקארד - כרטיסי אשראי, מתחרה של ויזה.',
+    'PYPL': '💰 פייפאל - תשלומים דיגיטליים.',
+    'TEVA': '💊 טבע - תרופות גנריות, אחת החברות הגדולות בישראל.',
+    'CHKP': '🔒 צ\'ק פוינט - אבטחת סייבר, חברה ישראלית.',
+    'WIX': '🌐 וויקס - בניית אתרים, חברה ישראלית.',
+    'NICE': '📞 נייס - תוכנה לניתוח שיחות ונתונים, חברה ישראלית.',
+    'MNDY': '📋 מאנדיי - ניהול פרויקטים ומשימות, חברה ישראלית.'
+}
+
+# ============================================
+# קאש מחירים משותף
+# ============================================
+
+# ברירות מחדל - ניתן לשנות ב-Secrets תחת [quote_cache]
+QUOTE_CACHE_TTL = 60          # שניות שבהן מחיר נחשב טרי
+QUOTE_CACHE_STALE_TTL = 300   # שניות נוספות שבהן מחזירים מחיר ישן ומרעננים ברקע
+QUOTE_CACHE_MAX_SIZE = 500    # מספר ערכים מקסימלי לפני פינוי (LRU)
+
+def get_setting(section, key, default):
+    """קריאת הגדרה אופציונלית מ-Secrets (עם ברירת מחדל)"""
+    try:
+        return st.secrets.get(section, {}).get(key, default)
+    except Exception:
+        return default
+
+class QuoteCache:
+    """קאש מחירים משותף לכל ה-sessions: TTL, פינוי LRU ורענון ברקע (stale-while-revalidate)"""
+    
+    def __init__(self, ttl, stale_ttl, max_size):
+        self.ttl = ttl
+        self.stale_ttl = stale_ttl
+        self.max_size = max_size
+        self._entries = OrderedDict()  # key -> (value, fetched_at)
+        self._refreshing = set()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.stale_hits = 0
+        self.misses = 0
+        self.evictions = 0
+    
+    def get(self, key, fetch):
+        """החזרת ערך מהקאש, או משיכה בעזרת fetch() אם אין ערך שמיש"""
+        return self.get_many([key], lambda missing: {key: fetch()}).get(key)
+    
+    def get_many(self, keys, fetch_many):
+        """החזרת ערכים לכמה מפתחות - כל החסרים נמשכים בקריאה אחת ל-fetch_many(missing)"""
+        now = time.time()
+        result = {}
+        missing = []
+        stale = []
+        with self._lock:
+            for key in keys:
+                entry = self._entries.get(key)
+                if entry is not None:
+                    value, fetched_at = entry
+                    age = now - fetched_at
+                    if age < self.ttl:
+                        self._entries.move_to_end(key)
+                        self.hits += 1
+                        result[key] = value
+                        continue
+                    if age < self.ttl + self.stale_ttl:
+                        # ערך ישן אבל שמיש - מחזירים מיד ומרעננים ברקע
+                        self._entries.move_to_end(key)
+                        self.stale_hits += 1
+                        result[key] = value
+                        if key not in self._refreshing:
+                            self._refreshing.add(key)
+                            stale.append(key)
+                        continue
+                self.misses += 1
+                missing.append(key)
+        
+        if stale:
+            threading.Thread(target=self._refresh, args=(stale, fetch_many), daemon=True).start()
+        
+        if missing:
+            fetched = fetch_many(missing) or {}
+            for key, value in fetched.items():
+                if value is not None:
+                    self.put(key, value)
+                    result[key] = value
+        return result
+    
+    def put(self, key, value):
+        """שמירת ערך בקאש (עם פינוי הערך הישן ביותר אם צריך)"""
+        with self._lock:
+            self._entries[key] = (value, time.time())
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+    
+    def _refresh(self, keys, fetch_many):
+        """רענון ערכים ברקע - במקרה של כישלון נשארים הערכים הישנים"""
+        try:
+            fetched = fetch_many(keys) or {}
+            for key, value in fetched.items():
+                if value is not None:
+                    self.put(key, value)
+        finally:
+            with self._lock:
+                self._refreshing.difference_update(keys)
+    
+    def stats(self):
+        """מוני פגיעות/החטאות"""
+        with self._lock:
+            total = self.hits + self.stale_hits + self.misses
+            return {
+                'hits': self.hits,
+                'stale_hits': self.stale_hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'size': len(self._entries),
+                'hit_rate': (self.hits + self.stale_hits) / total if total else 0.0
+            }
+
+@st.cache_resource
+def get_quote_cache():
+    """קאש מחירים יחיד לכל התהליך - משותף לכל התלמידים"""
+    return QuoteCache(
+        ttl=float(get_setting('quote_cache', 'ttl', QUOTE_CACHE_TTL)),
+        stale_ttl=float(get_setting('quote_cache', 'stale_ttl', QUOTE_CACHE_STALE_TTL)),
+        max_size=int(get_setting('quote_cache', 'max_size', QUOTE_CACHE_MAX_SIZE))
+    )
+
+# ============================================
+# מדידת ביצועים (spans)
+# ============================================
+
+# ברירת מחדל - ניתן לשנות ב-Secrets תחת [metrics]
+METRICS_EXPORT_INTERVAL = 300   # כל כמה שניות נכתבת תמונת מצב לקובץ (0 = בלי קובץ)
+
+class Metrics:
+    """זמנים ומספר קריאות לכל span - מצטבר לכל התהליך, ובנפרד לכל הרצה של הדף (rerun) בתהליכון שלה"""
+    
+    def __init__(self, export_dir, export_interval):
+        self._export_dir = export_dir
+        self._export_interval = export_interval
+        self._spans = {}                  # name -> [count, total, max]
+        self._lock = threading.Lock()
+        self._local = threading.local()   # ה-rerun הנוכחי של התהליכון (אם יש)
+        self.started = time.time()
+        if export_interval:
+            threading.Thread(target=self._run, name="metrics-export", daemon=True).start()
+    
+    @staticmethod
+    def _add(spans, name, elapsed):
+        entry = spans.setdefault(name, [0, 0.0, 0.0])
+        entry[0] += 1
+        entry[1] += elapsed
+        entry[2] = max(entry[2], elapsed)
+    
+    @contextmanager
+    def span(self, name):
+        """מדידת זמן של קטע קוד (גם אם נזרקה בו שגיאה)"""
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - started
+            with self._lock:
+                self._add(self._spans, name, elapsed)
+            rerun = getattr(self._local, 'rerun', None)
+            if rerun is not None:
+                self._add(rerun, name, elapsed)
+    
+    @contextmanager
+    def rerun(self):
+        """איסוף כל ה-spans של הרצה אחת של הדף - מחזיר מילון שמתמלא עד סוף ה-with"""
+        spans = {}
+        self._local.rerun = spans
+        try:
+            with self.span('rerun'):
+                yield spans
+        finally:
+            self._local.rerun = None
+    
+    @staticmethod
+    def summarize(spans):
+        """טבלת סיכום: name -> count, total_ms, avg_ms, max_ms"""
+        return {
+            name: {
+                'count': count,
+                'total_ms': round(total * 1000, 2),
+                'avg_ms': round(total / count * 1000, 2),
+                'max_ms': round(longest * 1000, 2)
+            }
+            for name, (count, total, longest) in sorted(spans.items())
+        }
+    
+    def snapshot(self):
+        with self._lock:
+            spans = {name: list(entry) for name, entry in self._spans.items()}
+        return {
+            'time': datetime.now().isoformat(timespec='seconds'),
+            'uptime_s': round(time.time() - self.started),
+            'spans': self.summarize(spans)
+        }
+    
+    def export(self):
+        """הוספת תמונת מצב (מצטברת) לקובץ JSONL של היום - לניתוח מגמות לאורך השבוע"""
+        os.makedirs(self._export_dir, exist_ok=True)
+        path = os.path.join(self._export_dir, f"metrics-{datetime.now():%Y-%m-%d}.jsonl")
+        with open(path, 'a', encoding='utf-8') as f:
+            f.write(json.dumps(self.snapshot(), ensure_ascii=False) + '\n')
+        return path
+    
+    def _run(self):
+        while True:
+            time.sleep(self._export_interval)
+            try:
+                self.export()
+            except OSError:
+                pass  # דיסק מלא/חסום - המדידה בזיכרון ממשיכה
+    
+    def instrument(self, target, prefix):
+        """עטיפה של אובייקט כך שכל קריאת מתודה נמדדת כ-span בשם prefix.method"""
+        return InstrumentedProxy(target, self, prefix)
+
+class InstrumentedProxy:
+    """עוטף אובייקט חיצוני (גיליון gspread, ספק נתוני שוק) ומודד כל קריאת מתודה"""
+    
+    def __init__(self, target, metrics, prefix):
+        self._target = target
+        self._metrics = metrics
+        self._prefix = prefix
+    
+    def __getattr__(self, name):
+        value = getattr(self._target, name)
+        if not callable(value):
+            return value
+        
+        def call(*args, **kwargs):
+            with self._metrics.span(f'{self._prefix}.{name}'):
+                return value(*args, **kwargs)
+        return call
+
+@st.cache_resource
+def get_metrics():
+    """מדידת הביצועים - אחת לכל התהליך, תמונות מצב נכתבות ל-data/metrics"""
+    return Metrics(os.path.join(DATA_DIR, 'metrics'), get_setting('metrics', 'export_interval', METRICS_EXPORT_INTERVAL))
+
+def span(name):
+    """קיצור ל-get_metrics().span(name) - לשימוש בקוד של הדף"""
+    return get_metrics().span(name)
+
+# ============================================
+# כיתות - כל כיתה (shard) בגיליון/קובץ נפרד
+# ============================================
+
+DEFAULT_CLASS = 'default'     # משתמשים שלא משויכים לכיתה - הגיליון והקבצים המקוריים
+LEADERBOARD_WORKERS = 8       # כמה כיתות נטענות במקביל לטבלה המשותפת
+
+class ClassRouter:
+    """מיפוי משתמש -> כיתה. כל כיתה נשמרת בנפרד, כך שכל חיבור קורא רק את הכיתה שלו גם כשנוספים בתי ספר"""
+    
+    def __init__(self, classes, users):
+        # כיתת ברירת המחדל ראשונה - כיתה מוגדרת עם אותו מורה/תלמיד גוברת עליה
+        self._classes = {DEFAULT_CLASS: {'name': "הכיתה", 'teacher': TEACHER_USERNAME, 'spreadsheet': SPREADSHEET_NAME}}
+        self._classes.update(classes)
+        self._class_of = {}
+        for class_id, config in self._classes.items():
+            self._class_of[config['teacher']] = class_id
+            for student in config.get('students', []):
+                self._class_of[student] = class_id
+        self._users = list(users)
+    
+    def class_of(self, username):
+        return self._class_of.get(username, DEFAULT_CLASS)
+    
+    def teacher(self, class_id):
+        return self._classes[class_id]['teacher']
+    
+    def is_teacher(self, username):
+        return self.teacher(self.class_of(username)) == username
+    
+    def name(self, class_id):
+        return self._classes[class_id].get('name', class_id)
+    
+    def spreadsheet(self, class_id):
+        return self._classes[class_id].get('spreadsheet', f"{SPREADSHEET_NAME} - {class_id}")
+    
+    def members(self, class_id):
+        """המשתמשים (מתוך Secrets) שמשויכים לכיתה, כולל המורה"""
+        return [username for username in self._users if self.class_of(username) == class_id]
+    
+    def classes(self):
+        """הכיתות הפעילות - כיתת ברירת המחדל רק אם יש בה מישהו או שאין כיתות אחרות"""
+        return [class_id for class_id in self._classes
+                if class_id != DEFAULT_CLASS or len(self._classes) == 1 or self.members(class_id)]
+
+def shard_path(path, class_id):
+    """קובץ נפרד לכל כיתה - בכיתת ברירת המחדל נשאר השם המקורי, כך שהתקנות קיימות לא משתנות"""
+    if class_id == DEFAULT_CLASS:
+        return path
+    root, ext = os.path.splitext(path)
+    return f"{root}-{class_id}{ext}"
+
+@st.cache_resource
+def get_class_router():
+    """הכיתות מ-Secrets תחת [classes.<מזהה>] (teacher, students, name, spreadsheet)"""
+    try:
+        classes = {class_id: dict(config) for class_id, config in st.secrets.get('classes', {}).items()}
+        users = list(st.secrets.get('users', {}).keys())
+    except Exception:
+        classes, users = {}, []   # בלי קובץ Secrets (למשל בבדיקת העומס) - כיתה אחת
+    return ClassRouter(classes, users)
+
+# ============================================
+# גישה ל-Google Sheets - אינדקס שורות ומדדים
+# ============================================
+
+class SheetRowIndex:
+    """מיפוי username -> מספר שורה בגיליון, משותף לכל ה-sessions (מתרענן רק בהחטאה)"""
+    
+    def __init__(self):
+        self._rows = {}
+        self._lock = threading.Lock()
+    
+    def load(self, usernames):
+        """בנייה מחדש מרשימת שמות לפי סדר השורות (שורה 1 = כותרת)"""
+        with self._lock:
+            self._rows = {name: idx + 2 for idx, name in enumerate(usernames) if name}
+    
+    def get(self, username):
+        with self._lock:
+            return self._rows.get(username)
+    
+    def set(self, username, row_number):
+        with self._lock:
+            self._rows[username] = row_number
+    
+    def refresh(self, sheet):
+        """קריאת עמודת שמות המשתמשים בלבד (קריאת API אחת)"""
+        usernames = sheet.col_values(1)[1:]
+        self.load(usernames)
+
+class SheetsApiStats:
+    """מוני קריאות API ל-Google Sheets - כמה קריאות עולה כל שמירה"""
+    
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.calls = {}
+        self.saves = 0
+        self.save_calls = 0
+        self.last_save_calls = 0
+    
+    def record(self, operation, count=1):
+        with self._lock:
+            self.calls[operation] = self.calls.get(operation, 0) + count
+    
+    def record_save(self, api_calls, saves=1):
+        """רישום כתיבה שכיסתה saves שמירות (כמה עסקאות יכולות להתאחד לכתיבה אחת)"""
+        with self._lock:
+            self.saves += saves
+            self.save_calls += api_calls
+            self.last_save_calls = api_calls
+    
+    def stats(self):
+        with self._lock:
+            return {
+                'calls': dict(self.calls),
+                'saves': self.saves,
+                'calls_per_save': self.save_calls / self.saves if self.saves else 0.0,
+                'last_save_calls': self.last_save_calls
+            }
+
+SPREADSHEET_NAME = "בורסת הכיתה - נתונים"
+SHEETS_SCOPES = ['https://spreadsheets.google.com/feeds',
+                 'https://www.googleapis.com/auth/drive']
+PORTFOLIO_HEADER = ['username', 'cash', 'stocks', 'history']
+
+class SheetsConnection:
+    """חיבור מאומת יחיד ל-Google Sheets - client אחד, רענון טוקן ושימוש חוזר בגיליון הפתוח"""
+    
+    def __init__(self, creds_info, spreadsheet_name, stats, metrics):
+        self._creds_info = creds_info
+        self._spreadsheet_name = spreadsheet_name
+        self._stats = stats
+        self._metrics = metrics
+        self._lock = threading.RLock()
+        self._creds = None
+        self._spreadsheet = None
+        self._worksheets = {}
+    
+    def _connect(self):
+        """אימות ופתיחת הגיליון - קורה רק בפעם הראשונה או אחרי תקלה"""
+        with self._metrics.span('sheets.connect'):
+            self._creds = Credentials.from_service_account_info(self._creds_info, scopes=SHEETS_SCOPES)
+            client = gspread.authorize(self._creds)
+            self._spreadsheet = client.open(self._spreadsheet_name)
+        self._worksheets = {}
+        self._stats.record('connect')
+    
+    def _ensure_token(self):
+        """רענון הטוקן רק כשפג תוקפו"""
+        if not self._creds.valid:
+            with self._metrics.span('sheets.token_refresh'):
+                self._creds.refresh(Request())
+            self._stats.record('token_refresh')
+    
+    def worksheet(self, title=None, header=None):
+        """גיליון פתוח לפי שם (ברירת מחדל: הגיליון הראשון). עם header - נוצר אם לא קיים,
+        ובגיליון הראשון - שורת הכותרת נוספת אם חסרה"""
+        with self._lock:
+            if self._spreadsheet is None:
+                self._connect()
+            self._ensure_token()
+            if title not in self._worksheets:
+                if title is None:
+                    worksheet = self._spreadsheet.sheet1
+                    if header is not None:
+                        self._ensure_header(worksheet, header)
+                    self._worksheets[title] = self._metrics.instrument(worksheet, 'sheets')
+                else:
+                    try:
+                        self._worksheets[title] = self._metrics.instrument(self._spreadsheet.worksheet(title), 'sheets')
+                    except gspread.exceptions.WorksheetNotFound:
+                        if header is None:
+                            raise
+                        worksheet = self._spreadsheet.add_worksheet(title=title, rows=1000, cols=len(header))
+                        worksheet.append_row(header)
+                        self._stats.record('add_worksheet')
+                        self._worksheets[title] = self._metrics.instrument(worksheet, 'sheets')
+            return self._worksheets[title]
+    
+    def _ensure_header(self, worksheet, header):
+        """הקריאה מדלגת על שורה 1 - בגיליון ריק (כיתה חדשה) התלמיד הראשון היה נכתב בה ונעלם בטעינה הבאה"""
+        first_row = worksheet.row_values(1, value_render_option='UNFORMATTED_VALUE')
+        self._stats.record('row_values')
+        # 🛡️ כותרת קיימת (גם אם בשמות אחרים) נשארת. שורה 1 עם מזומן מספרי היא תלמיד - הכותרת נכנסת מעליה
+        if not first_row or (len(first_row) > 1 and isinstance(first_row[1], (int, float))):
+            worksheet.insert_row(header, 1)
+            self._stats.record('insert_row')
+    
+    def reset(self):
+        """ניתוק - הקריאה הבאה תתחבר מחדש"""
+        with self._lock:
+            self._creds = None
+            self._spreadsheet = None
+            self._worksheets = {}
+
+@st.cache_resource
+def get_sheets_connection(class_id):
+    """חיבור יחיד ל-Google Sheets לכל כיתה (כל כיתה בקובץ גיליונות משלה)"""
+    return SheetsConnection(dict(st.secrets["gcp_service_account"]), get_class_router().spreadsheet(class_id),
+                            get_sheets_stats(class_id), get_metrics())
+
+@st.cache_resource
+def get_row_index(class_id):
+    """אינדקס שורות יחיד לכל כיתה"""
+    return SheetRowIndex()
+
+@st.cache_resource
+def get_sheets_stats(class_id):
+    """מוני קריאות API יחידים לכל כיתה"""
+    return SheetsApiStats()
+
+def write_user_rows(sheet, rows, row_index, stats):
+    """כתיבת שורות של כמה משתמשים: batch_update אחד לקיימים ו-append_rows אחד לחדשים. מחזיר מספר קריאות API"""
+    api_calls = 0
+    
+    # חיפוש השורות באינדקס - קריאה מהגיליון רק אם משתמש לא נמצא
+    if any(row_index.get(username) is None for username in rows):
+        row_index.refresh(sheet)
+        stats.record('col_values')
+        api_calls += 1
+    
+    updates = []
+    appends = []
+    for username, values in rows.items():
+        row_number = row_index.get(username)
+        if row_number:
+            updates.append({'range': f'B{row_number}:D{row_number}', 'values': [values]})
+        else:
+            appends.append([username] + values)
+    
+    if updates:
+        # עדכון שורות קיימות - עמודות B:D של כולם בקריאה אחת
+        sheet.batch_update(updates, value_input_option='USER_ENTERED')
+        stats.record('batch_update')
+        api_calls += 1
+    
+    if appends:
+        # הוספת שורות חדשות - ושמירת מספרי השורות שנוצרו באינדקס
+        response = sheet.append_rows(appends)
+        stats.record('append_rows')
+        api_calls += 1
+        updated_range = response.get('updates', {}).get('updatedRange', '')
+        if updated_range:
+            first_cell = updated_range.split('!')[-1].split(':')[0]
+            first_row = gspread.utils.a1_to_rowcol(first_cell)[0]
+            for offset, row in enumerate(appends):
+                row_index.set(row[0], first_row + offset)
+    
+    return api_calls
+
+# ============================================
+# ייצוג קומפקטי בזיכרון - אחזקות ועסקאות
+# ============================================
+
+class Holding:
+    """אחזקה במניה אחת - __slots__ במקום מילון. holding['shares'] עובד כמו במילון, כך שהקוד הקיים לא משתנה"""
+    
+    __slots__ = ('shares', 'avg_price')
+    
+    def __init__(self, shares, avg_price):
+        self.shares = shares
+        self.avg_price = avg_price
+    
+    def __getitem__(self, key):
+        if key not in Holding.__slots__:
+            raise KeyError(key)
+        return getattr(self, key)
+    
+    def __setitem__(self, key, value):
+        if key not in Holding.__slots__:
+            raise KeyError(key)
+        setattr(self, key, value)
+    
+    def __eq__(self, other):
+        if not isinstance(other, Holding):
+            return NotImplemented
+        return self.shares == other.shares and self.avg_price == other.avg_price
+    
+    def __deepcopy__(self, memo):
+        return Holding(self.shares, self.avg_price)
+    
+    def __repr__(self):
+        return f"Holding(shares={self.shares!r}, avg_price={self.avg_price!r})"
+    
+    def to_dict(self):
+        return {'shares': self.shares, 'avg_price': self.avg_price}
+
+def compact_portfolio(portfolio):
+    """תיק בייצוג הקומפקטי: אחזקות כ-Holding, וכל סימול נשמר פעם אחת בתהליך (sys.intern) ולא פעם לכל תלמיד"""
+    if portfolio is None:
+        return None
+    return {
+        'cash': portfolio['cash'],
+        'stocks': {sys.intern(symbol): Holding(data['shares'], data['avg_price'])
+                   for symbol, data in portfolio['stocks'].items()}
+    }
+
+class TradeHistory:
+    """העסקאות האחרונות של משתמש בעמודות (מערכים של מספרים ורשימות של מחרוזות) במקום מילון לכל עסקה.
+    עוברים עליה כמו על רשימת עסקאות - כל עסקה נבנית כמילון רק בזמן הקריאה"""
+    
+    __slots__ = ('maxlen', 'dates', 'actions', 'symbols', 'shares', 'prices', 'commissions', 'totals')
+    
+    def __init__(self, maxlen):
+        self.maxlen = maxlen
+        self.clear()
+    
+    def _columns(self):
+        return (self.dates, self.actions, self.symbols, self.shares, self.prices, self.commissions, self.totals)
+    
+    def clear(self):
+        self.dates, self.actions, self.symbols = [], [], []
+        self.shares = array('q')
+        self.prices, self.commissions, self.totals = array('d'), array('d'), array('d')
+    
+    def append(self, trade):
+        self.dates.append(trade['date'])
+        self.actions.append(sys.intern(str(trade['action'])))
+        self.symbols.append(sys.intern(str(trade['symbol'])))
+        self.shares.append(trade['shares'])
+        self.prices.append(trade['price'])
+        self.commissions.append(trade['commission'])
+        self.totals.append(trade['total'])
+        if len(self.dates) > self.maxlen:
+            for column in self._columns():
+                del column[0]
+    
+    def __len__(self):
+        return len(self.dates)
+    
+    def __iter__(self):
+        """העסקאות מהישנה לחדשה, כמילונים כמו ש-row_to_trade מחזיר"""
+        for date, action, symbol, shares, price, commission, total in zip(*self._columns()):
+            yield {'date': date, 'action': action, 'symbol': symbol, 'shares': shares,
+                   'price': price, 'commission': commission, 'total': total}
+
+# ============================================
+# יומן עסקאות (append-only)
+# ============================================
+
+LEDGER_SHEET_NAME = "עסקאות"
+LEDGER_HEADER = ['username', 'date', 'action', 'symbol', 'shares', 'price', 'commission', 'total']
+LEDGER_RECENT_LIMIT = 20
+
+def trade_to_row(username, trade):
+    """המרת עסקה לשורה ביומן"""
+    return [username] + [trade.get(column, '') for column in LEDGER_HEADER[1:]]
+
+def row_to_trade(row):
+    """המרת שורה מהיומן לעסקה"""
+    row = list(row) + [''] * (len(LEDGER_HEADER) - len(row))
+    return {
+        'date': row[1],
+        'action': row[2],
+        'symbol': row[3],
+        'shares': int(float(row[4] or 0)),
+        'price': float(row[5] or 0),
+        'commission': float(row[6] or 0),
+        'total': float(row[7] or 0)
+    }
+
+class TradeLedger:
+    """יומן עסקאות בגיליון נפרד - שורה לכל עסקה, רק הוספות. שומר בזיכרון אינדקס שורות ואת העסקאות האחרונות של כל משתמש"""
+    
+    def __init__(self, connection, stats, recent_limit):
+        self._connection = connection
+        self._stats = stats
+        self._recent_limit = recent_limit
+        self._lock = threading.RLock()
+        self._rows = None      # username -> מערך מספרי השורות מאז האיפוס האחרון (None = עוד לא נטען)
+        self._recent = {}      # username -> TradeHistory של העסקאות האחרונות
+        self._unflushed = {}   # username -> שורות שנרשמו אבל עוד לא נכתבו לגיליון
+        self._migrated = set()
+    
+    def _sheet(self):
+        return self._connection.worksheet(LEDGER_SHEET_NAME, header=LEDGER_HEADER)
+    
+    def _ensure_index(self):
+        """טעינת עמודות המשתמש והפעולה בלבד (קריאת API אחת, פעם אחת לתהליך)"""
+        if self._rows is not None:
+            return
+        usernames, actions = self._sheet().batch_get(['A2:A', 'C2:C'])
+        self._stats.record('batch_get')
+        rows = {}
+        for offset, (name_cell, action_cell) in enumerate(zip_longest(usernames, actions, fillvalue=[])):
+            username = name_cell[0] if name_cell else ''
+            if not username:
+                continue
+            if action_cell and action_cell[0] == 'reset':
+                rows[username] = array('l')
+            else:
+                rows.setdefault(username, array('l')).append(offset + 2)
+        self._rows = rows
+    
+    def counts(self):
+        """מספר העסקאות של כל משתמש מאז האיפוס האחרון"""
+        with self._lock:
+            self._ensure_index()
+            counts = {username: len(rows) for username, rows in self._rows.items()}
+            for username, rows in self._unflushed.items():
+                for row in rows:
+                    counts[username] = 0 if row[2] == 'reset' else counts.get(username, 0) + 1
+            return counts
+    
+    def recent(self, username):
+        """העסקאות האחרונות של משתמש (מהישנה לחדשה) - בלי לקרוא את שאר היומן"""
+        with self._lock:
+            if username not in self._recent:
+                self._ensure_index()
+                row_numbers = self._rows.get(username, array('l'))[-self._recent_limit:]
+                trades = TradeHistory(self._recent_limit)
+                if row_numbers:
+                    ranges = [f'A{n}:H{n}' for n in row_numbers]
+                    values = self._sheet().batch_get(ranges, value_render_option='UNFORMATTED_VALUE')
+                    self._stats.record('batch_get')
+                    for value_range in values:
+                        if value_range:
+                            trades.append(row_to_trade(value_range[0]))
+                for row in self._unflushed.get(username, []):
+                    self._apply_recent(trades, row)
+                self._recent[username] = trades
+            return list(self._recent[username])
+    
+    def _apply_recent(self, trades, row):
+        if row[2] == 'reset':
+            trades.clear()
+        else:
+            trades.append(row_to_trade(row))
+    
+    def record(self, username, rows):
+        """רישום עסקאות חדשות בזיכרון (הכתיבה לגיליון נעשית בתור השמירות)"""
+        with self._lock:
+            self._unflushed.setdefault(username, []).extend(rows)
+            if username in self._recent:
+                for row in rows:
+                    self._apply_recent(self._recent[username], row)
+    
+    def claim_migration(self, username):
+        """סימון שהיסטוריה ישנה (מעמודה D) של המשתמש הועברה ליומן - מחזיר False אם כבר טופל"""
+        with self._lock:
+            if username in self._migrated:
+                return False
+            self._migrated.add(username)
+            return True
+    
+    def on_appended(self, rows, first_row):
+        """עדכון האינדקס אחרי שהשורות נכתבו לגיליון"""
+        with self._lock:
+            for offset, row in enumerate(rows):
+                username = row[0]
+                unflushed = self._unflushed.get(username, [])
+                if row in unflushed:
+                    unflushed.remove(row)
+                elif username in self._recent:
+                    # שורה מיומן השמירות של הפעלה קודמת - עדיין לא מופיעה בזיכרון
+                    self._apply_recent(self._recent[username], row)
+                if self._rows is None:
+                    continue
+                if row[2] == 'reset':
+                    self._rows[username] = array('l')
+                else:
+                    self._rows.setdefault(username, array('l')).append(first_row + offset)
+    
+    def all_rows(self):
+        """כל שורות היומן (להעתקה לאחסון אחר)"""
+        rows = self._sheet().get_all_values(value_render_option='UNFORMATTED_VALUE')
+        self._stats.record('get_all_values')
+        return [row for row in rows[1:] if row and row[0]]
+    
+    def rows_after(self, position):
+        """שורות היומן שאחרי position (מספר השורות שכבר נקראו) - קריאה של הזנב בלבד. מחזיר (שורות, position חדש)"""
+        values = self._sheet().get(f'A{position + 2}:H', value_render_option='UNFORMATTED_VALUE')
+        self._stats.record('get')
+        return [row for row in values if row and row[0]], position + len(values)
+    
+    def append(self, rows):
+        """כתיבת שורות ליומן בקריאת append_rows אחת"""
+        response = self._sheet().append_rows(rows)
+        self._stats.record('append_rows')
+        updated_range = response.get('updates', {}).get('updatedRange', '')
+        if updated_range:
+            first_cell = updated_range.split('!')[-1].split(':')[0]
+            self.on_appended(rows, gspread.utils.a1_to_rowcol(first_cell)[0])
+        else:
+            with self._lock:
+                self._rows = None  # לא ידוע איפה נכתב - נטען מחדש בפעם הבאה
+
+@st.cache_resource
+def get_ledger(class_id):
+    """יומן עסקאות יחיד לכל כיתה"""
+    return TradeLedger(get_sheets_connection(class_id), get_sheets_stats(class_id), LEDGER_RECENT_LIMIT)
+
+# ============================================
+# תור שמירה ברקע (write-behind)
+# ============================================
+
+DATA_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data')
+SAVE_FLUSH_INTERVAL = 2.0     # שניות בין כתיבות לגיליון
+SAVE_MAX_BACKOFF = 60.0       # המתנה מקסימלית אחרי שגיאת מכסה
+
+def is_quota_error(error):
+    """האם זו שגיאת מכסה/עומס זמני של Google (429 או 5xx)"""
+    response = getattr(error, 'response', None)
+    status = getattr(response, 'status_code', None)
+    return status == 429 or (status is not None and status >= 500)
+
+class WriteBehindQueue:
+    """תור שמירות ברקע: מאחד כמה שמירות של אותו משתמש לכתיבה אחת, עם יומן בדיסק כך ששום עסקה שאושרה לא הולכת לאיבוד"""
+    
+    def __init__(self, connection, row_index, ledger, stats, journal_path, flush_interval):
+        self._connection = connection
+        self._row_index = row_index
+        self._ledger = ledger
+        self._stats = stats
+        self._journal_path = journal_path
+        self._flush_interval = flush_interval
+        self._pending = OrderedDict()  # username -> (values, מספר שמירות שאוחדו)
+        self._pending_trades = []      # שורות ליומן העסקאות - לא מתאחדות, רק מתווספות
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._stopped = False
+        self.flushes = 0
+        self.failures = 0
+        self.retries = 0
+        self.coalesced = 0
+        self.last_flush_latency = 0.0
+        self.total_flush_latency = 0.0
+        self.last_error = None
+        
+        os.makedirs(os.path.dirname(journal_path), exist_ok=True)
+        self._replay_journal()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+        atexit.register(self.shutdown)
+    
+    def _replay_journal(self):
+        """טעינת שמירות שלא נכתבו לפני שהתהליך נעצר"""
+        if not os.path.exists(self._journal_path):
+            return
+        with open(self._journal_path, encoding='utf-8') as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    continue  # שורה חלקית מקריסה באמצע כתיבה
+                # שמירה מרוכזת (enqueue_many) נרשמת כשורה אחת - כולה או כלום
+                for item in entry.get('batch', [entry]):
+                    if item.get('values') is not None:
+                        self._pending[item['username']] = (item['values'], 1)
+                    self._pending_trades.extend(item.get('trades', []))
+    
+    def _rewrite_journal(self, in_flight=None):
+        """כתיבת היומן מחדש כך שיכיל רק את מה שעדיין ממתין (נקרא תחת self._lock).
+        in_flight - שורות תיקים שנמצאות באמצע כתיבה, נרשמות לפני הממתינים (החדשים יותר גוברים בטעינה)"""
+        tmp_path = self._journal_path + '.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            for username, (values, _) in list((in_flight or {}).items()) + list(self._pending.items()):
+                f.write(json.dumps({'username': username, 'values': values}, ensure_ascii=False) + '\n')
+            if self._pending_trades:
+                f.write(json.dumps({'username': None, 'values': None, 'trades': self._pending_trades}, ensure_ascii=False) + '\n')
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self._journal_path)
+    
+    def enqueue(self, username, values, trades=()):
+        """הוספת שמירה (ושורות ליומן העסקאות) לתור - חוזר רק אחרי שהשמירה נרשמה ביומן בדיסק"""
+        trades = list(trades)
+        line = json.dumps({'username': username, 'values': values, 'trades': trades}, ensure_ascii=False) + '\n'
+        with self._lock:
+            with open(self._journal_path, 'a', encoding='utf-8') as f:
+                f.write(line)
+                f.flush()
+                os.fsync(f.fileno())
+            if username in self._pending:
+                self.coalesced += 1
+                count = self._pending.pop(username)[1] + 1
+            else:
+                count = 1
+            self._pending[username] = (values, count)
+            self._pending_trades.extend(trades)
+    
+    def enqueue_many(self, entries):
+        """הוספת שמירות של כמה משתמשים (username -> (values, trades)) כשורה אחת ביומן, כך שקריסה לא משאירה חלק מהן.
+        כולן נכתבות לגיליון באותה כתיבה (batch_update/append_rows אחד), והכתיבה מתחילה מיד"""
+        batch = [{'username': username, 'values': values, 'trades': list(trades)} for username, (values, trades) in entries.items()]
+        line = json.dumps({'batch': batch}, ensure_ascii=False) + '\n'
+        with self._lock:
+            with open(self._journal_path, 'a', encoding='utf-8') as f:
+                f.write(line)
+                f.flush()
+                os.fsync(f.fileno())
+            for item in batch:
+                if item['username'] in self._pending:
+                    self.coalesced += 1
+                    count = self._pending.pop(item['username'])[1] + 1
+                else:
+                    count = 1
+                self._pending[item['username']] = (item['values'], count)
+                self._pending_trades.extend(item['trades'])
+        self._wakeup.set()
+    
+    def pending(self):
+        """עותק של השמירות שעוד לא נכתבו (username -> values)"""
+        with self._lock:
+            return {username: values for username, (values, _) in self._pending.items()}
+    
+    def flush(self):
+        """כתיבת כל הממתינים לגיליון. מחזיר True אם הצליח (או שלא היה מה לכתוב)"""
+        with self._flush_lock:
+            with self._lock:
+                batch = self._pending
+                trades = self._pending_trades
+                self._pending = OrderedDict()
+                self._pending_trades = []
+            if not batch and not trades:
+                return True
+            
+            start = time.perf_counter()
+            api_calls = 0
+            try:
+                # 📌 היומן ושורות התיקים הם שני גיליונות - שתי כתיבות נפרדות, לא טרנזקציה אחת. אם השנייה נכשלת
+                # הגיליון לא עקבי לזמן קצר (למשל שורות איפוס ביומן והתיק הישן בגיליון), עד שהניסיון החוזר משלים אותה
+                if trades:
+                    # קודם היומן: הוספה אחת לכל העסקאות, ואז הן כבר לא ממתינות
+                    self._ledger.append(trades)
+                    api_calls += 1
+                    trades = []
+                    # 🛡️ העסקאות כבר ביומן בגיליון - מוחקים אותן מהיומן בדיסק מיד, אחרת קריסה לפני כתיבת
+                    # השורות (למשל בהמתנה אחרי שגיאת מכסה) תכתוב אותן שוב
+                    with self._lock:
+                        self._rewrite_journal(in_flight=batch)
+                if batch:
+                    sheet = self._connection.worksheet(header=PORTFOLIO_HEADER)
+                    rows = {username: values for username, (values, _) in batch.items()}
+                    api_calls += write_user_rows(sheet, rows, self._row_index, self._stats)
+            except Exception as e:
+                with self._lock:
+                    self._pending_trades = trades + self._pending_trades
+                    # 🛡️ מחזירים לתור - בלי לדרוס שמירה חדשה יותר של אותו משתמש
+                    for username, entry in batch.items():
+                        if username in self._pending:
+                            newer_values, newer_count = self._pending[username]
+                            self._pending[username] = (newer_values, newer_count + entry[1])
+                        else:
+                            self._pending[username] = entry
+                    self.failures += 1
+                    self.last_error = str(e)
+                if not is_quota_error(e):
+                    self._connection.reset()
+                return False
+            
+            latency = time.perf_counter() - start
+            self._stats.record_save(api_calls, saves=max(1, sum(count for _, count in batch.values())))
+            with self._lock:
+                self.flushes += 1
+                self.last_flush_latency = latency
+                self.total_flush_latency += latency
+                self.last_error = None
+                self._rewrite_journal()
+            return True
+    
+    def _run(self):
+        """לולאת הכתיבה ברקע - עם backoff אקספוננציאלי אחרי כישלון"""
+        attempt = 0
+        while not self._stopped:
+            delay = self._flush_interval
+            if attempt:
+                delay = min(SAVE_MAX_BACKOFF, self._flush_interval * 2 ** attempt) * random.uniform(0.5, 1.0)
+            self._wakeup.wait(delay)
+            self._wakeup.clear()
+            if self.flush():
+                attempt = 0
+            else:
+                attempt += 1
+                self.retries += 1
+    
+    def shutdown(self):
+        """כתיבה אחרונה בסגירת התהליך"""
+        self._stopped = True
+        self._wakeup.set()
+        self.flush()
+    
+    def stats(self):
+        """מדדי התור: עומק, זמני כתיבה וכישלונות"""
+        with self._lock:
+            return {
+                'depth': len(self._pending),
+                'pending_trades': len(self._pending_trades),
+                'flushes': self.flushes,
+                'coalesced': self.coalesced,
+                'failures': self.failures,
+                'retries': self.retries,
+                'last_flush_latency': self.last_flush_latency,
+                'avg_flush_latency': self.total_flush_latency / self.flushes if self.flushes else 0.0,
+                'last_error': self.last_error
+            }
+
+@st.cache_resource
+def get_save_queue(class_id):
+    """תור שמירות יחיד לכל כיתה (עם יומן בדיסק משלו)"""
+    return WriteBehindQueue(
+        connection=get_sheets_connection(class_id),
+        row_index=get_row_index(class_id),
+        ledger=get_ledger(class_id),
+        stats=get_sheets_stats(class_id),
+        journal_path=shard_path(os.path.join(DATA_DIR, 'pending_saves.jsonl'), class_id),
+        flush_interval=float(get_setting('save_queue', 'flush_interval', SAVE_FLUSH_INTERVAL))
+    )
+
+# ============================================
+# אחסון נתונים - Google Sheets או SQLite
+# ============================================
+
+# קידוד עמודת האחזקות בעמודות: "v1|AAPL,MSFT|2,1|150.0,504.75" (סימולים|כמויות|מחירים ממוצעים) -
+# חצי מהגודל של JSON (פחות נתונים לכל קריאה וכתיבה לגיליון). הקידוד מהיר בערך פי 1.6, והפענוח בערך כמו
+# json.loads (בניית המילונים היא רוב העבודה - benchmark.py codec). תאים ישנים (JSON שמתחיל ב-"{") עדיין נקראים,
+# ונכתבים מחדש בקידוד החדש בשמירה הבאה של התיק
+STOCKS_HEADER = 'v1|'
+
+def encode_stocks(stocks):
+    """האחזקות (symbol -> {'shares', 'avg_price'}) כמחרוזת לתא. סימול עם תו מפריד או כמות לא שלמה - נשמרים כ-JSON"""
+    symbols = ','.join(stocks)
+    try:
+        shares = ','.join([f"{holding['shares']:d}" for holding in stocks.values()])
+    except ValueError:
+        shares = None
+    if shares is None or '|' in symbols or symbols.count(',') != max(len(stocks) - 1, 0):
+        return json.dumps(stocks, ensure_ascii=False, default=Holding.to_dict)
+    prices = ','.join([repr(float(holding['avg_price'])) for holding in stocks.values()])
+    return f"{STOCKS_HEADER}{symbols}|{shares}|{prices}"
+
+def decode_stocks(cell):
+    """קריאת תא אחזקות - בקידוד v1 או JSON ישן"""
+    if not cell:
+        return {}
+    if cell.startswith(STOCKS_HEADER):
+        symbols, shares, prices = cell[len(STOCKS_HEADER):].split('|')
+        if not symbols:
+            return {}
+        return {symbol: {'shares': count, 'avg_price': price}
+                for symbol, count, price in zip(symbols.split(','), map(int, shares.split(',')), map(float, prices.split(',')))}
+    if cell.startswith('{'):
+        return json.loads(cell)
+    raise ValueError(f"קידוד אחזקות לא מוכר: {cell[:10]!r}")
+
+def portfolio_row_values(portfolio):
+    """ערכי עמודות B:D של תיק - ההיסטוריה נמצאת ביומן העסקאות, לכן עמודה D ריקה"""
+    return [portfolio['cash'], encode_stocks(portfolio['stocks']), '']
+
+class SheetsStorage:
+    """אחסון ב-Google Sheets: תיקים בגיליון הראשי, עסקאות בלשונית "עסקאות", כתיבה דרך תור השמירות"""
+    
+    name = 'sheets'
+    
+    def __init__(self, connection, row_index, ledger, queue, stats):
+        self._connection = connection
+        self._row_index = row_index
+        self._ledger = ledger
+        self._queue = queue
+        self._stats = stats
+    
+    def _sheet(self):
+        try:
+            return self._connection.worksheet(header=PORTFOLIO_HEADER)
+        except Exception:
+            # 🛡️ ייתכן שהחיבור נפל - מתחברים מחדש פעם אחת
+            self._connection.reset()
+            return self._connection.worksheet(header=PORTFOLIO_HEADER)
+    
+    def _parse_rows(self, rows):
+        """המרת שורות גיליון ([username, cash, stocks, history?]) לתיקים, כולל שמירות שעדיין בתור"""
+        # 🛡️ שמירות שעדיין בתור חדשות יותר ממה שבגיליון
+        pending = self._queue.pending()
+        
+        portfolios = {}
+        legacy_histories = {}
+        for row in rows:
+            row = list(row) + [''] * (4 - len(row))
+            username, cash, stocks, history = row[:4]
+            if not username:
+                continue
+            
+            if username in pending:
+                cash, stocks, history = pending[username]
+            
+            portfolios[username] = {
+                'cash': float(cash if cash != '' else 10000),
+                'stocks': decode_stocks(stocks)
+            }
+            
+            # היסטוריה בפורמט הישן (JSON בעמודה D) - מועברת ליומן העסקאות
+            if history:
+                legacy_histories[username] = json.loads(history)
+        
+        for username, history in legacy_histories.items():
+            if self._ledger.claim_migration(username):
+                trades = [trade_to_row(username, trade) for trade in history]
+                self.save(username, portfolio_row_values(portfolios[username]), trades)
+        
+        return portfolios, pending
+    
+    def _read(self, read):
+        """קריאה מהגיליון - עם ניתוק אחרי תקלה כדי שהפעם הבאה תתחבר מחדש"""
+        try:
+            return read(self._sheet())
+        except Exception:
+            self._connection.reset()
+            raise
+    
+    def _load_range(self, cell_range):
+        all_data = self._read(lambda sheet: sheet.get(cell_range, value_render_option='UNFORMATTED_VALUE'))
+        self._stats.record('get')
+        self._row_index.load([row[0] if row else '' for row in all_data])
+        portfolios, pending = self._parse_rows(all_data)
+        for username, (cash, stocks, _) in pending.items():
+            if username not in portfolios:
+                portfolios[username] = {'cash': float(cash), 'stocks': decode_stocks(stocks)}
+        return portfolios
+    
+    def load_all(self):
+        """כל התיקים (username -> {'cash', 'stocks'}), כולל שמירות שעדיין בתור. קורא גם את עמודה D: היסטוריה ישנה
+        שעוד לא הועברה ליומן חייבת לעבור לפני שהתיק נשמר (השמירה כותבת D ריקה). אחרי ההעברה העמודה ריקה"""
+        return self._load_range('A2:D')
+    
+    def load_user(self, username):
+        """התיק של משתמש אחד בלבד (None אם אין) - שורה אחת מהגיליון לפי אינדקס השורות"""
+        pending = self._queue.pending()
+        if username in pending:
+            cash, stocks, _ = pending[username]
+            return {'cash': float(cash), 'stocks': decode_stocks(stocks)}
+        
+        for attempt in range(2):
+            row_number = self._row_index.get(username)
+            if row_number is None or attempt:
+                self._read(self._row_index.refresh)
+                self._stats.record('col_values')
+                row_number = self._row_index.get(username)
+            if row_number is None:
+                return None
+            
+            values = self._read(lambda sheet: sheet.get(f'A{row_number}:D{row_number}', value_render_option='UNFORMATTED_VALUE'))
+            self._stats.record('get')
+            # 🛡️ מוודאים שהשורה עדיין שייכת למשתמש (אולי נוספו/נמחקו שורות בגיליון)
+            if values and values[0] and values[0][0] == username:
+                portfolios, _ = self._parse_rows(values)
+                return portfolios.get(username)
+        return None
+    
+    def save(self, username, values, trade_rows):
+        """שמירת שורת תיק ועסקאות - נרשם ביומן מקומי ונכתב לגיליון ברקע"""
+        self._ledger.record(username, trade_rows)
+        self._queue.enqueue(username, values, trade_rows)
+    
+    def save_many(self, entries):
+        """שמירה של כמה תיקים (username -> (values, trade_rows)) - רישום אחד ביומן המקומי (כולם או אף אחד).
+        הגיליון מתעדכן ברקע ובסופו של דבר - היומן קודם ואז שורות התיקים, עם ניסיון חוזר עד ששניהם נכתבו"""
+        self._queue.enqueue_many(entries)
+        for username, (_, trade_rows) in entries.items():
+            self._ledger.record(username, trade_rows)
+    
+    def trade_counts(self):
+        return self._ledger.counts()
+    
+    def recent_trades(self, username):
+        return self._ledger.recent(username)
+    
+    def trades_after(self, position):
+        """שורות יומן שנכתבו לגיליון אחרי position - (שורות, position חדש)"""
+        return self._read(lambda sheet: self._ledger.rows_after(position))
+    
+    def export_all(self):
+        """כל התיקים וכל שורות היומן - אחרי שכל מה שבתור נכתב"""
+        portfolios = self.load_all()
+        if not self._queue.flush():
+            raise RuntimeError("לא ניתן לכתוב את השמירות הממתינות לגיליון")
+        return portfolios, self._ledger.all_rows()
+
+SQLITE_SCHEMA = """
+CREATE TABLE IF NOT EXISTS portfolios (
+    username TEXT PRIMARY KEY,
+    cash REAL NOT NULL,
+    stocks TEXT NOT NULL DEFAULT '{}'
+);
+CREATE TABLE IF NOT EXISTS trades (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    username TEXT NOT NULL,
+    date TEXT,
+    action TEXT NOT NULL,
+    symbol TEXT,
+    shares REAL,
+    price REAL,
+    commission REAL,
+    total REAL
+);
+CREATE INDEX IF NOT EXISTS trades_by_user ON trades (username, id);
+"""
+
+class SqliteStorage:
+    """אחסון מקומי ב-SQLite (מצב WAL): חיפוש לפי username באינדקס, וכל עסקה נכתבת בטרנזקציה אחת"""
+    
+    name = 'sqlite'
+    
+    def __init__(self, path):
+        self.path = path
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._lock = threading.Lock()
+        with self._lock:
+            self._conn.execute('PRAGMA journal_mode=WAL')
+            self._conn.execute('PRAGMA synchronous=NORMAL')
+            self._conn.executescript(SQLITE_SCHEMA)
+    
+    @staticmethod
+    def _clean_row(row):
+        """ערכים ש-SQLite יודע לשמור (בלי טיפוסי numpy, '' הופך ל-NULL)"""
+        return [None if value == '' else float(value) if isinstance(value, float) else value for value in row]
+    
+    def load_all(self):
+        with self._lock:
+            rows = self._conn.execute('SELECT username, cash, stocks FROM portfolios').fetchall()
+        return {
+            username: {'cash': float(cash), 'stocks': decode_stocks(stocks)}
+            for username, cash, stocks in rows
+        }
+    
+    def load_user(self, username):
+        """התיק של משתמש אחד (חיפוש באינדקס של המפתח הראשי)"""
+        with self._lock:
+            row = self._conn.execute('SELECT cash, stocks FROM portfolios WHERE username = ?', (username,)).fetchone()
+        if row is None:
+            return None
+        cash, stocks = row
+        return {'cash': float(cash), 'stocks': decode_stocks(stocks)}
+    
+    def save(self, username, values, trade_rows):
+        """שמירת שורת תיק ועסקאות בטרנזקציה אחת"""
+        cash, stocks, _ = values
+        with self._lock, self._conn:
+            self._conn.execute(
+                'INSERT INTO portfolios (username, cash, stocks) VALUES (?, ?, ?) '
+                'ON CONFLICT(username) DO UPDATE SET cash = excluded.cash, stocks = excluded.stocks',
+                (username, float(cash), stocks)
+            )
+            self._conn.executemany(
+                'INSERT INTO trades (username, date, action, symbol, shares, price, commission, total) '
+                'VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                [self._clean_row(row) for row in trade_rows]
+            )
+    
+    def save_many(self, entries):
+        """שמירה של כמה תיקים (username -> (values, trade_rows)) בטרנזקציה אחת - כולם או אף אחד"""
+        with self._lock, self._conn:
+            self._conn.executemany(
+                'INSERT INTO portfolios (username, cash, stocks) VALUES (?, ?, ?) '
+                'ON CONFLICT(username) DO UPDATE SET cash = excluded.cash, stocks = excluded.stocks',
+                [(username, float(values[0]), values[1]) for username, (values, _) in entries.items()]
+            )
+            self._conn.executemany(
+                'INSERT INTO trades (username, date, action, symbol, shares, price, commission, total) '
+                'VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                [self._clean_row(row) for _, trade_rows in entries.values() for row in trade_rows]
+            )
+    
+    def trade_counts(self):
+        """מספר העסקאות של כל משתמש מאז האיפוס האחרון"""
+        with self._lock:
+            rows = self._conn.execute(
+                "WITH last_reset AS (SELECT username, MAX(id) AS id FROM trades WHERE action = 'reset' GROUP BY username) "
+                "SELECT t.username, COUNT(*) FROM trades t LEFT JOIN last_reset r ON r.username = t.username "
+                "WHERE t.action != 'reset' AND t.id > COALESCE(r.id, 0) GROUP BY t.username"
+            ).fetchall()
+        return dict(rows)
+    
+    def recent_trades(self, username):
+        """העסקאות האחרונות של משתמש (מהישנה לחדשה)"""
+        with self._lock:
+            rows = self._conn.execute(
+                'SELECT username, date, action, symbol, shares, price, commission, total FROM trades '
+                "WHERE username = ? AND id > COALESCE((SELECT MAX(id) FROM trades WHERE username = ? AND action = 'reset'), 0) "
+                'ORDER BY id DESC LIMIT ?',
+                (username, username, LEDGER_RECENT_LIMIT)
+            ).fetchall()
+        return [row_to_trade(row) for row in reversed(rows)]
+    
+    def trades_after(self, position):
+        """שורות יומן עם id גדול מ-position - (שורות, position חדש)"""
+        with self._lock:
+            rows = self._conn.execute(
+                'SELECT id, username, date, action, symbol, shares, price, commission, total FROM trades '
+                'WHERE id > ? ORDER BY id',
+                (position,)
+            ).fetchall()
+        if not rows:
+            return [], position
+        return [list(row[1:]) for row in rows], rows[-1][0]
+    
+    def replace_all(self, portfolios, trade_rows):
+        """החלפת כל התוכן (להעתקה מ-Google Sheets) בטרנזקציה אחת"""
+        with self._lock, self._conn:
+            self._conn.execute('DELETE FROM portfolios')
+            self._conn.execute('DELETE FROM trades')
+            self._conn.executemany(
+                'INSERT INTO portfolios (username, cash, stocks) VALUES (?, ?, ?)',
+                [(username, float(p['cash']), encode_stocks(p['stocks'])) for username, p in portfolios.items()]
+            )
+            self._conn.executemany(
+                'INSERT INTO trades (username, date, action, symbol, shares, price, commission, total) '
+                'VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                [self._clean_row(list(row) + [''] * (len(LEDGER_HEADER) - len(row))) for row in trade_rows]
+            )
+
+def get_sqlite_path(class_id):
+    return shard_path(get_setting('storage', 'path', os.path.join(DATA_DIR, 'portfolios.db')), class_id)
+
+def sheets_storage(class_id):
+    return SheetsStorage(get_sheets_connection(class_id), get_row_index(class_id), get_ledger(class_id),
+                         get_save_queue(class_id), get_sheets_stats(class_id))
+
+@st.cache_resource
+def get_storage(class_id):
+    """האחסון של כיתה לפי Secrets תחת [storage] (ברירת מחדל: Google Sheets)"""
+    backend = get_setting('storage', 'backend', 'sheets')
+    if backend == 'sqlite':
+        storage = SqliteStorage(get_sqlite_path(class_id))
+    elif backend == 'sheets':
+        storage = sheets_storage(class_id)
+    else:
+        raise ValueError(f"סוג אחסון לא מוכר: {backend}")
+    return get_metrics().instrument(storage, f'storage.{storage.name}')
+
+def migrate_sheets_to_sqlite(path, class_id):
+    """העתקת כל התיקים והעסקאות של כיתה מ-Google Sheets למסד SQLite. מחזיר (מספר תיקים, מספר עסקאות)"""
+    active = get_storage(class_id)
+    # 🛡️ replace_all מוחק את תוכן הקובץ - אסור שזה יהיה המסד שהאפליקציה עובדת מולו עכשיו
+    active_path = getattr(active, 'path', None)
+    if active_path and os.path.realpath(active_path) == os.path.realpath(path):
+        raise ValueError(f"הקובץ {path} הוא מסד הנתונים הפעיל - בחר קובץ אחר")
+    if active.name != 'sheets':
+        raise ValueError("ההעתקה אפשרית רק כשהאחסון הפעיל הוא Google Sheets")
+    source = sheets_storage(class_id)
+    portfolios, trade_rows = source.export_all()
+    SqliteStorage(path).replace_all(portfolios, trade_rows)
+    return len(portfolios), len(trade_rows)
+
+# ============================================
+# מאגר תיקים משותף לכל החיבורים
+# ============================================
+
+# כל כמה שניות כל דף בודק אם תיק שמוצג בו השתנה בחיבור אחר
+CHANGE_POLL_INTERVAL = 5
+CHANGE_FEED_SIZE = 1000
+
+class ConflictError(Exception):
+    """התיק השתנה (בחיבור אחר) מאז שנקרא - יש לקרוא מחדש ולנסות שוב"""
+
+class PortfolioStore:
+    """עותק אחד בזיכרון של התיקים לכל החיבורים: נעילה לכל משתמש, מספר גרסה לכל תיק ורשימת שינויים.
+    התיקים נשמרים בייצוג הקומפקטי (compact_portfolio)"""
+    
+    def __init__(self, storage, feed_size=CHANGE_FEED_SIZE):
+        self._storage = storage
+        self._portfolios = {}
+        self._versions = {}
+        self._user_locks = {}
+        self._feed = deque(maxlen=feed_size)
+        self._seq = 0
+        self._all_loaded = False
+        self._lock = threading.RLock()
+    
+    def lock(self, username):
+        """נעילה של משתמש אחד - לעטוף בה קריאה, בדיקה ושמירה של עסקה"""
+        with self._lock:
+            if username not in self._user_locks:
+                self._user_locks[username] = threading.RLock()
+            return self._user_locks[username]
+    
+    def get(self, username):
+        """התיק של משתמש (None אם אין). נטען מהאחסון רק בפעם הראשונה. אסור לשנות את המילון המוחזר"""
+        with self._lock:
+            if username in self._portfolios:
+                return self._portfolios[username]
+            if self._all_loaded:
+                return None
+        
+        with self.lock(username):
+            portfolio = compact_portfolio(self._storage.load_user(username))
+            with self._lock:
+                # 🛡️ אם בינתיים נשמר תיק חדש יותר - הוא קובע
+                if portfolio is not None and username not in self._portfolios:
+                    self._portfolios[username] = portfolio
+                    self._versions.setdefault(username, 0)
+                return self._portfolios.get(username)
+    
+    def all(self):
+        """כל התיקים (username -> תיק). האחסון נקרא פעם אחת, אחר כך הכל מהזיכרון"""
+        with self._lock:
+            if self._all_loaded:
+                return dict(self._portfolios)
+        return self.reload()
+    
+    def reload(self):
+        """קריאה מחדש של כל התיקים מהאחסון (למשל אחרי שינוי ידני בגיליון)"""
+        with self._lock:
+            versions = dict(self._versions)
+        portfolios = self._storage.load_all()
+        
+        with self._lock:
+            for username, portfolio in portfolios.items():
+                # 🛡️ תיק שנשמר בזמן הקריאה חדש יותר ממה שנקרא
+                if self._versions.get(username, 0) != versions.get(username, 0):
+                    continue
+                portfolio = compact_portfolio(portfolio)
+                if self._portfolios.get(username) != portfolio:
+                    self._portfolios[username] = portfolio
+                    self._versions[username] = self._versions.get(username, 0) + 1
+                    self._notify(username)
+            self._all_loaded = True
+            return dict(self._portfolios)
+    
+    def checkout(self, username):
+        """עותק לעריכה של התיק ומספר הגרסה שלו - להחזיר עם commit"""
+        portfolio = self.get(username)
+        with self._lock:
+            return copy.deepcopy(portfolio), self._versions.get(username, 0)
+    
+    def commit(self, username, portfolio, expected_version, trades=()):
+        """שמירת תיק ששונה. זורק ConflictError אם התיק השתנה מאז ה-checkout"""
+        with self.lock(username):
+            with self._lock:
+                if self._versions.get(username, 0) != expected_version:
+                    raise ConflictError(username)
+            
+            ledger_rows = [trade_to_row(username, trade) for trade in trades]
+            self._storage.save(username, portfolio_row_values(portfolio), ledger_rows)
+            
+            with self._lock:
+                self._portfolios[username] = compact_portfolio(portfolio)
+                self._versions[username] = expected_version + 1
+                self._notify(username)
+                return self._versions[username]
+    
+    def commit_many(self, changes):
+        """שמירה של כמה תיקים בבת אחת: username -> (תיק, גרסה מה-checkout, עסקאות).
+        כולם נשמרים בקריאה אחת לאחסון. אם תיק אחד השתנה בינתיים (ConflictError) או שהשמירה נכשלה -
+        אף תיק לא משתנה, לא באחסון ולא בזיכרון. ב-Sheets "נשמר" פירושו נרשם ביומן המקומי - הגיליון
+        מתעדכן אחר כך ברקע (ראו WriteBehindQueue.flush)"""
+        with ExitStack() as stack:
+            # 🛡️ נעילה בסדר קבוע - שתי פעולות מרוכזות במקביל לא ננעלות זו על זו
+            for username in sorted(changes):
+                stack.enter_context(self.lock(username))
+            with self._lock:
+                for username, (_, expected_version, _) in changes.items():
+                    if self._versions.get(username, 0) != expected_version:
+                        raise ConflictError(username)
+            
+            self._storage.save_many({
+                username: (portfolio_row_values(portfolio), [trade_to_row(username, trade) for trade in trades])
+                for username, (portfolio, _, trades) in changes.items()
+            })
+            
+            with self._lock:
+                for username, (portfolio, expected_version, _) in changes.items():
+                    self._portfolios[username] = compact_portfolio(portfolio)
+                    self._versions[username] = expected_version + 1
+                    self._notify(username)
+    
+    def _notify(self, username):
+        self._seq += 1
+        self._feed.append((self._seq, username))
+    
+    def last_seq(self):
+        with self._lock:
+            return self._seq
+    
+    def changes_since(self, seq):
+        """המשתמשים שהתיק שלהם השתנה אחרי seq, ו-seq העדכני. None = ייתכן שהכל השתנה"""
+        with self._lock:
+            if seq >= self._seq:
+                return set(), self._seq
+            if not self._feed or self._feed[0][0] > seq + 1:
+                return None, self._seq
+            return {username for change_seq, username in self._feed if change_seq > seq}, self._seq
+    
+    def version(self, username):
+        with self._lock:
+            return self._versions.get(username, 0)
+    
+    def held_symbols(self):
+        """כל המניות שמוחזקות בתיקים שכבר בזיכרון"""
+        with self._lock:
+            return {symbol for portfolio in self._portfolios.values() for symbol in portfolio['stocks']}
+
+@st.cache_resource
+def get_open_stores():
+    """class_id -> מאגר התיקים של כל כיתה שכבר נפתחה בתהליך (רענון המחירים עוקב אחרי האחזקות בכולן)"""
+    return {}
+
+@st.cache_resource
+def get_portfolio_store(class_id):
+    """מאגר התיקים המשותף של כיתה - אחד לכל כיתה בתהליך"""
+    store = PortfolioStore(get_storage(class_id))
+    get_open_stores()[class_id] = store
+    return store
+
+def store_for(username):
+    """מאגר התיקים של הכיתה שהמשתמש שייך אליה"""
+    return get_portfolio_store(get_class_router().class_of(username))
+
+# ============================================
+# ספקי נתוני שוק - Yahoo או סימולטור מקומי
+# ============================================
+
+PRICE_FIELDS = ['Open', 'High', 'Low', 'Close']
+
+# ברירות מחדל לסימולטור - ניתן לשנות ב-Secrets תחת [simulator]
+SIMULATOR_SEED = 42
+SIMULATOR_SPEED = 1.0           # שניות מדומות לכל שנייה אמיתית (3600 = שעת מסחר בשנייה)
+SIMULATOR_DRIFT = 0.07          # תשואה שנתית ממוצעת
+SIMULATOR_VOLATILITY = 0.25     # תנודתיות שנתית
+SIMULATOR_HISTORY_DAYS = 120    # ימים של היסטוריה מדומה לפני תחילת הסימולציה
+SIMULATOR_STEP = 300            # שניות מדומות בין שתי נקודות במסלול המחיר
+SECONDS_PER_YEAR = 365 * 24 * 3600
+
+class YahooProvider:
+    """נתוני שוק אמיתיים מ-Yahoo Finance (דרך yfinance). שגיאות רשת עולות למעלה - MarketGateway מנסה שוב ומדווח עליהן"""
+    
+    name = 'yahoo'
+    market_hours = True      # המחירים זזים רק כשהבורסה פתוחה
+    
+    def quotes(self, symbols):
+        """מחיר נוכחי וסגירה קודמת לכמה מניות בקריאה אחת (symbol -> {'price', 'prev_close'})"""
+        data = yf.download(list(symbols), period='5d', progress=False, auto_adjust=False)
+        if data.empty:
+            return {}
+        
+        closes = data['Close']
+        if isinstance(closes, pd.Series):
+            closes = closes.to_frame(name=symbols[0])
+        
+        quotes = {}
+        for symbol in symbols:
+            if symbol not in closes:
+                continue
+            series = closes[symbol].dropna()
+            if series.empty:
+                continue
+            price = float(series.iloc[-1])
+            prev_close = float(series.iloc[-2]) if len(series) >= 2 else price
+            quotes[symbol] = {'price': price, 'prev_close': prev_close}
+        return quotes
+    
+    def daily_bars(self, symbols, start):
+        """נרות יומיים (OHLC) מתאריך start ועד היום, לכמה מניות בקריאה אחת (symbol -> DataFrame)"""
+        data = yf.download(list(symbols), start=start, progress=False, auto_adjust=False)
+        if data.empty:
+            return {}
+        data.index = pd.to_datetime(data.index).tz_localize(None).normalize()
+        
+        bars = {}
+        for symbol in symbols:
+            if isinstance(data.columns, pd.MultiIndex):
+                if symbol not in data.columns.get_level_values(1):
+                    continue
+                frame = data.xs(symbol, axis=1, level=1)[PRICE_FIELDS]
+            else:
+                frame = data[PRICE_FIELDS]
+            frame = frame.dropna(subset=['Close'])
+            if not frame.empty:
+                bars[symbol] = frame.astype(float)
+        return bars
+    
+    def info(self, symbol):
+        """שם ומטבע של מניה"""
+        info = yf.Ticker(symbol).info
+        return {
+            'name': info.get('longName', symbol),
+            'currency': info.get('currency', 'USD')
+        }
+
+class SimulatedProvider:
+    """סימולטור שוק מקומי בלי רשת: מסלול GBM קבוע לכל מניה (לפי seed), או הרצה חוזרת של קובץ מחירים מוקלט.
+    הזמן המדומה מתחיל עכשיו ורץ במהירות speed; המסלול נשמר בזיכרון כך שכל ציטוט הוא חיפוש במערך"""
+    
+    name = 'simulator'
+    market_hours = False     # השוק המדומה פתוח תמיד
+    
+    def __init__(self, seed=SIMULATOR_SEED, speed=SIMULATOR_SPEED, replay_path=None,
+                 drift=SIMULATOR_DRIFT, volatility=SIMULATOR_VOLATILITY, history_days=SIMULATOR_HISTORY_DAYS):
+        self.seed = seed
+        self.speed = speed
+        self.drift = drift
+        self.volatility = volatility
+        self._started = time.time()
+        self._origin = self._started - history_days * 86400   # זמן מדומה של הנקודה הראשונה במסלול
+        self._paths = {}     # symbol -> (np.ndarray של log מחיר, Generator)
+        self._lock = threading.Lock()
+        self._replay = None
+        if replay_path:
+            # קובץ רחב: עמודת תאריך ועמודה לכל מניה (למשל panel.to_csv() ממאגר המחירים)
+            self._replay = pd.read_csv(replay_path, index_col=0, parse_dates=True).sort_index().ffill()
+    
+    def now(self):
+        """הזמן המדומה (epoch seconds)"""
+        return self._started + (time.time() - self._started) * self.speed
+    
+    # ---------- GBM ----------
+    
+    def _path(self, symbol, index):
+        """המסלול של מניה עד הנקודה index לפחות - נבנה בהדרגה ותמיד זהה לאותו seed"""
+        path, rng = self._paths.get(symbol, (None, None))
+        if path is None or len(path) <= index:
+            with self._lock:
+                path, rng = self._paths.get(symbol, (None, None))
+                if path is None:
+                    rng = np.random.default_rng([self.seed, zlib.crc32(symbol.encode())])
+                    start_price = 3.6 if symbol == FX_SYMBOL else rng.uniform(20, 500)
+                    path = np.array([np.log(start_price)])
+                if len(path) <= index:
+                    volatility = self.volatility / 3 if symbol == FX_SYMBOL else self.volatility
+                    dt = SIMULATOR_STEP / SECONDS_PER_YEAR
+                    count = max(index + 1 - len(path), 4096)
+                    steps = (self.drift - volatility ** 2 / 2) * dt + volatility * np.sqrt(dt) * rng.standard_normal(count)
+                    path = np.concatenate([path, path[-1] + np.cumsum(steps)])
+                self._paths[symbol] = (path, rng)
+        return path
+    
+    def _gbm_price(self, symbol, at):
+        index = int((at - self._origin) // SIMULATOR_STEP)
+        return float(np.exp(self._path(symbol, index)[index]))
+    
+    def _gbm_bars(self, symbol, days):
+        opens = [(pd.Timestamp(day) + pd.Timedelta(hours=9, minutes=30)).timestamp() for day in days]
+        closes = [(pd.Timestamp(day) + pd.Timedelta(hours=16)).timestamp() for day in days]
+        first = np.array([int((t - self._origin) // SIMULATOR_STEP) for t in opens])
+        last = np.array([int((t - self._origin) // SIMULATOR_STEP) for t in closes])
+        # 🛡️ בלי מחירים מהעתיד: הנר של היום נסגר במחיר של עכשיו, ולפני הפתיחה אין נר של היום בכלל
+        now = int((self.now() - self._origin) // SIMULATOR_STEP)
+        started = first <= now
+        days = pd.DatetimeIndex(days)[started]
+        first, last = first[started], np.minimum(last[started], now)
+        if len(days) == 0:
+            return pd.DataFrame(columns=PRICE_FIELDS, dtype=float)
+        path = np.exp(self._path(symbol, int(last.max())))
+        return pd.DataFrame({
+            'Open': path[first],
+            'High': [path[a:b + 1].max() for a, b in zip(first, last)],
+            'Low': [path[a:b + 1].min() for a, b in zip(first, last)],
+            'Close': path[last]
+        }, index=days)
+    
+    # ---------- הרצה חוזרת ----------
+    
+    def _replay_position(self, at):
+        """מיקום (שורה, יכול להיות שבר) בקובץ המוקלט - שורה לכל יום מדומה, וההתחלה אחרי ההיסטוריה"""
+        start_row = min(SIMULATOR_HISTORY_DAYS * 5 // 7, len(self._replay) - 1)
+        return min(start_row + (at - self._started) / 86400, len(self._replay) - 1)
+    
+    def _replay_price(self, symbol, at):
+        column = self._replay[symbol].to_numpy(dtype=float)
+        position = self._replay_position(at)
+        low = int(position)
+        high = min(low + 1, len(column) - 1)
+        return float(column[low] + (column[high] - column[low]) * (position - low))
+    
+    def _replay_bars(self, symbol, days):
+        # השורות עד המיקום הנוכחי מקבלות את תאריכי ימי המסחר שמסתיימים היום המדומה
+        rows = self._replay[symbol].to_numpy(dtype=float)[:int(self._replay_position(self.now())) + 1]
+        dates = pd.bdate_range(end=pd.Timestamp(self.now(), unit='s').normalize(), periods=len(rows))
+        closes = pd.Series(rows, index=dates).reindex(pd.DatetimeIndex(days)).dropna()
+        opens = closes.shift(1).fillna(closes)
+        return pd.DataFrame({
+            'Open': opens,
+            'High': np.maximum(opens, closes),
+            'Low': np.minimum(opens, closes),
+            'Close': closes
+        })
+    
+    def _replayed(self, symbol):
+        return self._replay is not None and symbol in self._replay
+    
+    # ---------- ממשק הספק ----------
+    
+    def price(self, symbol, at=None):
+        at = self.now() if at is None else at
+        return self._replay_price(symbol, at) if self._replayed(symbol) else self._gbm_price(symbol, at)
+    
+    def quotes(self, symbols):
+        now = self.now()
+        today = pd.Timestamp(now, unit='s').normalize()
+        prev_day = today - pd.offsets.BDay(1)
+        prev_close_at = (prev_day + pd.Timedelta(hours=16)).timestamp()
+        return {
+            symbol: {'price': self.price(symbol, now), 'prev_close': self.price(symbol, prev_close_at)}
+            for symbol in symbols
+        }
+    
+    def daily_bars(self, symbols, start):
+        today = pd.Timestamp(self.now(), unit='s').normalize()
+        first_day = max(pd.Timestamp(start).normalize(), pd.Timestamp(self._origin, unit='s').normalize() + pd.Timedelta(days=1))
+        days = pd.bdate_range(first_day, today)
+        if len(days) == 0:
+            return {}
+        return {
+            symbol: self._replay_bars(symbol, days) if self._replayed(symbol) else self._gbm_bars(symbol, days)
+            for symbol in symbols
+        }
+    
+    def info(self, symbol):
+        return {'name': f"{symbol} (סימולציה)", 'currency': 'USD'}
+
+# ============================================
+# שער לספק נתוני השוק - הגבלת קצב, איחוד בקשות וניסיונות חוזרים
+# ============================================
+
+# ברירות מחדל - ניתן לשנות ב-Secrets תחת [market_data]
+MARKET_RATE_LIMIT = 2.0       # קריאות לשנייה ל-Yahoo (בממוצע)
+MARKET_BURST = 5              # קריאות רצופות שמותרות לפני שמתחילים להמתין
+MARKET_RETRIES = 2            # ניסיונות חוזרים אחרי שגיאה או תשובה ריקה
+MARKET_RETRY_DELAY = 0.5      # השהיה בסיסית (שניות) לפני ניסיון חוזר - מוכפלת בכל ניסיון
+
+class TokenBucket:
+    """מגביל קצב (token bucket): rate קריאות לשנייה בממוצע, עד burst ברצף. rate=0 - בלי הגבלה"""
+    
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self._tokens = float(burst)
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+        self.waits = 0
+        self.waited = 0.0
+    
+    def acquire(self):
+        """לקיחת אסימון - ממתין אם אין פנוי. מחזיר כמה שניות הומתן"""
+        if not self.rate:
+            return 0.0
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+            self._updated = now
+            # האסימון נלקח מיד (גם "בהקפה") - כך הממתינים מקבלים תורות לפי סדר ההגעה
+            self._tokens -= 1
+            wait = -self._tokens / self.rate if self._tokens < 0 else 0.0
+            if wait:
+                self.waits += 1
+                self.waited += wait
+        if wait:
+            time.sleep(wait)
+        return wait
+
+class InFlight:
+    """משיכה אחת שבדרך - תהליכונים אחרים שצריכים את אותם מפתחות ממתינים לתוצאה שלה"""
+    
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = {}
+
+class MarketGateway:
+    """השער היחיד לספק נתוני השוק: בקשות זהות שבדרך מתאחדות (single-flight), כל קריאה לספק עוברת
+    במגביל הקצב, ושגיאה או תשובה ריקה (כך Yahoo מגיב כשהוא חוסם) מקבלות ניסיון חוזר עם jitter"""
+    
+    def __init__(self, provider, limiter, retries, retry_delay):
+        self._provider = provider
+        self._limiter = limiter
+        self._retries = retries
+        self._retry_delay = retry_delay
+        self._inflight = {}   # key -> InFlight
+        self._lock = threading.Lock()
+        self.name = provider.name
+        self.market_hours = provider.market_hours
+        self.requests = 0
+        self.coalesced = 0
+        self.upstream_calls = 0
+        self.retries = 0
+        self.failures = 0
+        self.last_error = None
+    
+    def _call(self, method, *args):
+        """קריאה לספק עם הגבלת קצב וניסיונות חוזרים. מחזיר None אם כל הניסיונות נכשלו"""
+        error = None
+        for attempt in range(self._retries + 1):
+            if attempt:
+                with self._lock:
+                    self.retries += 1
+                time.sleep(self._retry_delay * 2 ** (attempt - 1) * random.uniform(0.5, 1.5))
+            self._limiter.acquire()
+            with self._lock:
+                self.upstream_calls += 1
+            try:
+                result = getattr(self._provider, method)(*args)
+            except Exception as e:
+                error = e
+                continue
+            if result:
+                self.last_error = None
+                return result
+            error = None
+        with self._lock:
+            self.failures += 1
+            self.last_error = str(error) if error else f"תשובה ריקה מהספק ({method})"
+        return None
+    
+    def _single_flight(self, keys, fetch):
+        """key -> value. מפתחות שתהליכון אחר כבר מושך - מחכים לתוצאה שלו; השאר נמשכים יחד בקריאה אחת ל-fetch(keys)"""
+        own = []
+        shared = {}
+        flight = InFlight()
+        with self._lock:
+            self.requests += len(keys)
+            for key in dict.fromkeys(keys):
+                other = self._inflight.get(key)
+                if other is None:
+                    self._inflight[key] = flight
+                    own.append(key)
+                else:
+                    shared[key] = other
+                    self.coalesced += 1
+        
+        result = {}
+        if own:
+            try:
+                flight.result = fetch(own) or {}
+            finally:
+                with self._lock:
+                    for key in own:
+                        del self._inflight[key]
+                flight.done.set()
+            result.update(flight.result)
+        
+        for key, other in shared.items():
+            other.done.wait()
+            if key in other.result:
+                result[key] = other.result[key]
+        return result
+    
+    def quotes(self, symbols):
+        def fetch(keys):
+            quotes = self._call('quotes', [symbol for _, symbol in keys]) or {}
+            return {('quote', symbol): quote for symbol, quote in quotes.items()}
+        
+        fetched = self._single_flight([('quote', symbol) for symbol in symbols], fetch)
+        return {symbol: quote for (_, symbol), quote in fetched.items()}
+    
+    def daily_bars(self, symbols, start):
+        def fetch(keys):
+            bars = self._call('daily_bars', [symbol for _, symbol, _ in keys], start) or {}
+            return {('bars', symbol, start): frame for symbol, frame in bars.items()}
+        
+        fetched = self._single_flight([('bars', symbol, start) for symbol in symbols], fetch)
+        return {symbol: frame for (_, symbol, _), frame in fetched.items()}
+    
+    def info(self, symbol):
+        key = ('info', symbol)
+        return self._single_flight([key], lambda keys: {key: self._call('info', symbol)}).get(key)
+    
+    def stats(self):
+        with self._lock:
+            return {
+                'requests': self.requests,
+                'coalesced': self.coalesced,
+                'upstream_calls': self.upstream_calls,
+                'retries': self.retries,
+                'failures': self.failures,
+                'throttled': self._limiter.waits,
+                'throttled_seconds': self._limiter.waited,
+                'last_error': self.last_error
+            }
+
+@st.cache_resource
+def get_market_provider():
+    """ספק נתוני השוק שנבחר ב-Secrets תחת [market_data] provider (ברירת מחדל: Yahoo), מאחורי MarketGateway"""
+    provider = get_setting('market_data', 'provider', 'yahoo')
+    if provider == 'simulator':
+        provider = SimulatedProvider(
+            seed=get_setting('simulator', 'seed', SIMULATOR_SEED),
+            speed=get_setting('simulator', 'speed', SIMULATOR_SPEED),
+            replay_path=get_setting('simulator', 'replay_path', None),
+            drift=get_setting('simulator', 'drift', SIMULATOR_DRIFT),
+            volatility=get_setting('simulator', 'volatility', SIMULATOR_VOLATILITY)
+        )
+    elif provider == 'yahoo':
+        provider = YahooProvider()
+    else:
+        raise ValueError(f"ספק נתוני שוק לא מוכר: {provider}")
+    # הסימולטור מקומי - אין סיבה להגביל אותו כברירת מחדל
+    limiter = TokenBucket(
+        get_setting('market_data', 'rate_limit', MARKET_RATE_LIMIT if provider.name == 'yahoo' else 0),
+        get_setting('market_data', 'burst', MARKET_BURST)
+    )
+    return MarketGateway(
+        get_metrics().instrument(provider, f'market.{provider.name}'),
+        limiter,
+        get_setting('market_data', 'retries', MARKET_RETRIES),
+        MARKET_RETRY_DELAY
+    )
+
+def market_data_path(name):
+    """מיקום קובץ/תיקייה של נתוני שוק - נתוני הסימולטור נשמרים בנפרד כדי לא להתערבב עם האמיתיים"""
+    provider = get_market_provider()
+    if provider.name == 'yahoo':
+        return os.path.join(DATA_DIR, name)
+    return os.path.join(DATA_DIR, provider.name, name)
+
+# ============================================
+# רענון מחירים ברקע
+# ============================================
+
+# ברירות מחדל - ניתן לשנות ב-Secrets תחת [market_data]
+MARKET_REFRESH_INTERVAL = 30      # שניות בין רענונים כשהבורסה בארה"ב פתוחה
+MARKET_CLOSED_INTERVAL = 900      # שניות בין רענונים כשהבורסה סגורה
+FX_SYMBOL = "ILS=X"
+MARKET_TIMEZONE = ZoneInfo("America/New_York")
+MARKET_OPEN_TIME = dtime(9, 30)
+MARKET_CLOSE_TIME = dtime(16, 0)
+
+def is_market_open(now=None):
+    """האם הבורסה בניו יורק פתוחה עכשיו (ימים ב'-ו' בשעון ארה"ב, בלי חגים)"""
+    now = (now or datetime.now(MARKET_TIMEZONE)).astimezone(MARKET_TIMEZONE)
+    return now.weekday() < 5 and MARKET_OPEN_TIME <= now.time() < MARKET_CLOSE_TIME
+
+def seconds_until_market_open(now=None):
+    """שניות עד הפתיחה הבאה של הבורסה (0 אם פתוחה)"""
+    now = (now or datetime.now(MARKET_TIMEZONE)).astimezone(MARKET_TIMEZONE)
+    if is_market_open(now):
+        return 0
+    opening = now.replace(hour=MARKET_OPEN_TIME.hour, minute=MARKET_OPEN_TIME.minute, second=0, microsecond=0)
+    if now.time() >= MARKET_OPEN_TIME:
+        opening += timedelta(days=1)
+    while opening.weekday() >= 5:
+        opening += timedelta(days=1)
+    return (opening - now).total_seconds()
+
+class MarketDataRefresher:
+    """תהליכון רקע שמושך בקריאה אחת את כל המניות המוחזקות, הרשימה הפופולרית ושער הדולר - והדפים מציגים מהתמונה המשותפת"""
+    
+    def __init__(self, stores, provider, base_symbols, open_interval, closed_interval):
+        self._stores = stores      # class_id -> PortfolioStore (מתמלא ככל שנפתחות כיתות)
+        self._provider = provider
+        self._base_symbols = set(base_symbols)
+        self._requested = set()
+        self.open_interval = open_interval
+        self.closed_interval = closed_interval
+        self._quotes = {}     # symbol -> {'price', 'prev_close', 'fetched_at'}
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self.runs = 0
+        self.failures = 0
+        self.last_run = None
+        self.last_duration = 0.0
+        self.last_error = None
+        self._thread = threading.Thread(target=self._run, name="market-data-refresher", daemon=True)
+        self._thread.start()
+    
+    def track(self, symbols):
+        """הוספת מניות (למשל סימול שהוקלד ידנית) לרענון הבא - מעירה את התהליכון אם יש חדשות"""
+        with self._lock:
+            new = set(symbols) - self._requested - self._base_symbols
+            self._requested.update(new)
+        if new:
+            self._wake.set()
+    
+    def interval(self):
+        if not self._provider.market_hours or is_market_open():
+            return self.open_interval
+        return self.closed_interval
+    
+    def max_age(self):
+        """גיל מקסימלי של מחיר בתמונה לפני שחוזרים למשיכה ישירה (אם הרענון נתקע)"""
+        return 3 * self.interval()
+    
+    def quotes(self, symbols):
+        """המחירים הטריים מהתמונה המשותפת (symbol -> quote) - בלי קריאת רשת"""
+        limit = time.time() - self.max_age()
+        with self._lock:
+            return {
+                symbol: self._quotes[symbol] for symbol in symbols
+                if symbol in self._quotes and self._quotes[symbol]['fetched_at'] >= limit
+            }
+    
+    def refresh(self):
+        """רענון אחד: כל הסימולים וגם שער הדולר בקריאת רשת אחת"""
+        with self._lock:
+            symbols = self._base_symbols | self._requested
+        held = set().union(*(store.held_symbols() for store in list(self._stores.values())))
+        symbols = sorted(symbols | held) + [FX_SYMBOL]
+        
+        started = time.time()
+        quotes = self._provider.quotes(symbols)
+        if not quotes:
+            raise RuntimeError(f"לא התקבלו מחירים מהספק ({self._provider.name})")
+        
+        fetched_at = time.time()
+        with self._lock:
+            for symbol, quote in quotes.items():
+                self._quotes[symbol] = dict(quote, fetched_at=fetched_at)
+            self.runs += 1
+            self.last_run = fetched_at
+            self.last_duration = fetched_at - started
+            self.last_error = None
+    
+    def _run(self):
+        while True:
+            try:
+                self.refresh()
+            except Exception as e:
+                with self._lock:
+                    self.failures += 1
+                    self.last_error = str(e)
+            
+            # 💤 כשהבורסה סגורה המחירים לא זזים - מחכים יותר, אבל מתעוררים לפתיחה
+            delay = self.interval()
+            if delay == self.closed_interval:
+                delay = max(self.open_interval, min(delay, seconds_until_market_open()))
+            self._wake.wait(delay)
+            self._wake.clear()
+    
+    def stats(self):
+        with self._lock:
+            return {
+                'symbols': len(self._quotes),
+                'runs': self.runs,
+                'failures': self.failures,
+                'last_run': self.last_run,
+                'last_duration': self.last_duration,
+                'last_error': self.last_error,
+                'market_open': not self._provider.market_hours or is_market_open(),
+                'provider': self._provider.name,
+                'interval': self.interval()
+            }
+
+@st.cache_resource
+def get_market_data():
+    """שירות רענון המחירים - אחד לכל התהליך, מתחיל לרוץ בקריאה הראשונה"""
+    base_symbols = [symbol for symbol in POPULAR_STOCKS.values() if not symbol.startswith("HEADER") and symbol != "CUSTOM"]
+    return MarketDataRefresher(
+        get_open_stores(),
+        get_market_provider(),
+        base_symbols,
+        get_setting('market_data', 'refresh_interval', MARKET_REFRESH_INTERVAL),
+        get_setting('market_data', 'closed_interval', MARKET_CLOSED_INTERVAL)
+    )
+
+# ============================================
+# מאגר מחירים יומיים בדיסק (Parquet)
+# ============================================
+
+PRICE_STORE_FRESHNESS = 900     # שניות שבהן מניה שנבדקה לא נבדקת שוב מול הספק
+
+class PriceStore:
+    """נרות יומיים לכל מניה בקובץ Parquet משלה: נמשך מהספק רק הזנב שאחרי הנר האחרון שנשמר"""
+    
+    def __init__(self, directory, provider, freshness=PRICE_STORE_FRESHNESS):
+        self._dir = directory
+        self._provider = provider
+        self.freshness = freshness
+        self._bars = {}      # symbol -> DataFrame (נטען מהדיסק לפי צורך)
+        self._checked = {}   # symbol -> מתי נבדק מול הספק לאחרונה
+        self._lock = threading.Lock()
+        self.fetches = 0
+        os.makedirs(directory, exist_ok=True)
+        
+        # התאריך הראשון שכבר נמשך לכל מניה (כדי לדעת אם צריך להשלים אחורה)
+        self._index_path = os.path.join(directory, 'index.json')
+        try:
+            with open(self._index_path, encoding='utf-8') as f:
+                self._coverage = {symbol: pd.Timestamp(day) for symbol, day in json.load(f).items()}
+        except (OSError, ValueError):
+            self._coverage = {}
+    
+    def _path(self, symbol):
+        return os.path.join(self._dir, f'{symbol}.parquet')
+    
+    def _load(self, symbol):
+        if symbol not in self._bars:
+            path = self._path(symbol)
+            self._bars[symbol] = pd.read_parquet(path) if os.path.exists(path) else pd.DataFrame(columns=PRICE_FIELDS, dtype=float)
+        return self._bars[symbol]
+    
+    def _store(self, symbol, fetched, start):
+        # נרות חדשים גוברים על הישנים (הנר של היום מתעדכן עד הסגירה)
+        bars = fetched.combine_first(self._load(symbol)) if len(self._load(symbol)) else fetched
+        bars = bars.sort_index()
+        tmp_path = self._path(symbol) + '.tmp'
+        bars.to_parquet(tmp_path)
+        os.replace(tmp_path, self._path(symbol))
+        self._bars[symbol] = bars
+        if symbol not in self._coverage or start < self._coverage[symbol]:
+            self._coverage[symbol] = start
+    
+    def _plan(self, symbols, start):
+        """אילו משיכות חסרות (נקרא תחת self._lock): מניות חדשות מ-start, לכל השאר רק מהנר האחרון"""
+        now = time.time()
+        stale = {s for s in symbols if now - self._checked.get(s, 0) >= self.freshness}
+        # 🛡️ מניה שלא נמצאה אצל הספק לא נבדקת שוב עד שעובר זמן הטריות
+        full = [s for s in symbols if (s in self._coverage and self._coverage[s] > start) or (s not in self._coverage and s in stale)]
+        tail = [s for s in symbols if s in stale and s not in full]
+        
+        requests = []
+        if full:
+            requests.append((full, start, True))
+        if tail:
+            last_bars = [self._load(s).index.max() for s in tail]
+            since = min((day for day in last_bars if pd.notna(day)), default=start)
+            requests.append((tail, since, False))
+        return requests
+    
+    def _update(self, symbols, start):
+        """משיכת מה שחסר. הרשת (כולל ניסיונות חוזרים והמתנות) מחוץ לנעילה - הנעילה רק לתכנון, למיזוג ולכתיבת הקבצים.
+        שתי קריאות במקביל עלולות למשוך את אותו זנב פעמיים - השער מאחד בקשות זהות, והמיזוג של אותם נרות לא משנה דבר"""
+        with self._lock:
+            requests = self._plan(symbols, start)
+        if not requests:
+            return
+        
+        now = time.time()
+        results = [(batch, since, is_full, self._provider.daily_bars(batch, since.strftime('%Y-%m-%d')))
+                   for batch, since, is_full in requests]
+        
+        with self._lock:
+            for batch, since, is_full, fetched in results:
+                self.fetches += 1
+                for symbol, bars in fetched.items():
+                    self._store(symbol, bars, since if is_full else self._coverage.get(symbol, since))
+                for symbol in batch:
+                    self._checked[symbol] = now
+            tmp_path = self._index_path + '.tmp'
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                json.dump({symbol: day.strftime('%Y-%m-%d') for symbol, day in self._coverage.items()}, f)
+            os.replace(tmp_path, self._index_path)
+    
+    def bars(self, symbol, start, end=None):
+        """נרות יומיים של מניה בטווח תאריכים (בלי רשת אם המידע טרי)"""
+        start = pd.Timestamp(start).normalize()
+        self._update([symbol], start)
+        with self._lock:
+            bars = self._load(symbol)
+        bars = bars[bars.index >= start]
+        return bars if end is None else bars[bars.index <= pd.Timestamp(end)]
+    
+    def closes(self, symbols, start):
+        """טבלת סגירות (תאריכים x מניות) מ-start ועד היום"""
+        start = pd.Timestamp(start).normalize()
+        symbols = list(dict.fromkeys(symbols))
+        self._update(symbols, start)
+        with self._lock:
+            columns = {symbol: self._load(symbol)['Close'] for symbol in symbols}
+        panel = pd.DataFrame(columns).reindex(columns=symbols)
+        panel.index = pd.to_datetime(panel.index)
+        return panel[panel.index >= start].sort_index()
+    
+    def stats(self):
+        with self._lock:
+            return {'symbols': len(self._coverage), 'fetches': self.fetches}
+
+@st.cache_resource
+def get_price_store():
+    """מאגר המחירים היומיים - אחד לכל התהליך, הקבצים ב-data/prices"""
+    return PriceStore(market_data_path('prices'), get_market_provider())
+
+# ============================================
+# קטלוג מניות (שם, מטבע ומחירי סגירה לחודש)
+# ============================================
+
+CATALOG_MAX_AGE = 900               # שניות עד שמחירי הסגירה בקטלוג מתעדכנים מזנב מאגר המחירים
+CATALOG_MISS_TTL = 600              # שניות שבהן סימול לא קיים לא נבדק שוב
+
+class InstrumentCatalog:
+    """קטלוג מניות בדיסק: שם ומטבע נשמרים לתמיד, מחירי הסגירה מתעדכנים ברקע ממאגר המחירים
+    (שמושך מהספק רק את הזנב החדש) - כך הנר של היום מתגלגל קדימה במהלך המסחר"""
+    
+    def __init__(self, path, symbols, prices, provider, max_age=CATALOG_MAX_AGE):
+        self._path = path
+        self._prices = prices
+        self._provider = provider
+        self._symbols = list(dict.fromkeys(symbols))
+        self.max_age = max_age
+        self._entries = {}   # symbol -> {'name', 'currency', 'dates', 'closes'}
+        self._misses = {}    # symbol -> מתי נבדק ולא נמצא
+        self.built_at = 0
+        self.version = 0     # עולה בכל שינוי - לפיו מנועים שמחשבים מהקטלוג יודעים לחשב מחדש
+        self.last_error = None
+        self._lock = threading.Lock()
+        self._build_lock = threading.Lock()
+        
+        self._load()
+        self._thread = threading.Thread(target=self._run, name="instrument-catalog", daemon=True)
+        self._thread.start()
+    
+    def _load(self):
+        if not os.path.exists(self._path):
+            return
+        try:
+            with open(self._path, encoding='utf-8') as f:
+                data = json.load(f)
+            self._entries = data.get('instruments', {})
+            self.built_at = data.get('built_at', 0)
+        except (OSError, ValueError) as e:
+            self.last_error = f"קובץ הקטלוג פגום, נבנה מחדש: {e}"
+    
+    def _save(self):
+        """כתיבה אטומית של הקטלוג (נקרא תחת self._lock)"""
+        os.makedirs(os.path.dirname(self._path), exist_ok=True)
+        tmp_path = self._path + '.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump({'built_at': self.built_at, 'instruments': self._entries}, f, ensure_ascii=False)
+        os.replace(tmp_path, self._path)
+    
+    def _month_closes(self, symbols):
+        """מחירי סגירה לחודש האחרון ממאגר המחירים (symbol -> {'dates', 'closes'})"""
+        start = pd.Timestamp.now().normalize() - pd.DateOffset(months=1)
+        panel = self._prices.closes(symbols, start)
+        series = {}
+        for symbol in panel:
+            column = panel[symbol].dropna()
+            if not column.empty:
+                series[symbol] = {
+                    'dates': [day.strftime('%Y-%m-%d') for day in column.index],
+                    'closes': [float(price) for price in column]
+                }
+        return series
+    
+    def build(self):
+        """בניית הקטלוג: מידע (info) רק למניות חדשות, ומחירי הסגירה לכולן בקריאה אחת"""
+        with self._build_lock:
+            with self._lock:
+                symbols = list(dict.fromkeys(self._symbols + list(self._entries)))
+                new_symbols = [s for s in symbols if s not in self._entries]
+            
+            infos = {symbol: self._provider.info(symbol) for symbol in new_symbols}
+            closes = self._month_closes(symbols)
+            if not closes:
+                raise RuntimeError("לא התקבלו מחירי סגירה מהספק")
+            
+            with self._lock:
+                changed = False
+                for symbol in symbols:
+                    entry = self._entries.get(symbol) or infos.get(symbol) or {'name': symbol, 'currency': 'USD'}
+                    entry = dict(entry, **closes.get(symbol, {}))
+                    changed = changed or entry != self._entries.get(symbol)
+                    self._entries[symbol] = entry
+                self.built_at = time.time()
+                self.last_error = None
+                # הגרסה עולה רק כשמשהו השתנה - אחרת מנוע הביצועים לא מחשב מחדש סתם
+                if changed:
+                    self.version += 1
+                    self._save()
+    
+    def _run(self):
+        while True:
+            age = time.time() - self.built_at
+            if age >= self.max_age:
+                try:
+                    self.build()
+                    continue
+                except Exception as e:
+                    self.last_error = str(e)
+                    age = self.max_age - 300  # ננסה שוב בעוד 5 דקות
+            time.sleep(self.max_age - age)
+    
+    def lookup(self, symbol):
+        """הרשומה של מניה מהקטלוג; סימול שלא מופיע נמשך פעם אחת מהספק ונוסף לקטלוג (None אם לא קיים)"""
+        with self._lock:
+            entry = self._entries.get(symbol)
+            if entry is not None:
+                return entry
+            if time.time() - self._misses.get(symbol, 0) < CATALOG_MISS_TTL:
+                return None
+        
+        info = self._provider.info(symbol)
+        closes = self._month_closes([symbol]).get(symbol)
+        with self._lock:
+            if info is None or not closes:
+                self._misses[symbol] = time.time()
+                return None
+            self._entries[symbol] = dict(info, **closes)
+            self.version += 1
+            self._save()
+            return self._entries[symbol]
+    
+    def series(self, symbols=None):
+        """מחירי הסגירה (symbol -> {'dates', 'closes'}) של המניות שבקטלוג, והגרסה שלהם"""
+        with self._lock:
+            symbols = self._entries.keys() if symbols is None else symbols
+            series = {
+                symbol: self._entries[symbol] for symbol in symbols
+                if symbol in self._entries and self._entries[symbol].get('dates')
+            }
+            return series, self.version
+    
+    def stats(self):
+        with self._lock:
+            return {
+                'size': len(self._entries),
+                'built_at': self.built_at,
+                'last_error': self.last_error
+            }
+
+@st.cache_resource
+def get_instrument_catalog():
+    """קטלוג המניות - אחד לכל התהליך, נטען מהדיסק ונבנה ברקע"""
+    symbols = [symbol for symbol in POPULAR_STOCKS.values() if not symbol.startswith("HEADER") and symbol != "CUSTOM"]
+    symbols += list(STOCK_DESCRIPTIONS)
+    return InstrumentCatalog(market_data_path('instruments.json'), symbols, get_price_store(), get_market_provider())
+
+# ============================================
+# מנוע ביצועים (כל המניות בבת אחת)
+# ============================================
+
+# חלונות תשואה בימי מסחר (None = מתחילת התקופה)
+PERFORMANCE_WINDOWS = {'daily_change': 1, 'weekly_change': 4, 'monthly_change': None}
+MONTHLY_MIN_DAYS = 20
+MOVING_AVERAGES = (5, 20)
+TRADING_DAYS_PER_YEAR = 252
+
+def price_panel(series):
+    """טבלת מחירים: שורה לכל יום מסחר, עמודה לכל מניה (NaN איפה שאין מחיר)"""
+    if not series:
+        return pd.DataFrame()
+    panel = pd.DataFrame({
+        symbol: pd.Series(entry['closes'], index=pd.to_datetime(entry['dates']))
+        for symbol, entry in series.items()
+    })
+    return panel.sort_index()
+
+def align_by_position(panel):
+    """כל מניה לפי ימי המסחר שלה: הערכים של כל עמודה (בלי NaN) מיושרים לסוף לפי מיקום - שורה אחרונה = המחיר האחרון.
+    כך מניה שנסחרת גם בסוף שבוע (BTC-USD) לא מוסיפה ימים ריקים לשאר המניות ולא מזיזה את החלונות שלהן"""
+    columns = {}
+    for symbol in panel.columns:
+        values = panel[symbol].dropna().to_numpy()
+        columns[symbol] = pd.Series(values, index=range(1 - len(values), 1), dtype=float)
+    return pd.DataFrame(columns, columns=panel.columns).sort_index()
+
+def compute_performance(panel, windows=PERFORMANCE_WINDOWS, moving_averages=MOVING_AVERAGES):
+    """תשואות (%), תנודתיות שנתית (%), ירידה מקסימלית (%) וממוצעים נעים לכל המניות בחישוב וקטורי אחד"""
+    panel = align_by_position(panel)
+    if panel.empty:
+        return pd.DataFrame()
+    
+    filled = panel.ffill()
+    last = filled.iloc[-1]
+    days = panel.notna().sum()
+    stats = pd.DataFrame({'last_price': last})
+    
+    for name, window in windows.items():
+        if window is None:
+            base = panel.bfill().iloc[0]
+            valid = days >= MONTHLY_MIN_DAYS
+        else:
+            base = filled.shift(window).iloc[-1]
+            valid = days > window
+        stats[name] = ((last - base) / base * 100).where(valid)
+    
+    daily_returns = filled.pct_change(fill_method=None)
+    stats['volatility'] = daily_returns.std() * np.sqrt(TRADING_DAYS_PER_YEAR) * 100
+    stats['max_drawdown'] = (filled / filled.cummax() - 1).min() * 100
+    for window in moving_averages:
+        stats[f'ma_{window}'] = filled.rolling(window, min_periods=window).mean().iloc[-1]
+    
+    return stats
+
+class PerformanceEngine:
+    """ביצועי כל המניות שבקטלוג - מחושב פעם אחת ליום מסחר (או כשהקטלוג משתנה) ומשותף לכל הדפים"""
+    
+    def __init__(self, catalog):
+        self._catalog = catalog
+        self._key = None
+        self._stats = pd.DataFrame()
+        self._lock = threading.Lock()
+        self.computations = 0
+    
+    def stats(self, symbols=None):
+        """טבלת ביצועים לפי סימול (לכל הקטלוג, או רק למניות שביקשו)"""
+        series, version = self._catalog.series()
+        last_day = max((entry['dates'][-1] for entry in series.values()), default=None)
+        key = (version, last_day)
+        
+        with self._lock:
+            if key != self._key:
+                self._stats = compute_performance(price_panel(series))
+                self._key = key
+                self.computations += 1
+            stats = self._stats
+        
+        return stats if symbols is None else stats.reindex(list(symbols))
+
+@st.cache_resource
+def get_performance_engine():
+    return PerformanceEngine(get_instrument_catalog())
+
+# ============================================
+# עקומות שווי תיקים (משוחזרות מיומן העסקאות)
+# ============================================
+
+EQUITY_UPDATE_INTERVAL = 600    # שניות מינימום בין עדכונים של העקומות
+STARTING_CASH = 10000
+
+def apply_trade(state, trade):
+    """עדכון מזומן ואחזקות (symbol -> כמות) לפי עסקה אחת מהיומן"""
+    if trade['action'] == 'reset':
+        state['cash'] = STARTING_CASH
+        state['stocks'] = {}
+    elif trade['action'] == 'buy':
+        state['cash'] -= trade['total']
+        state['stocks'][trade['symbol']] = state['stocks'].get(trade['symbol'], 0) + trade['shares']
+    elif trade['action'] == 'sell':
+        state['cash'] += trade['total']
+        shares = state['stocks'].get(trade['symbol'], 0) - trade['shares']
+        if shares > 0:
+            state['stocks'][trade['symbol']] = shares
+        else:
+            state['stocks'].pop(trade['symbol'], None)
+
+class EquityCurves:
+    """שווי יומי (₪) של כל תיק, משוחזר מיומן העסקאות ומחירי הסגירה. כל עדכון קורא רק עסקאות חדשות
+    ומוסיף רק ימים חדשים; המצב נשמר בדיסק כך שאחרי הפעלה מחדש לא מחשבים מההתחלה"""
+    
+    def __init__(self, storage, history, path, update_interval=EQUITY_UPDATE_INTERVAL):
+        self._storage = storage
+        self._history = history
+        self._path = path
+        self.update_interval = update_interval
+        self._position = 0    # כמה מהיומן כבר נקרא
+        self._users = {}      # username -> {'cash', 'stocks', 'pending': [עסקאות], 'curve': [[תאריך, שווי], ...]}
+        self._lock = threading.Lock()
+        self.last_update = 0
+        self.last_error = None
+        self._load()
+    
+    def _load(self):
+        if not os.path.exists(self._path):
+            return
+        try:
+            with open(self._path, encoding='utf-8') as f:
+                data = json.load(f)
+            self._position = data['position']
+            self._users = data['users']
+        except (OSError, ValueError, KeyError) as e:
+            self.last_error = f"קובץ העקומות פגום, מחושב מחדש: {e}"
+    
+    def _save(self):
+        os.makedirs(os.path.dirname(self._path), exist_ok=True)
+        tmp_path = self._path + '.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump({'position': self._position, 'users': self._users}, f, ensure_ascii=False)
+        os.replace(tmp_path, self._path)
+    
+    def update(self, force=False):
+        """קריאת עסקאות חדשות מהיומן והוספת ימים שהסתיימו מאז העדכון הקודם"""
+        with self._lock:
+            if not force and time.time() - self.last_update < self.update_interval:
+                return False
+            
+            rows, self._position = self._storage.trades_after(self._position)
+            for row in rows:
+                user = self._users.setdefault(row[0], {'cash': STARTING_CASH, 'stocks': {}, 'pending': [], 'curve': []})
+                user['pending'].append(row_to_trade(row))
+            
+            # רק ימים שהסתיימו - את היום הנוכחי מוסיפים מחר, עם מחיר הסגירה הסופי
+            today = pd.Timestamp.now(MARKET_TIMEZONE).tz_localize(None).normalize()
+            starts = {}
+            for username, user in self._users.items():
+                if user['curve']:
+                    starts[username] = pd.Timestamp(user['curve'][-1][0]) + pd.Timedelta(days=1)
+                elif user['pending']:
+                    starts[username] = pd.Timestamp(user['pending'][0]['date'][:10])
+            starts = {u: day for u, day in starts.items() if day < today}
+            
+            if starts:
+                symbols = {s for u in starts for s in self._users[u]['stocks']}
+                symbols |= {t['symbol'] for u in starts for t in self._users[u]['pending'] if t.get('symbol')}
+                closes = self._history.closes(sorted(symbols) + [FX_SYMBOL], min(starts.values()))
+                closes = closes[closes.index < today].ffill()
+                if not closes.empty and closes[FX_SYMBOL].isna().all():
+                    raise RuntimeError("לא התקבלו מחירי סגירה מהספק")
+                
+                for username, start in starts.items():
+                    self._extend(self._users[username], closes[closes.index >= start])
+            
+            self.last_update = time.time()
+            self.last_error = None
+            self._save()
+            return True
+    
+    def _extend(self, user, closes):
+        """הוספת ימים לעקומה של משתמש אחד: מחילים את העסקאות עד סוף כל יום ומעריכים את התיק בסגירה"""
+        pending = user['pending']
+        state = {'cash': user['cash'], 'stocks': user['stocks']}
+        
+        for day, prices in closes.iterrows():
+            day_end = (day + pd.Timedelta(days=1)).strftime('%Y-%m-%d')
+            # 🛡️ עסקה שנרשמה ביומן באיחור (תאריך שכבר חושב) נכנסת ביום הבא
+            while pending and str(pending[0]['date'])[:10] < day_end:
+                apply_trade(state, pending.pop(0))
+            
+            fx = prices.get(FX_SYMBOL)
+            if pd.isna(fx):
+                continue
+            shares = pd.Series(state['stocks'], dtype=float)
+            stock_prices = prices.reindex(shares.index).fillna(0).to_numpy(dtype=float)
+            value = state['cash'] + float(shares.to_numpy() @ stock_prices) * float(fx)
+            user['curve'].append([day.strftime('%Y-%m-%d'), round(value, 2)])
+        
+        user['cash'], user['stocks'] = state['cash'], state['stocks']
+    
+    def curves(self, usernames=None):
+        """טבלת שווי: שורה לכל יום, עמודה לכל תלמיד"""
+        with self._lock:
+            users = self._users if usernames is None else {u: self._users[u] for u in usernames if u in self._users}
+            series = {
+                username: pd.Series(dict(user['curve']))
+                for username, user in users.items() if user['curve']
+            }
+        if not series:
+            return pd.DataFrame()
+        table = pd.DataFrame(series)
+        table.index = pd.to_datetime(table.index)
+        return table.sort_index()
+
+@st.cache_resource
+def get_equity_curves(class_id):
+    """עקומות השווי של כיתה - המצב נשמר ב-data/equity_curves.json (ולכל כיתה נוספת קובץ משלה)"""
+    return EquityCurves(get_storage(class_id), get_price_store(), shard_path(market_data_path('equity_curves.json'), class_id))
+
 # ============================================
 # פונקציות עזר
 # ============================================
@@ -46,60 +2614,52 @@ def init_session_state():
         st.session_state.logged_in = False
     if 'username' not in st.session_state:
         st.session_state.username = None
-    if 'portfolios' not in st.session_state:
-        st.session_state.portfolios = load_portfolios()
+    if 'seen_seq' not in st.session_state:
+        st.session_state.seen_seq = 0  # השינוי האחרון במאגר התיקים שהדף כבר מציג
+    if 'trade_quotes' not in st.session_state:
+        st.session_state.trade_quotes = {}  # symbol -> תמונת המחיר שמוצגת בפאנל הקנייה/מכירה
 
-def get_google_sheet():
-    """התחברות ל-Google Sheets"""
+def load_session_portfolios(username):
+    """טעינה לפי צורך: המורה מקבל תקציר של כל התיקים בכיתה שלו, תלמיד - רק את התיק שלו"""
+    router = get_class_router()
+    if router.is_teacher(username):
+        return load_portfolios(router.class_of(username))
+    
     try:
-        scope = ['https://spreadsheets.google.com/feeds',
-                 'https://www.googleapis.com/auth/drive']
-        creds_dict = dict(st.secrets["gcp_service_account"])
-        creds = Credentials.from_service_account_info(creds_dict, scopes=scope)
-        client = gspread.authorize(creds)
-        spreadsheet = client.open("בורסת הכיתה - נתונים")
-        sheet = spreadsheet.sheet1
-        return sheet
+        portfolio = store_for(username).get(username)
     except Exception as e:
-        st.error(f"שגיאה בהתחברות ל-Google Sheets: {e}")
-        return None
-
-def load_portfolios():
-    """טעינת נתוני תיקים מ-Google Sheets - עם הגנות חזקות"""
-    sheet = get_google_sheet()
+        st.error(f"🔴 **שגיאה קריטית בטעינת נתונים:** {e}")
+        st.info("נסה לרענן את הדף. אם הבעיה נמשכת, פנה למורה.")
+        st.stop()
     
-    # 🛡️ אם אין חיבור - עצור הכל
-    if not sheet:
-        st.error("🔴 **שגיאה קריטית:** לא ניתן להתחבר ל-Google Sheets!")
+    return {username: portfolio} if portfolio else {}
+
+def load_portfolios(class_id):
+    """כל התיקים (מזומן ואחזקות) של כיתה מהמאגר המשותף - נקרא מהאחסון רק בפעם הראשונה, עם הגנות חזקות"""
+    try:
+        store = get_portfolio_store(class_id)
+    except Exception as e:
+        # 🛡️ אם אין חיבור - עצור הכל
+        st.error(f"🔴 **שגיאה קריטית:** לא ניתן להתחבר לאחסון הנתונים! ({e})")
         st.info("נסה לרענן את הדף. אם הבעיה נמשכת, פנה למורה.")
         st.stop()
     
     try:
-        all_data = sheet.get_all_records()
-        
-        # 🛡️ אם הגיליון ריק - זו בעיה חמורה
-        if not all_data:
-            st.error("🔴 **שגיאה קריטית:** הגיליון ריק לגמרי!")
-            st.warning("ייתכן שיש בעיה בגיליון Google Sheets. פנה למורה.")
-            st.stop()
+        portfolios = store.all()
         
-        portfolios = {}
-        for row in all_data:
-            username = row.get('username')
-            if not username:
-                continue
+        # 🛡️ ההגנות חלות על הגיליון המקורי - כיתה חדשה שנוספה ב-Secrets מתחילה ריקה ומתמלאת כשהמורה יוצר תיקים
+        if class_id == DEFAULT_CLASS:
+            # 🛡️ אם הגיליון ריק - זו בעיה חמורה
+            if not portfolios:
+                st.error("🔴 **שגיאה קריטית:** הגיליון ריק לגמרי!")
+                st.warning("ייתכן שיש בעיה בנתונים. פנה למורה.")
+                st.stop()
             
-            portfolios[username] = {
-                'cash': float(row.get('cash', 10000)),
-                'stocks': json.loads(row.get('stocks', '{}')) if row.get('stocks') else {},
-                'history': json.loads(row.get('history', '[]')) if row.get('history') else []
-            }
-        
-        # 🛡️ בדיקת תקינות - חייב להיות לפחות 3 תיקים
-        if len(portfolios) < 3:
-            st.error(f"🔴 **שגיאה קריטית:** נטענו רק {len(portfolios)} תיקים!")
-            st.warning("זה לא נורמלי. ייתכן שיש בעיה בנתונים. פנה למורה.")
-            st.stop()
+            # 🛡️ בדיקת תקינות - חייב להיות לפחות 3 תיקים
+            if len(portfolios) < 3:
+                st.error(f"🔴 **שגיאה קריטית:** נטענו רק {len(portfolios)} תיקים!")
+                st.warning("זה לא נורמלי. ייתכן שיש בעיה בנתונים. פנה למורה.")
+                st.stop()
         
         # ✅ הכל תקין
         return portfolios
@@ -109,262 +2669,728 @@ def load_portfolios():
         st.info("נסה לרענן את הדף. אם הבעיה נמשכת, פנה למורה.")
         st.stop()
 
-def save_single_user(username):
-    """שמירת תיק של משתמש בודד - בטוח ומדויק!"""
-    sheet = get_google_sheet()
-    
-    # 🛡️ אם אין חיבור - לא שומרים
-    if not sheet:
-        st.error("🔴 לא ניתן לשמור - אין חיבור ל-Google Sheets")
-        return False
-    
+def save_portfolio(store, username, portfolio, version, trades=()):
+    """שמירת תיק ששונה (ועסקאות חדשות ליומן). מחזיר (הצלחה, הודעת שגיאה)"""
     try:
-        # וידוא שהמשתמש קיים ב-session
-        if username not in st.session_state.portfolios:
-            st.error(f"🔴 שגיאה: {username} לא קיים ב-session")
-            return False
-        
-        portfolio = st.session_state.portfolios[username]
-        
-        # קריאת כל הנתונים כדי למצוא את השורה
-        all_data = sheet.get_all_records()
-        row_number = None
-        
-        # חיפוש השורה של המשתמש
-        for idx, row in enumerate(all_data):
-            if row.get('username') == username:
-                row_number = idx + 2  # +2 כי: 1=header, 0-indexed
-                break
-        
-        # הכנת הנתונים
-        cash_value = portfolio['cash']
-        stocks_json = json.dumps(portfolio['stocks'], ensure_ascii=False)
-        history_json = json.dumps(portfolio['history'], ensure_ascii=False)
-        
-        if row_number:
-            # עדכון שורה קיימת
-            sheet.update_cell(row_number, 2, cash_value)
-            sheet.update_cell(row_number, 3, stocks_json)
-            sheet.update_cell(row_number, 4, history_json)
-        else:
-            # הוספת שורה חדשה
-            sheet.append_row([username, cash_value, stocks_json, history_json])
-        
-        return True
-        
+        store.commit(username, portfolio, version, trades)
+        return True, None
+    except ConflictError:
+        return False, "התיק עודכן בינתיים מחלון אחר - הפעולה לא בוצעה, נסה שוב"
     except Exception as e:
-        st.error(f"🔴 שגיאה בשמירת {username}: {e}")
-        return False
+        return False, f"🔴 שגיאה בשמירת {username}: {e}"
+
+def _fetch_usd_to_ils(prices):
+    """שער USD/ILS האחרון ממאגר המחירים היומיים - רשת רק אם המאגר לא טרי (None אם נכשל)"""
+    try:
+        closes = prices.closes([FX_SYMBOL], pd.Timestamp.now().normalize() - pd.Timedelta(days=7))[FX_SYMBOL].dropna()
+        return float(closes.iloc[-1]) if not closes.empty else None
+    except Exception:
+        return None
 
 def get_usd_to_ils():
-    """קבלת שער USD/ILS"""
+    """קבלת שער USD/ILS (מתמונת המחירים המשותפת, ואם אין - דרך הקאש)"""
+    quote = get_market_data().quotes([FX_SYMBOL]).get(FX_SYMBOL)
+    if quote is not None:
+        return quote['price']
+    prices = get_price_store()
+    rate = get_quote_cache().get(('fx', FX_SYMBOL), lambda: _fetch_usd_to_ils(prices))
+    return rate if rate is not None else 3.6
+
+def _quotes_from_store(prices, symbols):
+    """מחיר אחרון וסגירה קודמת מהנרות היומיים שבמאגר (בלי רשת אם המאגר טרי)"""
     try:
-        ticker = yf.Ticker("ILS=X")
-        hist = ticker.history(period='1d')
-        if not hist.empty:
-            return hist['Close'].iloc[-1]
-        return 3.6
-    except:
-        return 3.6
+        panel = prices.closes(symbols, pd.Timestamp.now().normalize() - pd.Timedelta(days=10))
+    except Exception:
+        return {}
+    
+    quotes = {}
+    for symbol in panel:
+        series = panel[symbol].dropna()
+        if series.empty:
+            continue
+        price = float(series.iloc[-1])
+        prev_close = float(series.iloc[-2]) if len(series) >= 2 else price
+        quotes[symbol] = {'price': price, 'prev_close': prev_close}
+    return quotes
+
+def get_prices(symbols):
+    """מחיר נוכחי וסגירה קודמת (USD) לרשימת מניות - DataFrame לפי סימול.
+    המחירים מגיעים מתמונת הרענון ברקע; מה שחסר בה נלקח ממאגר המחירים היומיים (שמושך רק את הזנב החסר)"""
+    symbols = list(dict.fromkeys(symbols))
+    market_data = get_market_data()
+    quotes = market_data.quotes(symbols)
+    
+    missing = [s for s in symbols if s not in quotes]
+    if missing:
+        market_data.track(missing)
+        
+        price_store = get_price_store()
+        
+        def fetch_missing(keys):
+            fetched = _quotes_from_store(price_store, [key[1] for key in keys])
+            return {('quote', symbol): quote for symbol, quote in fetched.items()}
+        
+        cached = get_quote_cache().get_many([('quote', s) for s in missing], fetch_missing)
+        quotes.update({key[1]: quote for key, quote in cached.items()})
+    
+    prices = pd.DataFrame.from_dict(quotes, orient='index', columns=['price', 'prev_close'])
+    return prices.reindex(symbols)
 
 def get_stock_price(symbol):
-    """משיכת מחיר מניה"""
-    try:
-        stock = yf.Ticker(symbol)
-        hist = stock.history(period='1d')
-        if not hist.empty:
-            return hist['Close'].iloc[-1]
+    """משיכת מחיר מניה (דרך הקאש המשותף)"""
+    price = get_prices([symbol]).at[symbol, 'price']
+    return None if pd.isna(price) else price
+
+QUOTE_MAX_AGE = 60   # שניות שבהן תמונת מחיר שהוצגה עדיין טובה לביצוע (Secrets: [trading] quote_max_age)
+
+def get_quote(symbol):
+    """תמונת מחיר לעסקה: מחיר (USD), שער דולר-שקל וזמן - נלקחת פעם אחת ומשמשת גם לתצוגה וגם לביצוע (None אם אין מחיר)"""
+    if get_instrument_catalog().lookup(symbol) is None:
         return None
-    except:
+    prices = get_prices([symbol, FX_SYMBOL])
+    price = prices.at[symbol, 'price']
+    if pd.isna(price):
         return None
+    usd_to_ils = prices.at[FX_SYMBOL, 'price']
+    return {
+        'symbol': symbol,
+        'price': float(price),
+        'usd_to_ils': float(usd_to_ils) if pd.notna(usd_to_ils) else get_usd_to_ils(),
+        'time': time.time()
+    }
 
-def get_stock_info(symbol):
-    """משיכת מידע על מניה"""
-    try:
-        stock = yf.Ticker(symbol)
-        info = stock.info
-        return {
-            'name': info.get('longName', symbol),
-            'price': get_stock_price(symbol),
-            'currency': info.get('currency', 'USD')
-        }
-    except:
-        return None
+def quote_is_stale(quote):
+    return time.time() - quote['time'] > get_setting('trading', 'quote_max_age', QUOTE_MAX_AGE)
+
+def trade_quote(symbol):
+    """תמונת המחיר שמוצגת למשתמש - נשמרת ב-session עד שהיא מתיישנת, כך שהעסקה מתבצעת בדיוק במחיר שהוצג"""
+    quote = st.session_state.trade_quotes.get(symbol)
+    if quote is None or quote_is_stale(quote):
+        quote = get_quote(symbol)
+        st.session_state.trade_quotes[symbol] = quote
+    return quote
+
+def live_performance(symbols):
+    """ביצועי המניות ממנוע הביצועים, כשהמחיר האחרון והשינוי היומי מחושבים מהמחיר החי (price מול prev_close)
+    ולא ממחירי הסגירה בקטלוג, שמתעדכנים רק כל כמה דקות"""
+    symbols = list(symbols)
+    stats = get_performance_engine().stats(symbols).copy()
+    prices = get_prices(symbols)
+    live = prices['price'].notna() & (prices['prev_close'] > 0)
+    stats.loc[live, 'last_price'] = prices.loc[live, 'price']
+    stats.loc[live, 'daily_change'] = ((prices['price'] - prices['prev_close']) / prices['prev_close'] * 100)[live]
+    return stats
 
 def get_stock_performance(symbol):
-    """קבלת ביצועים היסטוריים"""
-    try:
-        stock = yf.Ticker(symbol)
-        hist = stock.history(period='1mo')
-        if hist.empty:
-            return None
-        
-        current_price = hist['Close'].iloc[-1]
-        perf = {}
-        
-        if len(hist) >= 2:
-            perf['daily_change'] = ((current_price - hist['Close'].iloc[-2]) / hist['Close'].iloc[-2]) * 100
-        if len(hist) >= 5:
-            perf['weekly_change'] = ((current_price - hist['Close'].iloc[-5]) / hist['Close'].iloc[-5]) * 100
-        if len(hist) >= 20:
-            perf['monthly_change'] = ((current_price - hist['Close'].iloc[0]) / hist['Close'].iloc[0]) * 100
-        
-        return perf
-    except:
+    """ביצועים היסטוריים של מניה (תשואות, תנודתיות, ירידה מקסימלית, ממוצעים נעים) ממנוע הביצועים"""
+    if get_instrument_catalog().lookup(symbol) is None:
         return None
+    
+    row = live_performance([symbol]).iloc[0]
+    perf = row.dropna().to_dict()
+    return perf or None
 
 def get_stock_description(symbol):
     """תיאור המניה בעברית"""
-    descriptions = {
-        'SPY': '📊 מניית סל העוקבת אחר מדד S&P 500 - 500 החברות הגדולות בארה"ב מכל התחומים.',
-        'QQQ': '📊 מניית סל העוקבת אחר מדד NASDAQ 100 - 100 חברות הטכנולוגיה המובילות (אפל, מיקרוסופט, גוגל ועוד).',
-        'VTI': '📊 מניית סל של Vanguard - כמעט כל השוק האמריקאי (כ-4,000 מניות!).',
-        'VXUS': '📊 מניית סל של Vanguard - חברות מכל העולם מחוץ לארה"ב (אירופה, אסיה, שווקים מתעוררים).',
-        'VOO': '📊 מניית סל של Vanguard - עוקבת אחר S&P 500, דומה ל-SPY עם עמלות נמוכות יותר.',
-        'AAPL': '🍎 אפל - מייצרת iPhone, iPad, Mac ועוד. אחת החברות הגדולות בעולם.',
-        'MSFT': '💻 מיקרוסופט - Windows, Office, Xbox, Azure ועוד. ענקית התוכנה.',
-        'GOOGL': '🔍 גוגל (אלפבית) - מנוע החיפוש, YouTube, Android, Gmail ועוד.',
-        'META': '📱 מטא (פייסבוק לשעבר) - פייסבוק, אינסטגרם, ווטסאפ.',
-        'NVDA': '🎮 אנבידיה - כרטיסי מסך, בינוי מלאכותית, מחשוב על.',
-        'AMZN': '🌐 אמזון - קניות אונליין, AWS (שירותי ענן), פריים.',
-        'NFLX': '🎬 נטפליקס - שירות סטרימינג לסרטים וסדרות.',
-        'INTC': '💾 אינטל - מעבדים ושבבים למחשבים.',
-        'AMD': '🖥️ AMD - מעבדים וכרטיסי מסך, מתחרה של אינטל ואנבידיה.',
-        'IBM': '💻 IBM - חברת טכנולוגיה ותוכנה ותיקה, מחשוב ענן ובינה מלאכותית.',
-        'ORCL': '☁️ אורקל - מסדי נתונים, תוכנה עסקית, שירותי ענן.',
-        'TSLA': '🚗 טסלה - מכוניות חשמליות, סולאריות, סוללות.',
-        'F': '🚙 פורד - אחת מיצרניות הרכב הותיקות בארה"ב.',
-        'GM': '🏭 ג\'נרל מוטורס - יצרנית רכב אמריקאית גדולה (שברולט, קדילאק).',
-        'BA': '✈️ בואינג - מטוסי נוסעים ומטוסי קרב.',
-        'KO': '🥤 קוקה קולה - משקאות קלים בעולם כולו.',
-        'MCD': '🍔 מקדונלד\'ס - רשת מזון מהיר עולמית.',
-        'SBUX': '☕ סטארבקס - רשת בתי קפה עולמית.',
-        'WMT': '🛒 וולמארט - רשת סופרמרקטים ענקית בארה"ב.',
-        'TGT': '🎯 טארגט - רשת חנויות כלבו אמריקאית.',
-        'NKE': '👟 נייקי - ביגוד וציוד ספורט.',
-        'DIS': '🏰 דיסני - סרטים, פארקי שעשועים, ערוצי טלוויזיה.',
-        'V': '💳 ויזה - כרטיסי אשראי בעולם כולו.',
-        'MA': '💳 מאסטרקארד - כרטיסי אשראי, מתחרה של ויזה.',
-        'PYPL': '💰 פייפאל - תשלומים דיגיטליים.',
-        'TEVA': '💊 טבע - תרופות גנריות, אחת החברות הגדולות בישראל.',
-        'CHKP': '🔒 צ\'ק פוינט - אבטחת סייבר, חברה ישראלית.',
-        'WIX': '🌐 וויקס - בניית אתרים, חברה ישראלית.',
-        'NICE': '📞 נייס - תוכנה לניתוח שיחות ונתונים, חברה ישראלית.',
-        'MNDY': '📋 מאנדיי - ניהול פרויקטים ומשימות, חברה ישראלית.'
+    return STOCK_DESCRIPTIONS.get(symbol, None)
+
+def value_portfolio(portfolio, usd_to_ils):
+    """שווי תיק (₪), רווח/הפסד ושינוי יומי - כל המחירים של התיק בקריאה אחת"""
+    stocks_value = 0
+    stocks_value_yesterday = 0
+    
+    prices = get_prices(portfolio['stocks'].keys())
+    
+    for symbol, data in portfolio['stocks'].items():
+        current_price_usd = prices.at[symbol, 'price']
+        if pd.notna(current_price_usd):
+            current_price_ils = current_price_usd * usd_to_ils
+            stocks_value += current_price_ils * data['shares']
+            
+            yesterday_price_ils = prices.at[symbol, 'prev_close'] * usd_to_ils
+            stocks_value_yesterday += yesterday_price_ils * data['shares']
+    
+    total_value = portfolio['cash'] + stocks_value
+    total_value_yesterday = portfolio['cash'] + stocks_value_yesterday
+    
+    profit_loss = total_value - 10000
+    daily_change = total_value - total_value_yesterday
+    
+    return {
+        'prices': prices,
+        'stocks_value': stocks_value,
+        'total_value': total_value,
+        'profit_loss': profit_loss,
+        'profit_loss_percent': (profit_loss / 10000) * 100,
+        'daily_change': daily_change,
+        'daily_change_percent': (daily_change / total_value_yesterday) * 100 if total_value_yesterday > 0 else 0
     }
-    return descriptions.get(symbol, None)
+
+def compute_class_leaderboard(portfolios, usd_to_ils, trade_counts):
+    """שווי כל תיקי הכיתה בפעולה וקטורית אחת: מטריצת אחזקות (תלמידים × מניות) כפול וקטור מחירים"""
+    students = list(portfolios.keys())
+    symbols = sorted({symbol for p in portfolios.values() for symbol in p['stocks']})
+    symbol_index = {symbol: i for i, symbol in enumerate(symbols)}
+    
+    # בניית מטריצת האחזקות (רוב התאים אפס)
+    rows, cols, shares = [], [], []
+    for i, p in enumerate(portfolios.values()):
+        for symbol, data in p['stocks'].items():
+            rows.append(i)
+            cols.append(symbol_index[symbol])
+            shares.append(data['shares'])
+    holdings = np.zeros((len(students), len(symbols)))
+    holdings[rows, cols] = shares
+    
+    # כל המחירים בקריאה אחת - מניה בלי מחיר נספרת כ-0
+    prices_ils = get_prices(symbols)['price'].fillna(0).to_numpy(dtype=float) * usd_to_ils
+    
+    cash = np.fromiter((p['cash'] for p in portfolios.values()), dtype=float, count=len(students))
+    stocks_value = holdings @ prices_ils
+    total_value = cash + stocks_value
+    
+    board = pd.DataFrame({
+        'cash': cash,
+        'stocks_value': stocks_value,
+        'total_value': total_value,
+        'profit': total_value - 10000,
+        'trades': [trade_counts.get(student, 0) for student in students],
+        'holdings': np.count_nonzero(holdings, axis=1)
+    }, index=pd.Index(students, name='student'))
+    board['rank'] = board['total_value'].rank(ascending=False, method='min').astype(int)
+    return board.sort_values('rank')
+
+def compute_school_leaderboard(usd_to_ils):
+    """טבלה משותפת לכל הכיתות: כל כיתה נטענת מהאחסון שלה במקביל, והשווי מחושב בפעולה וקטורית אחת לכולם"""
+    router = get_class_router()
+    class_ids = router.classes()
+    # המשאבים נוצרים כאן (בתהליכון של Streamlit) - התהליכונים המקבילים רק קוראים מהאחסון
+    shards = {class_id: (get_portfolio_store(class_id), get_storage(class_id)) for class_id in class_ids}
+    
+    def load_shard(class_id):
+        store, storage = shards[class_id]
+        return store.all(), storage.trade_counts()
+    
+    with ThreadPoolExecutor(max_workers=max(1, min(len(class_ids), LEADERBOARD_WORKERS))) as pool:
+        loaded = dict(zip(class_ids, pool.map(load_shard, class_ids)))
+    
+    portfolios, trade_counts, classes = {}, {}, {}
+    for class_id, (class_portfolios, class_trade_counts) in loaded.items():
+        for student, portfolio in class_portfolios.items():
+            if router.is_teacher(student):
+                continue
+            portfolios[student] = portfolio
+            trade_counts[student] = class_trade_counts.get(student, 0)
+            classes[student] = router.name(class_id)
+    
+    board = compute_class_leaderboard(portfolios, usd_to_ils, trade_counts)
+    board['class'] = board.index.map(classes)
+    return board
 
 def calculate_commission(amount):
     """חישוב עמלה: 0.1% עם מינימום 5 ₪"""
     commission = amount * 0.001
     return max(commission, 5)
 
-def buy_stock(username, symbol, shares):
-    """קניית מניה"""
-    info = get_stock_info(symbol)
-    if not info or info['price'] is None:
-        return False, "לא נמצא סימול מניה תקין"
+def buy_stock(username, symbol, shares, quote=None):
+    """קניית מניה - במחיר של quote (תמונת המחיר שהוצגה למשתמש), או בתמונה חדשה אם לא ניתנה"""
+    if quote is None:
+        quote = get_quote(symbol)
+        if quote is None:
+            return False, "לא נמצא סימול מניה תקין"
+    elif quote['symbol'] != symbol or quote_is_stale(quote):
+        return False, "⏱️ המחיר התעדכן - בדוק את המחיר החדש ונסה שוב"
     
-    price_usd = info['price']
-    usd_to_ils = get_usd_to_ils()
+    return fill_buy(store_for(username), username, symbol, shares, quote['price'], quote['usd_to_ils'])
+
+def fill_buy(store, username, symbol, shares, price_usd, usd_to_ils):
+    """ביצוע קנייה במחיר נתון (עם עמלה) - משותף לעסקה מיידית ולפקודה ממתינה שהופעלה. מחזיר (הצלחה, הודעה)"""
     price_ils = price_usd * usd_to_ils
-    
     total_cost = price_ils * shares
     commission = calculate_commission(total_cost)
     total_with_commission = total_cost + commission
     
-    portfolio = st.session_state.portfolios[username]
-    
-    if portfolio['cash'] < total_with_commission:
-        return False, f"אין מספיק כסף. צריך: ₪{total_with_commission:.2f}, יש: ₪{portfolio['cash']:.2f}"
-    
-    portfolio['cash'] -= total_with_commission
-    
-    if symbol in portfolio['stocks']:
-        old_shares = portfolio['stocks'][symbol]['shares']
-        old_avg = portfolio['stocks'][symbol]['avg_price']
-        new_avg = (old_shares * old_avg + shares * price_ils) / (old_shares + shares)
-        portfolio['stocks'][symbol]['shares'] += shares
-        portfolio['stocks'][symbol]['avg_price'] = new_avg
-    else:
-        portfolio['stocks'][symbol] = {
+    with store.lock(username):
+        portfolio, version = store.checkout(username)
+        if portfolio is None:
+            return False, "אין תיק למשתמש זה"
+        
+        if portfolio['cash'] < total_with_commission:
+            return False, f"אין מספיק כסף. צריך: ₪{total_with_commission:.2f}, יש: ₪{portfolio['cash']:.2f}"
+        
+        portfolio['cash'] -= total_with_commission
+        
+        if symbol in portfolio['stocks']:
+            old_shares = portfolio['stocks'][symbol]['shares']
+            old_avg = portfolio['stocks'][symbol]['avg_price']
+            new_avg = (old_shares * old_avg + shares * price_ils) / (old_shares + shares)
+            portfolio['stocks'][symbol]['shares'] += shares
+            portfolio['stocks'][symbol]['avg_price'] = new_avg
+        else:
+            portfolio['stocks'][symbol] = {
+                'shares': shares,
+                'avg_price': price_ils
+            }
+        
+        trade = {
+            'date': datetime.now().isoformat(),
+            'action': 'buy',
+            'symbol': symbol,
             'shares': shares,
-            'avg_price': price_ils
+            'price': price_ils,
+            'commission': commission,
+            'total': total_with_commission
         }
+        
+        saved, error = save_portfolio(store, username, portfolio, version, trades=[trade])
     
-    portfolio['history'].append({
-        'date': datetime.now().isoformat(),
-        'action': 'buy',
-        'symbol': symbol,
-        'shares': shares,
-        'price': price_ils,
-        'commission': commission,
-        'total': total_with_commission
-    })
-    
-    save_single_user(username)
+    if not saved:
+        return False, error
     return True, f"קנית {shares} מניות של {symbol} ב-${price_usd:.2f} (₪{price_ils:.2f}) | עמלה: ₪{commission:.2f}"
 
-def sell_stock(username, symbol, shares):
-    """מכירת מניה"""
-    portfolio = st.session_state.portfolios[username]
-    
-    if symbol not in portfolio['stocks']:
+def sell_stock(username, symbol, shares, quote=None):
+    """מכירת מניה - במחיר של quote (תמונת המחיר שהוצגה למשתמש), או בתמונה חדשה אם לא ניתנה"""
+    store = store_for(username)
+    holding = (store.get(username) or {}).get('stocks', {}).get(symbol)
+    if not holding:
         return False, "אין לך מניות מסוג זה"
+    if holding['shares'] < shares:
+        return False, f"אין לך מספיק מניות. יש לך: {holding['shares']}"
     
-    if portfolio['stocks'][symbol]['shares'] < shares:
-        return False, f"אין לך מספיק מניות. יש לך: {portfolio['stocks'][symbol]['shares']}"
+    if quote is None:
+        quote = get_quote(symbol)
+        if quote is None:
+            return False, "שגיאה במשיכת מחיר"
+    elif quote['symbol'] != symbol or quote_is_stale(quote):
+        return False, "⏱️ המחיר התעדכן - בדוק את המחיר החדש ונסה שוב"
     
-    price_usd = get_stock_price(symbol)
-    if price_usd is None:
-        return False, "שגיאה במשיכת מחיר"
-    
-    usd_to_ils = get_usd_to_ils()
+    return fill_sell(store, username, symbol, shares, quote['price'], quote['usd_to_ils'])
+
+def fill_sell(store, username, symbol, shares, price_usd, usd_to_ils):
+    """ביצוע מכירה במחיר נתון (עם עמלה) - משותף לעסקה מיידית ולפקודה ממתינה שהופעלה. מחזיר (הצלחה, הודעה)"""
     price_ils = price_usd * usd_to_ils
     
-    total_value = price_ils * shares
-    commission = calculate_commission(total_value)
-    total_after_commission = total_value - commission
-    
-    portfolio['cash'] += total_after_commission
-    portfolio['stocks'][symbol]['shares'] -= shares
-    
-    if portfolio['stocks'][symbol]['shares'] == 0:
-        del portfolio['stocks'][symbol]
-    
-    portfolio['history'].append({
-        'date': datetime.now().isoformat(),
-        'action': 'sell',
-        'symbol': symbol,
-        'shares': shares,
-        'price': price_ils,
-        'commission': commission,
-        'total': total_after_commission
-    })
+    with store.lock(username):
+        portfolio, version = store.checkout(username)
+        if portfolio is None:
+            return False, "אין תיק למשתמש זה"
+        
+        if symbol not in portfolio['stocks']:
+            return False, "אין לך מניות מסוג זה"
+        
+        if portfolio['stocks'][symbol]['shares'] < shares:
+            return False, f"אין לך מספיק מניות. יש לך: {portfolio['stocks'][symbol]['shares']}"
+        
+        total_value = price_ils * shares
+        commission = calculate_commission(total_value)
+        total_after_commission = total_value - commission
+        
+        portfolio['cash'] += total_after_commission
+        portfolio['stocks'][symbol]['shares'] -= shares
+        
+        if portfolio['stocks'][symbol]['shares'] == 0:
+            del portfolio['stocks'][symbol]
+        
+        trade = {
+            'date': datetime.now().isoformat(),
+            'action': 'sell',
+            'symbol': symbol,
+            'shares': shares,
+            'price': price_ils,
+            'commission': commission,
+            'total': total_after_commission
+        }
+        
+        saved, error = save_portfolio(store, username, portfolio, version, trades=[trade])
     
-    save_single_user(username)
+    if not saved:
+        return False, error
     return True, f"מכרת {shares} מניות של {symbol} ב-${price_usd:.2f} (₪{price_ils:.2f}) | עמלה: ₪{commission:.2f}"
 
 def create_portfolio(username):
     """יצירת תיק חדש למשתמש"""
-    st.session_state.portfolios[username] = {
-        'cash': 10000,
-        'stocks': {},
-        'history': []
-    }
-    save_single_user(username)
+    store = store_for(username)
+    with store.lock(username):
+        saved, _ = save_portfolio(store, username, {'cash': 10000, 'stocks': {}}, store.version(username))
+    return saved
 
 def reset_portfolio(username):
     """איפוס תיק"""
-    if username in st.session_state.portfolios:
-        st.session_state.portfolios[username] = {
-            'cash': 10000,
-            'stocks': {},
-            'history': []
+    store = store_for(username)
+    with store.lock(username):
+        if store.get(username) is None:
+            return False
+        # היומן הוא append-only - האיפוס נרשם כשורה, וההיסטוריה נספרת מחדש ממנה
+        saved, _ = save_portfolio(store, username, {'cash': 10000, 'stocks': {}}, store.version(username),
+                                  trades=[{'date': datetime.now().isoformat(), 'action': 'reset'}])
+        if saved:
+            # פקודות ממתינות מלפני האיפוס לא יתבצעו מול הכסף החדש
+            order_book_for(username).cancel_all(username)
+    return saved
+
+def _bulk_update(class_id, usernames, build, progress=None):
+    """בניית השינויים לכל המשתמשים בזיכרון ושמירתם ב-commit_many אחד. build(store, username) מחזיר
+    (תיק, עסקאות) או None לדילוג. progress(ערך, טקסט) - לסרגל התקדמות. מחזיר (מספר תיקים, הודעת שגיאה)"""
+    store = get_portfolio_store(class_id)
+    usernames = list(usernames)
+    changes = {}
+    for i, username in enumerate(usernames, 1):
+        change = build(store, username)
+        if change is not None:
+            portfolio, trades = change
+            changes[username] = (portfolio, store.version(username), trades)
+        if progress:
+            progress(0.5 * i / len(usernames), f"מכין {i}/{len(usernames)}...")
+    if not changes:
+        return 0, None
+    
+    if progress:
+        progress(0.5, f"שומר {len(changes)} תיקים בכתיבה אחת...")
+    try:
+        store.commit_many(changes)
+    except ConflictError as e:
+        return 0, f"התיק של {e} עודכן בינתיים - אף תיק לא שונה, נסה שוב"
+    except Exception as e:
+        return 0, f"🔴 השמירה נכשלה - אף תיק לא שונה: {e}"
+    if progress:
+        progress(1.0, f"נשמרו {len(changes)} תיקים")
+    return len(changes), None
+
+def create_portfolios(class_id, usernames, progress=None):
+    """יצירת תיקים חדשים לכמה תלמידים בכתיבה אחת (מי שכבר יש לו תיק - מדולג)"""
+    def build(store, username):
+        if store.get(username) is not None:
+            return None
+        return {'cash': 10000, 'stocks': {}}, []
+    return _bulk_update(class_id, usernames, build, progress)
+
+def reset_portfolios(class_id, usernames, progress=None):
+    """איפוס של כמה תיקים בשמירה אחת - כולם או אף אחד בזיכרון ובאחסון (ב-Sheets: ביומן המקומי, והגיליון מתעדכן ברקע)"""
+    date = datetime.now().isoformat()
+    def build(store, username):
+        if store.get(username) is None:
+            return None
+        return {'cash': 10000, 'stocks': {}}, [{'date': date, 'action': 'reset'}]
+    count, error = _bulk_update(class_id, usernames, build, progress)
+    if not error:
+        book = get_order_matcher(class_id).book
+        for username in usernames:
+            book.cancel_all(username)
+    return count, error
+
+# ============================================
+# פקודות ממתינות (לימיט/סטופ) ומנוע התאמה ברקע
+# ============================================
+
+# ברירות מחדל - ניתן לשנות ב-Secrets תחת [orders]
+ORDER_MATCH_INTERVAL = 2.0    # כל כמה שניות המנוע בודק אם יש מחירים חדשים
+ORDER_MAX_OPEN = 50           # פקודות פתוחות מקסימום לתלמיד
+ORDER_HISTORY_SIZE = 20       # פקודות שנסגרו שנשמרות לכל תלמיד (להצגה)
+ORDER_TYPES = {"שוק": None, "לימיט": 'limit', "סטופ": 'stop'}
+
+class OrderBook:
+    """ספר פקודות ממתינות לפי מניה. לכל מניה שתי רשימות ממוינות לפי מחיר ההפעלה, כך שבכל עדכון מחיר
+    נבדקות רק הפקודות שהמחיר חצה (חיפוש בינארי) ולא כל הפקודות הפתוחות.
+    כל שינוי נרשם כשורה ביומן בדיסק (JSONL), והיומן נכתב מחדש בקטן כשהוא גדל"""
+    
+    def __init__(self, path, history_size=ORDER_HISTORY_SIZE):
+        self._path = path
+        self._history_size = history_size
+        self._orders = {}     # id -> פקודה פתוחה
+        self._below = {}      # symbol -> [(trigger, id)] - מופעלות כשהמחיר <= trigger (קניית לימיט, מכירת סטופ)
+        self._above = {}      # symbol -> [(trigger, id)] - מופעלות כשהמחיר >= trigger (מכירת לימיט, קניית סטופ)
+        self._closed = {}     # username -> deque של פקודות שנסגרו (החדשה ראשונה)
+        self._next_id = 1
+        self._journal_lines = 0
+        self._lock = threading.Lock()
+        self.version = 0
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        self._replay()
+    
+    def _replay(self):
+        """בניית הספר מהיומן בדיסק"""
+        if not os.path.exists(self._path):
+            return
+        with open(self._path, encoding='utf-8') as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    continue  # שורה חלקית מקריסה באמצע כתיבה
+                self._apply(entry)
+                self._journal_lines += 1
+    
+    def _apply(self, entry):
+        if 'place' in entry:
+            order = entry['place']
+            self._orders[order['id']] = order
+            self._index(order)
+            self._next_id = max(self._next_id, order['id'] + 1)
+        elif 'take' in entry:
+            for order_id in entry['take']:
+                order = self._orders.pop(order_id, None)
+                if order is not None:
+                    self._unindex(order)
+        elif 'close' in entry:
+            closed = entry['close']
+            order = self._orders.pop(closed['id'], None)
+            if order is not None:
+                self._unindex(order)
+            self._remember(closed)
+            self._next_id = max(self._next_id, closed['id'] + 1)
+    
+    def _write(self, entries, durable=False):
+        """הוספת שורות ליומן (נקרא תחת self._lock). durable - גם fsync, לפני ביצוע של פקודות"""
+        with open(self._path, 'a', encoding='utf-8') as f:
+            for entry in entries:
+                f.write(json.dumps(entry, ensure_ascii=False) + '\n')
+            if durable:
+                f.flush()
+                os.fsync(f.fileno())
+        self._journal_lines += len(entries)
+        live = len(self._orders) + sum(len(orders) for orders in self._closed.values())
+        if self._journal_lines > max(1000, 4 * live):
+            self._compact()
+    
+    def _compact(self):
+        """כתיבת היומן מחדש כך שיכיל רק את הפקודות הפתוחות וההיסטוריה השמורה"""
+        entries = [{'close': closed} for orders in self._closed.values() for closed in reversed(orders)]
+        entries += [{'place': order} for order in self._orders.values()]
+        tmp_path = self._path + '.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            for entry in entries:
+                f.write(json.dumps(entry, ensure_ascii=False) + '\n')
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self._path)
+        self._journal_lines = len(entries)
+    
+    def _book(self, order):
+        # קניית לימיט ומכירת סטופ מופעלות בירידה, מכירת לימיט וקניית סטופ - בעלייה
+        below = (order['side'] == 'buy') == (order['type'] == 'limit')
+        return (self._below if below else self._above).setdefault(order['symbol'], [])
+    
+    def _index(self, order):
+        bisect.insort(self._book(order), (order['trigger'], order['id']))
+    
+    def _unindex(self, order):
+        entries = self._book(order)
+        key = (order['trigger'], order['id'])
+        i = bisect.bisect_left(entries, key)
+        if i < len(entries) and entries[i] == key:
+            del entries[i]
+    
+    def _remember(self, closed):
+        if closed['username'] not in self._closed:
+            self._closed[closed['username']] = deque(maxlen=self._history_size)
+        self._closed[closed['username']].appendleft(closed)
+    
+    def _close(self, order, status, message, price=None):
+        closed = dict(order, status=status, message=message, price=price,
+                      closed=datetime.now().isoformat(timespec='seconds'))
+        self._remember(closed)
+        return {'close': closed}
+    
+    def place(self, username, symbol, side, order_type, trigger, shares, max_open=None):
+        """רישום פקודה חדשה - מחזיר עותק שלה, או None אם כבר יש למשתמש max_open פקודות פתוחות"""
+        with self._lock:
+            # 🛡️ הבדיקה תחת הנעילה - שתי פקודות במקביל לא יכולות לעבור יחד את המכסה
+            if max_open is not None and sum(1 for order in self._orders.values() if order['username'] == username) >= max_open:
+                return None
+            order = {
+                'id': self._next_id,
+                'username': username,
+                'symbol': symbol,
+                'side': side,
+                'type': order_type,
+                'trigger': float(trigger),
+                'shares': int(shares),
+                'created': datetime.now().isoformat(timespec='seconds')
+            }
+            self._next_id += 1
+            self._orders[order['id']] = order
+            self._index(order)
+            self.version += 1
+            self._write([{'place': order}])
+            return dict(order)
+    
+    def cancel(self, username, order_id):
+        """ביטול פקודה פתוחה של המשתמש - False אם כבר לא פתוחה"""
+        with self._lock:
+            order = self._orders.get(order_id)
+            if order is None or order['username'] != username:
+                return False
+            del self._orders[order_id]
+            self._unindex(order)
+            self.version += 1
+            self._write([self._close(order, 'cancelled', "בוטלה")])
+            return True
+    
+    def cancel_all(self, username):
+        """ביטול כל הפקודות הפתוחות של משתמש (באיפוס תיק) - מחזיר כמה בוטלו"""
+        with self._lock:
+            orders = [order for order in self._orders.values() if order['username'] == username]
+            if not orders:
+                return 0
+            for order in orders:
+                del self._orders[order['id']]
+                self._unindex(order)
+            self.version += 1
+            self._write([self._close(order, 'cancelled', "בוטלה באיפוס התיק") for order in orders])
+            return len(orders)
+    
+    def crossing(self, prices):
+        """הפקודות שהמחיר הנוכחי (symbol -> price) חצה - יוצאות מהספר ומוחזרות לביצוע"""
+        with self._lock:
+            triggered = []
+            for symbol, price in prices.items():
+                below = self._below.get(symbol)
+                if below:
+                    i = bisect.bisect_left(below, (price,))
+                    triggered.extend(order_id for _, order_id in below[i:])
+                    del below[i:]
+                above = self._above.get(symbol)
+                if above:
+                    i = bisect.bisect_right(above, (price, float('inf')))
+                    triggered.extend(order_id for _, order_id in above[:i])
+                    del above[:i]
+            if not triggered:
+                return []
+            orders = [self._orders.pop(order_id) for order_id in triggered]
+            self.version += 1
+            # 🛡️ נרשם בדיסק עוד לפני הביצוע - קריסה באמצע מאבדת את הפקודה אבל אף פעם לא מבצעת אותה פעמיים
+            self._write([{'take': triggered}], durable=True)
+            return orders
+    
+    def settle(self, results):
+        """רישום תוצאות הביצוע: רשימת (פקודה, סטטוס, הודעה, מחיר)"""
+        if not results:
+            return
+        with self._lock:
+            self._write([self._close(order, status, message, price) for order, status, message, price in results])
+    
+    def open_orders(self, username=None):
+        with self._lock:
+            return [dict(order) for order in self._orders.values() if username is None or order['username'] == username]
+    
+    def closed_orders(self, username):
+        with self._lock:
+            return list(self._closed.get(username, []))
+    
+    def symbols(self):
+        """המניות שיש עליהן פקודות פתוחות"""
+        with self._lock:
+            return {order['symbol'] for order in self._orders.values()}
+
+class OrderMatcher:
+    """תהליכון רקע שמתאים את הפקודות הממתינות מול תמונת המחירים העדכנית, ומבצע אותן
+    דרך fill_buy/fill_sell - אותה לוגיקה ועמלה של עסקה רגילה, במחיר השוק ברגע ההפעלה"""
+    
+    def __init__(self, book, store, market_data, interval):
+        self.book = book
+        self._store = store
+        self._market_data = market_data
+        self.interval = interval
+        self.ticks = 0
+        self.fills = 0
+        self.rejections = 0
+        self.last_tick_duration = 0.0
+        self.last_error = None
+        self._thread = threading.Thread(target=self._run, name="order-matcher", daemon=True)
+        self._thread.start()
+    
+    def tick(self):
+        """בדיקה אחת של כל הספר מול המחירים הנוכחיים - מחזיר כמה פקודות הופעלו"""
+        symbols = self.book.symbols()
+        if not symbols:
+            return 0
+        started = time.perf_counter()
+        quotes = self._market_data.quotes(sorted(symbols) + [FX_SYMBOL])
+        fx = quotes.pop(FX_SYMBOL, None)
+        if fx is None:
+            return 0   # בלי שער דולר אי אפשר לתמחר בשקלים - מחכים לרענון הבא
+        prices = {symbol: quote['price'] for symbol, quote in quotes.items()}
+        
+        results = []
+        for order in self.book.crossing(prices):
+            price = prices[order['symbol']]
+            fill = fill_buy if order['side'] == 'buy' else fill_sell
+            success, message = fill(self._store, order['username'], order['symbol'], order['shares'], price, fx['price'])
+            results.append((order, 'filled' if success else 'rejected', message, price))
+            if success:
+                self.fills += 1
+            else:
+                self.rejections += 1
+        self.book.settle(results)
+        
+        self.ticks += 1
+        self.last_tick_duration = time.perf_counter() - started
+        return len(results)
+    
+    def _run(self):
+        seen = None
+        while True:
+            time.sleep(self.interval)
+            # בודקים רק כשיש מחירים חדשים או שהספר השתנה (פקודה חדשה יכולה להיות כבר "חוצה")
+            state = (self._market_data.runs, self.book.version)
+            if state == seen:
+                continue
+            try:
+                self.tick()
+                self.last_error = None
+            except Exception as e:
+                self.last_error = str(e)
+            seen = (self._market_data.runs, self.book.version)
+    
+    def stats(self):
+        return {
+            'open': len(self.book.open_orders()),
+            'ticks': self.ticks,
+            'fills': self.fills,
+            'rejections': self.rejections,
+            'last_tick_duration': self.last_tick_duration,
+            'last_error': self.last_error
         }
-        save_single_user(username)
-        return True
-    return False
+
+@st.cache_resource
+def get_order_matcher(class_id):
+    """מנוע ההתאמה וספר הפקודות של כיתה - הספר נשמר ביומן data/orders.jsonl"""
+    return OrderMatcher(
+        OrderBook(shard_path(os.path.join(DATA_DIR, 'orders.jsonl'), class_id)),
+        get_portfolio_store(class_id),
+        get_market_data(),
+        get_setting('orders', 'match_interval', ORDER_MATCH_INTERVAL)
+    )
+
+@st.cache_resource
+def start_order_matchers():
+    """הפעלת מנועי ההתאמה של כל הכיתות שיש להן יומן פקודות - אחרי הפעלה מחדש פקודות ממתינות מתבצעות
+    גם אם אף אחד מהכיתה עוד לא נכנס לדף"""
+    return [get_order_matcher(class_id) for class_id in get_class_router().classes()
+            if os.path.exists(shard_path(os.path.join(DATA_DIR, 'orders.jsonl'), class_id))]
+
+def order_book_for(username):
+    return get_order_matcher(get_class_router().class_of(username)).book
+
+def place_order(username, symbol, side, order_type, trigger, shares):
+    """רישום פקודת לימיט/סטופ. הכסף/המניות נבדקים שוב ברגע הביצוע. מחזיר (הצלחה, הודעה)"""
+    if trigger <= 0 or shares < 1:
+        return False, "מחיר ההפעלה והכמות חייבים להיות חיוביים"
+    if get_instrument_catalog().lookup(symbol) is None:
+        return False, "לא נמצא סימול מניה תקין"
+    if side == 'sell':
+        holding = (store_for(username).get(username) or {}).get('stocks', {}).get(symbol)
+        if not holding or holding['shares'] < shares:
+            return False, f"אין לך מספיק מניות. יש לך: {holding['shares'] if holding else 0}"
+    
+    max_open = int(get_setting('orders', 'max_open', ORDER_MAX_OPEN))
+    if order_book_for(username).place(username, symbol, side, order_type, trigger, shares, max_open=max_open) is None:
+        return False, f"אפשר להחזיק עד {max_open} פקודות פתוחות"
+    get_market_data().track([symbol])
+    
+    action = "קנייה" if side == 'buy' else "מכירה"
+    direction = "יורד" if (side == 'buy') == (order_type == 'limit') else "עולה"
+    return True, f"📌 פקודת {action} נרשמה: {shares} מניות של {symbol} כשהמחיר {direction} ל-${trigger:.2f}"
 
 # ============================================
 # ממשק משתמש - התחברות
@@ -394,25 +3420,27 @@ def login_page():
 # ממשק משתמש - דף ראשי
 # ============================================
 
-def main_page():
+def main_page(portfolios):
     """הדף הראשי של המערכת"""
     username = st.session_state.username
     
     # בדיקה פשוטה: האם יש תיק?
-    if username not in st.session_state.portfolios:
+    if username not in portfolios:
         st.error(f"❌ אין תיק עבור {username}")
         
         # אם זה המורה - תן לו ליצור
-        if username == "nadav":
+        if get_class_router().is_teacher(username):
             if st.button("✅ צור תיק למשתמש זה"):
-                create_portfolio(username)
-                st.success("תיק נוצר!")
-                st.rerun()
+                if create_portfolio(username):
+                    st.success("תיק נוצר!")
+                    st.rerun()
+                else:
+                    st.error("❌ שגיאה ביצירת התיק")
         else:
             st.info("נא לפנות למורה")
         return
     
-    portfolio = st.session_state.portfolios[username]
+    portfolio = portfolios[username]
     
     # כותרת
     col_title, col_logout = st.columns([3, 1])
@@ -431,35 +3459,15 @@ def main_page():
     st.info(f"💱 **שער דולר-שקל היום:** $1.00 = ₪{usd_to_ils:.3f}")
     
     # חישוב שווי תיק
-    stocks_value = 0
-    stocks_value_yesterday = 0
-    
-    for symbol, data in portfolio['stocks'].items():
-        current_price_usd = get_stock_price(symbol)
-        if current_price_usd:
-            current_price_ils = current_price_usd * usd_to_ils
-            stocks_value += current_price_ils * data['shares']
-            
-            try:
-                stock = yf.Ticker(symbol)
-                hist = stock.history(period='2d')
-                if len(hist) >= 2:
-                    yesterday_price_usd = hist['Close'].iloc[-2]
-                    yesterday_price_ils = yesterday_price_usd * usd_to_ils
-                    stocks_value_yesterday += yesterday_price_ils * data['shares']
-                else:
-                    stocks_value_yesterday += current_price_ils * data['shares']
-            except:
-                stocks_value_yesterday += current_price_ils * data['shares']
-    
-    total_value = portfolio['cash'] + stocks_value
-    total_value_yesterday = portfolio['cash'] + stocks_value_yesterday
-    
-    profit_loss = total_value - 10000
-    profit_loss_percent = (profit_loss / 10000) * 100
-    
-    daily_change = total_value - total_value_yesterday
-    daily_change_percent = (daily_change / total_value_yesterday) * 100 if total_value_yesterday > 0 else 0
+    with span('render.valuation'):
+        valuation = value_portfolio(portfolio, usd_to_ils)
+    prices = valuation['prices']
+    stocks_value = valuation['stocks_value']
+    total_value = valuation['total_value']
+    profit_loss = valuation['profit_loss']
+    profit_loss_percent = valuation['profit_loss_percent']
+    daily_change = valuation['daily_change']
+    daily_change_percent = valuation['daily_change_percent']
     
     # מטריקות
     col1, col2, col3, col4, col5 = st.columns(5)
@@ -478,81 +3486,42 @@ def main_page():
     st.markdown("---")
     
     # טאבים
-    is_teacher = (username == "nadav")
+    router = get_class_router()
+    class_id = router.class_of(username)
+    is_teacher = router.is_teacher(username)
     
     if is_teacher:
-        tab1, tab2, tab3, tab4 = st.tabs(["💰 קנה/מכור", "📊 התיק שלי", "📜 היסטוריה", "👨‍🏫 לוח בקרת מורה"])
+        tab1, tab2, tab3, tab5, tab4 = st.tabs(["💰 קנה/מכור", "📊 התיק שלי", "📜 היסטוריה", "🌍 סקירת שוק", "👨‍🏫 לוח בקרת מורה"])
     else:
-        tab1, tab2, tab3 = st.tabs(["💰 קנה/מכור", "📊 התיק שלי", "📜 היסטוריה"])
+        tab1, tab2, tab3, tab5 = st.tabs(["💰 קנה/מכור", "📊 התיק שלי", "📜 היסטוריה", "🌍 סקירת שוק"])
     
     # טאב 1: קנייה/מכירה
-    with tab1:
+    with tab1, span('render.trade'):
         col1, col2 = st.columns(2)
         
         with col1:
             st.subheader("🛒 קנה מניה")
             
-            popular_stocks = {
-                "--- מניות סל (ETFs) ---": "HEADER1",
-                "📊 SPY - S&P 500": "SPY",
-                "📊 QQQ - NASDAQ 100": "QQQ",
-                "📊 VTI - כלל שוק ארה\"ב": "VTI",
-                "📊 VXUS - כלל עולמי": "VXUS",
-                "📊 VOO - S&P 500 (Vanguard)": "VOO",
-                "--- טכנולוגיה ---": "HEADER2",
-                "🍎 Apple (AAPL)": "AAPL",
-                "💻 Microsoft (MSFT)": "MSFT",
-                "🔍 Google (GOOGL)": "GOOGL",
-                "📱 Meta/Facebook (META)": "META",
-                "🎮 NVIDIA (NVDA)": "NVDA",
-                "🌐 Amazon (AMZN)": "AMZN",
-                "🎬 Netflix (NFLX)": "NFLX",
-                "💾 Intel (INTC)": "INTC",
-                "🖥️ AMD (AMD)": "AMD",
-                "💻 IBM (IBM)": "IBM",
-                "☁️ Oracle (ORCL)": "ORCL",
-                "--- רכב וחלל ---": "HEADER3",
-                "🚗 Tesla (TSLA)": "TSLA",
-                "🚙 Ford (F)": "F",
-                "🏭 General Motors (GM)": "GM",
-                "✈️ Boeing (BA)": "BA",
-                "--- צריכה ומזון ---": "HEADER4",
-                "🥤 Coca-Cola (KO)": "KO",
-                "🍔 McDonald's (MCD)": "MCD",
-                "☕ Starbucks (SBUX)": "SBUX",
-                "🛒 Walmart (WMT)": "WMT",
-                "🎯 Target (TGT)": "TGT",
-                "--- ספורט ופיננסים ---": "HEADER5",
-                "👟 Nike (NKE)": "NKE",
-                "🏰 Disney (DIS)": "DIS",
-                "💳 Visa (V)": "V",
-                "💳 Mastercard (MA)": "MA",
-                "💰 PayPal (PYPL)": "PYPL",
-                "--- חברות ישראליות ---": "HEADER6",
-                "💊 Teva (TEVA)": "TEVA",
-                "🔒 Check Point (CHKP)": "CHKP",
-                "🌐 Wix (WIX)": "WIX",
-                "📞 Nice (NICE)": "NICE",
-                "📋 Monday.com (MNDY)": "MNDY",
-                "--- או הכנס ידנית ---": "CUSTOM"
-            }
-            
-            stock_choice = st.selectbox("בחר מניה", options=list(popular_stocks.keys()), key="stock_choice")
+            stock_choice = st.selectbox("בחר מניה", options=list(POPULAR_STOCKS.keys()), key="stock_choice")
             
             buy_symbol = None
             
-            if popular_stocks[stock_choice].startswith("HEADER"):
+            if POPULAR_STOCKS[stock_choice].startswith("HEADER"):
                 st.info("👆 בחר מניה מהרשימה")
-            elif popular_stocks[stock_choice] == "CUSTOM":
+            elif POPULAR_STOCKS[stock_choice] == "CUSTOM":
                 buy_symbol = st.text_input("הכנס סימול", key="buy_symbol_custom").upper()
             else:
-                buy_symbol = popular_stocks[stock_choice]
+                buy_symbol = POPULAR_STOCKS[stock_choice]
+            
+            # 🔒 הקנייה מתבצעת בתמונת המחיר שהוצגה בהרצה הקודמת (זו שהתלמיד ראה כשלחץ)
+            shown_buy_quote = st.session_state.trade_quotes.get(buy_symbol)
             
             if buy_symbol and buy_symbol != "CUSTOM":
-                info = get_stock_info(buy_symbol)
-                if info and info['price']:
-                    price_ils = info['price'] * usd_to_ils
-                    st.info(f"**{info['name']}** - מחיר נוכחי: ${info['price']:.2f} (₪{price_ils:.2f})")
+                info = get_instrument_catalog().lookup(buy_symbol)
+                quote = trade_quote(buy_symbol) if info else None
+                if quote:
+                    price_ils = quote['price'] * quote['usd_to_ils']
+                    st.info(f"**{info['name']}** - מחיר נוכחי: ${quote['price']:.2f} (₪{price_ils:.2f})")
                     
                     description = get_stock_description(buy_symbol)
                     if description:
@@ -576,14 +3545,33 @@ def main_page():
                                 emoji = "🟢 ⬆️" if perf['monthly_change'] >= 0 else "🔴 ⬇️"
                                 color = "green" if perf['monthly_change'] >= 0 else "red"
                                 st.markdown(f"{emoji} **חודשי:** :{color}[{perf['monthly_change']:+.2f}%]")
+                        risk = []
+                        if 'volatility' in perf:
+                            risk.append(f"תנודתיות שנתית: {perf['volatility']:.1f}%")
+                        if 'max_drawdown' in perf:
+                            risk.append(f"ירידה מקסימלית בחודש: {perf['max_drawdown']:.1f}%")
+                        if 'ma_20' in perf:
+                            risk.append(f"ממוצע נע 20 יום: ${perf['ma_20']:.2f}")
+                        if risk:
+                            st.caption("📐 " + " | ".join(risk))
                 else:
                     st.warning("לא נמצא סימול תקין")
             
             buy_shares = st.number_input("כמות מניות", min_value=1, value=1, key="buy_shares")
             
+            # 📌 לימיט: קנייה כשהמחיר יורד עד מחיר ההפעלה | סטופ: קנייה כשהמחיר עולה עד מחיר ההפעלה
+            buy_order_type = ORDER_TYPES[st.radio("סוג פקודה", list(ORDER_TYPES), horizontal=True, key="buy_order_type")]
+            if buy_order_type:
+                current_quote = st.session_state.trade_quotes.get(buy_symbol)
+                default_trigger = current_quote['price'] if current_quote else 1.0
+                buy_trigger = st.number_input("מחיר הפעלה ($)", min_value=0.01, value=round(default_trigger, 2), key=f"buy_trigger_{buy_symbol}")
+            
             if st.button("קנה", use_container_width=True):
                 if buy_symbol:
-                    success, message = buy_stock(username, buy_symbol, buy_shares)
+                    if buy_order_type:
+                        success, message = place_order(username, buy_symbol, 'buy', buy_order_type, buy_trigger, buy_shares)
+                    else:
+                        success, message = buy_stock(username, buy_symbol, buy_shares, shown_buy_quote or trade_quote(buy_symbol))
                     if success:
                         st.success(message)
                         st.rerun()
@@ -602,15 +3590,25 @@ def main_page():
                 max_shares = portfolio['stocks'][sell_symbol]['shares']
                 st.info(f"יש לך {max_shares} מניות")
                 
-                current_price = get_stock_price(sell_symbol)
-                if current_price:
-                    price_ils = current_price * usd_to_ils
-                    st.info(f"מחיר נוכחי: ${current_price:.2f} (₪{price_ils:.2f})")
+                shown_sell_quote = st.session_state.trade_quotes.get(sell_symbol)
+                quote = trade_quote(sell_symbol)
+                if quote:
+                    price_ils = quote['price'] * quote['usd_to_ils']
+                    st.info(f"מחיר נוכחי: ${quote['price']:.2f} (₪{price_ils:.2f})")
                 
                 sell_shares = st.number_input("כמות מניות למכירה", min_value=1, max_value=max_shares, value=1, key="sell_shares")
                 
+                # 📌 לימיט: מכירה כשהמחיר עולה עד מחיר ההפעלה | סטופ: מכירה כשהמחיר יורד עד מחיר ההפעלה (הגנה מהפסד)
+                sell_order_type = ORDER_TYPES[st.radio("סוג פקודה", list(ORDER_TYPES), horizontal=True, key="sell_order_type")]
+                if sell_order_type:
+                    default_trigger = quote['price'] if quote else 1.0
+                    sell_trigger = st.number_input("מחיר הפעלה ($)", min_value=0.01, value=round(default_trigger, 2), key=f"sell_trigger_{sell_symbol}")
+                
                 if st.button("מכור", use_container_width=True):
-                    success, message = sell_stock(username, sell_symbol, sell_shares)
+                    if sell_order_type:
+                        success, message = place_order(username, sell_symbol, 'sell', sell_order_type, sell_trigger, sell_shares)
+                    else:
+                        success, message = sell_stock(username, sell_symbol, sell_shares, shown_sell_quote or quote)
                     if success:
                         st.success(message)
                         st.rerun()
@@ -618,16 +3616,39 @@ def main_page():
                         st.error(message)
             else:
                 st.info("אין לך מניות למכירה")
+        
+        # פקודות ממתינות - מתבצעות ברקע כשהמחיר מגיע למחיר ההפעלה
+        book = order_book_for(username)
+        open_orders = book.open_orders(username)
+        closed_orders = book.closed_orders(username)
+        if open_orders or closed_orders:
+            st.markdown("---")
+            st.markdown("### 📌 פקודות ממתינות")
+            for order in sorted(open_orders, key=lambda o: o['id']):
+                col_order, col_cancel = st.columns([4, 1])
+                with col_order:
+                    action = "קנייה" if order['side'] == 'buy' else "מכירה"
+                    order_type = "לימיט" if order['type'] == 'limit' else "סטופ"
+                    st.write(f"{action} ({order_type}) | {order['shares']} × {order['symbol']} | מחיר הפעלה: ${order['trigger']:.2f}")
+                with col_cancel:
+                    if st.button("❌ בטל", key=f"cancel_order_{order['id']}"):
+                        book.cancel(username, order['id'])
+                        st.rerun()
+            if closed_orders:
+                with st.expander("📜 פקודות שנסגרו"):
+                    for order in closed_orders:
+                        icon = {'filled': "✅", 'rejected': "⚠️", 'cancelled': "❌"}[order['status']]
+                        st.write(f"{icon} {order['closed'].replace('T', ' ')} | {order['symbol']} | {order['message']}")
     
     # טאב 2: התיק
-    with tab2:
+    with tab2, span('render.holdings'):
         st.subheader("📊 המניות שלי")
         
         if portfolio['stocks']:
             rows = []
             for symbol, data in portfolio['stocks'].items():
-                current_price_usd = get_stock_price(symbol)
-                if current_price_usd:
+                current_price_usd = prices.at[symbol, 'price']
+                if pd.notna(current_price_usd):
                     current_price_ils = current_price_usd * usd_to_ils
                     current_value = current_price_ils * data['shares']
                     purchase_value = data['avg_price'] * data['shares']
@@ -649,11 +3670,12 @@ def main_page():
             st.info("אין לך מניות בתיק כרגע")
     
     # טאב 3: היסטוריה
-    with tab3:
+    with tab3, span('render.history'):
         st.subheader("📜 היסטוריית עסקאות")
         
-        if portfolio['history']:
-            recent = portfolio['history'][-20:][::-1]
+        history = get_storage(class_id).recent_trades(username)
+        if history:
+            recent = history[::-1]
             
             for transaction in recent:
                 action_emoji = "🛒" if transaction['action'] == 'buy' else "💸"
@@ -670,18 +3692,44 @@ def main_page():
         else:
             st.info("עדיין לא ביצעת עסקאות")
     
+    # טאב 5: סקירת שוק - כל המניות מהרשימה בטבלה אחת
+    with tab5, span('render.market'):
+        st.subheader("🌍 סקירת שוק")
+        
+        names = {symbol: name for name, symbol in POPULAR_STOCKS.items() if not symbol.startswith("HEADER") and symbol != "CUSTOM"}
+        overview = live_performance(names.keys()).dropna(subset=['last_price'])
+        
+        if overview.empty:
+            st.info("נתוני השוק עדיין נטענים - נסה שוב בעוד רגע")
+        else:
+            percent = lambda value: '' if pd.isna(value) else f"{value:+.2f}%"
+            df = pd.DataFrame({
+                'מניה': overview.index.map(names),
+                'מחיר': overview['last_price'].map('${:.2f}'.format),
+                'יומי': overview['daily_change'].map(percent),
+                'שבועי': overview['weekly_change'].map(percent),
+                'חודשי': overview['monthly_change'].map(percent),
+                'תנודתיות שנתית': overview['volatility'].map(lambda v: '' if pd.isna(v) else f"{v:.1f}%"),
+                'ירידה מקסימלית': overview['max_drawdown'].map(percent),
+                'ממוצע נע 20 יום': overview['ma_20'].map(lambda v: '' if pd.isna(v) else f"${v:.2f}")
+            })
+            st.dataframe(df, hide_index=True)
+            st.caption("📈 שינוי יומי לפי המחיר הנוכחי, שבועי/חודשי לפי מחירי הסגירה, תנודתיות וירידה מקסימלית לפי החודש האחרון")
+    
     # טאב 4: לוח בקרת מורה
     if is_teacher:
-        with tab4:
-            st.subheader("👨‍🏫 לוח בקרת מורה")
+        with tab4, span('render.teacher'):
+            st.subheader(f"👨‍🏫 לוח בקרת מורה - {router.name(class_id)}" if len(router.classes()) > 1 else "👨‍🏫 לוח בקרת מורה")
             
             # סטטיסטיקות
             st.markdown("### 📊 סטטיסטיקות כיתה")
             col1, col2, col3 = st.columns(3)
             
-            total_students = len(st.session_state.portfolios) - 1
-            total_cash = sum(p['cash'] for u, p in st.session_state.portfolios.items() if u != username)
-            total_trades = sum(len(p['history']) for u, p in st.session_state.portfolios.items() if u != username)
+            total_students = len(portfolios) - 1
+            total_cash = sum(p['cash'] for u, p in portfolios.items() if u != username)
+            storage = get_storage(class_id)
+            trade_counts = storage.trade_counts()
+            total_trades = sum(count for u, count in trade_counts.items() if u != username and u in portfolios)
             
             with col1:
                 st.metric("👥 מספר תלמידים", total_students)
@@ -690,60 +3738,182 @@ def main_page():
             with col3:
                 st.metric("📈 סך עסקאות", total_trades)
             
+            market_stats = get_market_data().stats()
+            market_age = f"לפני {time.time() - market_stats['last_run']:.0f} שניות" if market_stats['last_run'] else "עדיין לא"
+            st.caption(
+                f"⏱️ רענון מחירים ברקע ({market_stats['provider']}): {market_stats['symbols']} מניות, עודכן {market_age} "
+                f"({market_stats['last_duration']:.1f} שניות) | הבורסה {'פתוחה' if market_stats['market_open'] else 'סגורה'} - "
+                f"רענון כל {market_stats['interval']} שניות | {market_stats['failures']} כישלונות"
+            )
+            if market_stats['last_error']:
+                st.warning(f"⚠️ שגיאת רענון מחירים אחרונה: {market_stats['last_error']}")
+            matcher_stats = get_order_matcher(class_id).stats()
+            st.caption(
+                f"📌 פקודות ממתינות: {matcher_stats['open']} פתוחות | {matcher_stats['fills']} בוצעו, "
+                f"{matcher_stats['rejections']} נדחו | בדיקה אחרונה: {matcher_stats['last_tick_duration'] * 1000:.1f}ms"
+            )
+            if matcher_stats['last_error']:
+                st.warning(f"⚠️ שגיאה במנוע הפקודות: {matcher_stats['last_error']}")
+            gateway_stats = get_market_provider().stats()
+            st.caption(
+                f"🚦 שער נתוני שוק: {gateway_stats['requests']} בקשות, {gateway_stats['coalesced']} אוחדו, "
+                f"{gateway_stats['upstream_calls']} קריאות לספק | {gateway_stats['retries']} ניסיונות חוזרים, "
+                f"{gateway_stats['failures']} כישלונות | המתנה למגביל הקצב: {gateway_stats['throttled']} פעמים "
+                f"({gateway_stats['throttled_seconds']:.1f} שניות)"
+            )
+            catalog_stats = get_instrument_catalog().stats()
+            catalog_built = datetime.fromtimestamp(catalog_stats['built_at']).strftime('%d/%m/%Y %H:%M') if catalog_stats['built_at'] else "עדיין לא"
+            price_store_stats = get_price_store().stats()
+            st.caption(
+                f"📚 קטלוג מניות: {catalog_stats['size']} מניות | מחירי סגירה עודכנו: {catalog_built} | "
+                f"מאגר מחירים יומיים: {price_store_stats['symbols']} מניות, {price_store_stats['fetches']} משיכות מהספק"
+            )
+            cache_stats = get_quote_cache().stats()
+            st.caption(
+                f"📡 קאש מחירים: {cache_stats['hits']} פגיעות, {cache_stats['stale_hits']} ישנות, "
+                f"{cache_stats['misses']} החטאות ({cache_stats['hit_rate']:.0%}) | {cache_stats['size']} ערכים"
+            )
+            if storage.name == 'sheets':
+                sheets_stats = get_sheets_stats(class_id).stats()
+                st.caption(
+                    f"📗 Google Sheets: {sheets_stats['saves']} שמירות, "
+                    f"{sheets_stats['calls_per_save']:.1f} קריאות API לעסקה (אחרונה: {sheets_stats['last_save_calls']}) | "
+                    f"{sheets_stats['calls'].get('connect', 0)} התחברויות"
+                )
+                queue_stats = get_save_queue(class_id).stats()
+                st.caption(
+                    f"💾 תור שמירות: {queue_stats['depth']} ממתינים | {queue_stats['flushes']} כתיבות, "
+                    f"{queue_stats['coalesced']} אוחדו | זמן כתיבה: {queue_stats['last_flush_latency'] * 1000:.0f}ms "
+                    f"(ממוצע {queue_stats['avg_flush_latency'] * 1000:.0f}ms) | {queue_stats['failures']} כישלונות"
+                )
+                if queue_stats['last_error']:
+                    st.warning(f"⚠️ שגיאת שמירה אחרונה (ינסה שוב אוטומטית): {queue_stats['last_error']}")
+            else:
+                st.caption(f"🗄️ אחסון: SQLite ({storage.path})")
+            
+            # 🐞 מדדי ביצועים - רק למי שמבקש, כדי לא להעמיס על הלוח
+            if st.checkbox("🐞 הצג מדדי ביצועים"):
+                metrics = get_metrics()
+                last_rerun = Metrics.summarize(st.session_state.get('last_rerun_spans', {}))
+                if last_rerun:
+                    st.markdown("**⏱️ ההרצה הקודמת של הדף**")
+                    st.dataframe(pd.DataFrame.from_dict(last_rerun, orient='index'), use_container_width=True)
+                snapshot = metrics.snapshot()
+                st.markdown(f"**📈 מצטבר מאז עליית השרת ({snapshot['uptime_s'] / 3600:.1f} שעות)**")
+                if snapshot['spans']:
+                    totals = pd.DataFrame.from_dict(snapshot['spans'], orient='index')
+                    st.dataframe(totals.sort_values('total_ms', ascending=False), use_container_width=True)
+                col1, col2 = st.columns(2)
+                with col1:
+                    st.download_button(
+                        "📥 הורד מדדים (JSON)",
+                        json.dumps(snapshot, ensure_ascii=False, indent=2),
+                        file_name=f"metrics-{datetime.now():%Y-%m-%d-%H%M}.json",
+                        mime="application/json"
+                    )
+                with col2:
+                    if st.button("💾 שמור תמונת מצב לקובץ"):
+                        try:
+                            st.success(f"✅ נשמר ל-{metrics.export()}")
+                        except OSError as e:
+                            st.error(f"❌ שגיאה בשמירה: {e}")
+            
+            # התיקים מוצגים מהזיכרון המשותף - שינוי ידני בגיליון נכנס רק אחרי רענון
+            if st.button("🔄 רענן נתונים מהאחסון"):
+                try:
+                    get_portfolio_store(class_id).reload()
+                    st.rerun()
+                except Exception as e:
+                    st.error(f"❌ שגיאה בטעינה: {e}")
+            
             st.markdown("---")
             
             # טבלת תלמידים
             st.markdown("### 👥 ניהול תלמידים")
             
-            students_data = []
-            for student_name, student_portfolio in st.session_state.portfolios.items():
-                if student_name == username:
-                    continue
-                
-                stocks_value = 0
-                for symbol, data in student_portfolio['stocks'].items():
-                    current_price = get_stock_price(symbol)
-                    if current_price:
-                        stocks_value += current_price * usd_to_ils * data['shares']
-                
-                total_value = student_portfolio['cash'] + stocks_value
-                profit = total_value - 10000
-                
-                students_data.append({
-                    'תלמיד': student_name,
-                    'יתרת מזומן': f"₪{student_portfolio['cash']:.2f}",
-                    'שווי מניות': f"₪{stocks_value:.2f}",
-                    'שווי כולל': f"₪{total_value:.2f}",
-                    'רווח/הפסד': f"₪{profit:+.2f}",
-                    'עסקאות': len(student_portfolio['history']),
-                    'מניות בתיק': len(student_portfolio['stocks'])
-                })
+            students = {u: p for u, p in portfolios.items() if u != username}
             
-            if students_data:
-                df = pd.DataFrame(students_data)
+            if students:
+                board = compute_class_leaderboard(students, usd_to_ils, trade_counts)
+                df = pd.DataFrame({
+                    'דירוג': board['rank'],
+                    'תלמיד': board.index,
+                    'יתרת מזומן': board['cash'].map('₪{:.2f}'.format),
+                    'שווי מניות': board['stocks_value'].map('₪{:.2f}'.format),
+                    'שווי כולל': board['total_value'].map('₪{:.2f}'.format),
+                    'רווח/הפסד': board['profit'].map('₪{:+.2f}'.format),
+                    'עסקאות': board['trades'],
+                    'מניות בתיק': board['holdings']
+                })
                 st.dataframe(df, hide_index=True)
             
+            # 🏫 טבלה בין-כיתתית - נטענת רק לפי בקשה, כי היא קוראת את כל הכיתות
+            if len(router.classes()) > 1 and st.checkbox("🏫 הצג טבלה משותפת לכל הכיתות"):
+                try:
+                    with st.spinner("טוען את כל הכיתות..."):
+                        school = compute_school_leaderboard(usd_to_ils)
+                    st.dataframe(pd.DataFrame({
+                        'דירוג': school['rank'],
+                        'תלמיד': school.index,
+                        'כיתה': school['class'],
+                        'שווי כולל': school['total_value'].map('₪{:.2f}'.format),
+                        'רווח/הפסד': school['profit'].map('₪{:+.2f}'.format),
+                        'עסקאות': school['trades']
+                    }), hide_index=True)
+                except Exception as e:
+                    st.error(f"❌ שגיאה בטעינת הכיתות: {e}")
+            
+            # עקומות שווי - מעודכנות בהדרגה (רק עסקאות וימים חדשים) ולא מחושבות מחדש בכל צפייה
+            st.markdown("### 📈 עקומות שווי")
+            equity = get_equity_curves(class_id)
+            try:
+                equity.update()
+            except Exception as e:
+                st.warning(f"⚠️ לא ניתן לעדכן את עקומות השווי: {e}")
+            
+            curves = equity.curves(students.keys())
+            if curves.empty:
+                st.info("עדיין אין מספיק היסטוריית עסקאות להצגת עקומות שווי")
+            else:
+                selected = st.multiselect("תלמידים להצגה", list(curves.columns), default=list(curves.columns))
+                if selected:
+                    st.line_chart(curves[selected])
+            
             st.markdown("---")
             
             # יצירת תיקים למשתמשים חדשים
             st.markdown("### ➕ הוספת תלמידים חדשים")
             
-            users_in_secrets = set(st.secrets['users'].keys())
-            users_with_portfolio = set(st.session_state.portfolios.keys())
+            users_in_secrets = set(router.members(class_id))
+            users_with_portfolio = set(portfolios.keys())
             missing_users = users_in_secrets - users_with_portfolio
             
             if missing_users:
                 st.info(f"🆕 נמצאו {len(missing_users)} משתמשים ב-Secrets שאין להם תיק:")
+                
+                # כל התיקים החסרים בכתיבה אחת
+                if st.button(f"➕ צור תיקים לכולם ({len(missing_users)})", type="primary", key="create_all"):
+                    bar = st.progress(0.0, text="מכין תיקים...")
+                    created, error = create_portfolios(class_id, sorted(missing_users), bar.progress)
+                    if error:
+                        st.error(f"❌ {error}")
+                    else:
+                        st.success(f"✅ נוצרו {created} תיקים!")
+                        time.sleep(1)
+                        st.rerun()
+                
                 for user in missing_users:
                     col_user, col_btn = st.columns([3, 1])
                     with col_user:
                         st.write(f"👤 **{user}**")
                     with col_btn:
                         if st.button("➕ צור תיק", key=f"create_{user}"):
-                            create_portfolio(user)
-                            st.success(f"✅ תיק נוצר עבור {user}!")
-                            time.sleep(1)
-                            st.rerun()
+                            if create_portfolio(user):
+                                st.success(f"✅ תיק נוצר עבור {user}!")
+                                time.sleep(1)
+                                st.rerun()
+                            else:
+                                st.error(f"❌ שגיאה ביצירת תיק עבור {user}")
             else:
                 st.success("✅ לכל המשתמשים ב-Secrets יש תיק!")
             
@@ -753,7 +3923,7 @@ def main_page():
             st.markdown("### 🔄 איפוס תיק תלמיד")
             st.warning("⚠️ פעולת איפוס תמחק את כל המניות וההיסטוריה ותחזיר את התיק ל-₪10,000")
             
-            students_list = [s for s in st.session_state.portfolios.keys() if s != username]
+            students_list = [s for s in portfolios.keys() if s != username]
             if students_list:
                 selected_student = st.selectbox("בחר תלמיד לאיפוס", students_list)
                 
@@ -784,6 +3954,43 @@ def main_page():
                         if st.button("❌ ביטול", key="confirm_no"):
                             st.session_state.confirm_teacher_reset = None
                             st.rerun()
+                
+                # איפוס של כמה תלמידים בבת אחת - שמירה אחת, כולם או אף אחד
+                st.markdown("#### 🔄 איפוס כמה תלמידים")
+                selected_students = st.multiselect("בחר תלמידים לאיפוס", students_list, key="bulk_reset_students")
+                
+                col_selected, col_all = st.columns(2)
+                with col_selected:
+                    if st.button(f"🔄 אפס נבחרים ({len(selected_students)})", disabled=not selected_students):
+                        st.session_state.confirm_bulk_reset = list(selected_students)
+                        st.rerun()
+                with col_all:
+                    if st.button(f"🔄 אפס את כל הכיתה ({len(students_list)})"):
+                        st.session_state.confirm_bulk_reset = list(students_list)
+                        st.rerun()
+                
+                if st.session_state.get('confirm_bulk_reset'):
+                    students_to_reset = st.session_state.confirm_bulk_reset
+                    st.error(f"❗ **האם לאפס {len(students_to_reset)} תיקים?** זו פעולה בלתי הפיכה!")
+                    
+                    col_yes, col_no = st.columns(2)
+                    
+                    with col_yes:
+                        if st.button("✅ כן, אפס את כולם", type="primary", key="confirm_bulk_yes"):
+                            bar = st.progress(0.0, text="מכין איפוס...")
+                            reset_count, error = reset_portfolios(class_id, students_to_reset, bar.progress)
+                            if error:
+                                st.error(f"❌ {error}")
+                            else:
+                                st.session_state.confirm_bulk_reset = None
+                                st.success(f"✅ {reset_count} תיקים אופסו בהצלחה!")
+                                time.sleep(1)
+                                st.rerun()
+                    
+                    with col_no:
+                        if st.button("❌ ביטול", key="confirm_bulk_no"):
+                            st.session_state.confirm_bulk_reset = None
+                            st.rerun()
             else:
                 st.info("אין תלמידים במערכת")
             
@@ -819,6 +4026,30 @@ def main_page():
                     if st.button("❌ ביטול", key="confirm_self_no"):
                         st.session_state.confirm_self_reset = None
                         st.rerun()
+            
+            # העתקת הנתונים ל-SQLite - רק כשהכיתה עדיין עובדת מול Google Sheets
+            if get_storage(class_id).name == 'sheets':
+                st.markdown("---")
+                st.markdown("### 🗄️ העתקת הנתונים ל-SQLite")
+                sqlite_path = get_sqlite_path(class_id)
+                st.info(f"מעתיק את כל התיקים והעסקאות מ-Google Sheets לקובץ `{sqlite_path}` (התוכן הקיים בקובץ יוחלף). "
+                        "אחרי ההעתקה אפשר לעבור ל-SQLite עם `backend = \"sqlite\"` תחת `[storage]` ב-Secrets.")
+                
+                if st.button("🗄️ העתק ל-SQLite"):
+                    try:
+                        with st.spinner("מעתיק..."):
+                            portfolio_count, trade_count = migrate_sheets_to_sqlite(sqlite_path, class_id)
+                        st.success(f"✅ הועתקו {portfolio_count} תיקים ו-{trade_count} עסקאות")
+                    except Exception as e:
+                        st.error(f"❌ שגיאה בהעתקה: {e}")
+
+@st.fragment(run_every=CHANGE_POLL_INTERVAL)
+def watch_portfolio_changes(username):
+    """בדיקה תקופתית במאגר המשותף - אם תיק שמוצג בדף השתנה (עסקה בחלון אחר), הדף נטען מחדש מהזיכרון"""
+    changed, latest = store_for(username).changes_since(st.session_state.seen_seq)
+    if changed is None or (changed and (get_class_router().is_teacher(username) or username in changed)):
+        st.rerun()
+    st.session_state.seen_seq = latest
 
 # ============================================
 # הרצת האפליקציה
@@ -830,7 +4061,19 @@ def main():
     if not st.session_state.logged_in:
         login_page()
     else:
-        main_page()
+        username = st.session_state.username
+        # ⏱️ כל ה-spans של ההרצה הזו נאספים - ומוצגים בלוח המורה בהרצה הבאה
+        with get_metrics().rerun() as rerun_spans:
+            try:
+                # 🔔 מספר השינוי האחרון שנקרא - לפיו watch_portfolio_changes יודע אם הדף מיושן
+                st.session_state.seen_seq = store_for(username).last_seq()
+                start_order_matchers()
+                with span('load.portfolios'):
+                    portfolios = load_session_portfolios(username)
+                main_page(portfolios)
+                watch_portfolio_changes(username)
+            finally:
+                st.session_state.last_rerun_spans = rerun_spans
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,543 @@
+"""
+בדיקות ביצועים לבורסת הכיתה - מריצים בלי Streamlit ובלי רשת:
+    
+    python benchmark.py load --users 50 --trades 20 --storage-latency 0.2 --market-latency 0.5
+    python benchmark.py orders --orders 5000 --ticks 200
+    python benchmark.py memory --users 500 --holdings 8 --ledger-rows 200
+    python benchmark.py codec --portfolios 1000 --holdings 12
+
+הפלט הוא דוח JSON (למסך או לקובץ עם --output).
+"""
+
+import argparse
+import gc
+import json
+import logging
+import os
+import random
+import tempfile
+import threading
+import time
+import tracemalloc
+from array import array
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+from streamlit import config as streamlit_config
+
+# Streamlit מדפיס אזהרות כשמריצים את app.py בלי `streamlit run` - לא רלוונטי כאן
+streamlit_config.set_option('global.showWarningOnDirectExecution', False)
+logging.getLogger('streamlit.runtime.scriptrunner_utils.script_run_context').setLevel(logging.ERROR)
+
+import app
+
+BENCHMARK_SYMBOLS = ['AAPL', 'MSFT', 'GOOGL', 'NVDA', 'TSLA', 'KO', 'SPY', 'QQQ', 'TEVA', 'WIX']
+
+# הודעות של עסקה שנדחתה כחוק (אין כסף/מניות) - לא נספרות כתקלה
+REJECTION_PREFIXES = ("אין מספיק כסף", "אין לך מספיק מניות", "אין לך מניות מסוג זה")
+
+# ============================================
+# כלים משותפים
+# ============================================
+
+class CallCounter:
+    """מונה קריאות חיצוניות (לפי שם) - בטוח לשימוש מכמה תהליכונים"""
+    
+    def __init__(self):
+        self._counts = {}
+        self._lock = threading.Lock()
+    
+    def record(self, name):
+        with self._lock:
+            self._counts[name] = self._counts.get(name, 0) + 1
+    
+    def snapshot(self):
+        with self._lock:
+            return dict(self._counts)
+
+class LatencyProxy:
+    """עוטף אובייקט (אחסון או ספק נתונים) ומוסיף השהיה וספירה לכל קריאת מתודה"""
+    
+    def __init__(self, target, latency, counter, prefix):
+        self._target = target
+        self._latency = latency
+        self._counter = counter
+        self._prefix = prefix
+    
+    def __getattr__(self, name):
+        value = getattr(self._target, name)
+        if not callable(value):
+            return value
+        
+        def call(*args, **kwargs):
+            self._counter.record(f'{self._prefix}.{name}')
+            if self._latency:
+                # השהיה משתנה (±50%) כמו ברשת אמיתית
+                time.sleep(self._latency * random.uniform(0.5, 1.5))
+            return value(*args, **kwargs)
+        return call
+
+class MemoryStorage:
+    """אחסון בזיכרון עם אותו ממשק כמו SqliteStorage/SheetsStorage"""
+    
+    name = 'memory'
+    
+    def __init__(self):
+        self._portfolios = {}
+        self._trades = []
+        self._lock = threading.Lock()
+    
+    def load_all(self):
+        with self._lock:
+            return {u: {'cash': float(cash), 'stocks': app.decode_stocks(stocks)} for u, (cash, stocks) in self._portfolios.items()}
+    
+    def load_user(self, username):
+        with self._lock:
+            if username not in self._portfolios:
+                return None
+            cash, stocks = self._portfolios[username]
+            return {'cash': float(cash), 'stocks': app.decode_stocks(stocks)}
+    
+    def save(self, username, values, trade_rows):
+        cash, stocks, _ = values
+        with self._lock:
+            self._portfolios[username] = (cash, stocks)
+            self._trades.extend(trade_rows)
+    
+    def save_many(self, entries):
+        with self._lock:
+            for username, ((cash, stocks, _), trade_rows) in entries.items():
+                self._portfolios[username] = (cash, stocks)
+                self._trades.extend(trade_rows)
+    
+    def trade_counts(self):
+        counts = {}
+        with self._lock:
+            for row in self._trades:
+                counts[row[0]] = 0 if row[2] == 'reset' else counts.get(row[0], 0) + 1
+        return counts
+    
+    def recent_trades(self, username):
+        with self._lock:
+            rows = [row for row in self._trades if row[0] == username]
+        return [app.row_to_trade(row) for row in rows[-app.LEDGER_RECENT_LIMIT:]]
+    
+    def trades_after(self, position):
+        with self._lock:
+            return list(self._trades[position:]), len(self._trades)
+
+def percentiles(samples):
+    """p50/p95/p99 וממוצע (במילישניות)"""
+    if not samples:
+        return {'count': 0}
+    values = np.array(samples) * 1000
+    return {
+        'count': len(values),
+        'mean_ms': round(float(values.mean()), 3),
+        'p50_ms': round(float(np.percentile(values, 50)), 3),
+        'p95_ms': round(float(np.percentile(values, 95)), 3),
+        'p99_ms': round(float(np.percentile(values, 99)), 3),
+        'max_ms': round(float(values.max()), 3)
+    }
+
+def write_report(report, output):
+    text = json.dumps(report, ensure_ascii=False, indent=2)
+    if output:
+        with open(output, 'w', encoding='utf-8') as f:
+            f.write(text + '\n')
+    else:
+        print(text)
+
+# ============================================
+# בדיקת עומס - תלמידים מדומים שקונים ומוכרים במקביל
+# ============================================
+
+def install_backends(args, counter):
+    """החלפת האחסון וספק הנתונים של app.py בגרסאות מקומיות עם השהיה מוזרקת"""
+    app.DATA_DIR = tempfile.mkdtemp(prefix='stock-benchmark-')
+    
+    if args.storage == 'sqlite':
+        storage = app.SqliteStorage(os.path.join(app.DATA_DIR, 'portfolios.db'))
+    else:
+        storage = MemoryStorage()
+    storage = LatencyProxy(storage, args.storage_latency, counter, 'storage')
+    # הספק המדומה מאחורי אותו שער כמו באפליקציה - הקריאות שנספרות הן אלו שמגיעות לספק בפועל
+    provider = app.MarketGateway(
+        LatencyProxy(app.SimulatedProvider(seed=args.seed), args.market_latency, counter, 'market'),
+        app.TokenBucket(args.market_rate, app.MARKET_BURST),
+        app.MARKET_RETRIES,
+        app.MARKET_RETRY_DELAY
+    )
+    
+    # הפונקציות ב-app.py מחפשות את ה-factories בזמן הקריאה, לכן מספיק להחליף אותן במודול
+    app.get_storage = lambda class_id: storage
+    app.get_market_provider = lambda: provider
+    
+    # יצירת כל המשאבים המשותפים מראש, מהתהליכון הראשי
+    app.get_portfolio_store(app.DEFAULT_CLASS)
+    app.get_market_data()
+    app.get_instrument_catalog()
+    return storage
+
+def simulated_student(username, trades, think_time, rng, results):
+    """תלמיד אחד: פותח את הדף (הערכת שווי), ואז קונה/מוכר trades פעמים"""
+    for _ in range(trades):
+        results['iterations'].append(username)
+        # 🛡️ כל הסיבוב בתוך try - תקלה בהערכת השווי או בקריאת התיק נספרת כשגיאה ולא נבלעת בתוך ה-Future
+        try:
+            portfolio = app.store_for(username).get(username)
+            
+            started = time.perf_counter()
+            app.value_portfolio(portfolio, app.get_usd_to_ils())
+            results['valuation'].append(time.perf_counter() - started)
+            
+            holdings = list(portfolio['stocks'])
+            if holdings and rng.random() < 0.4:
+                symbol = rng.choice(holdings)
+                action = 'sell'
+                trade = lambda: app.sell_stock(username, symbol, 1)
+            else:
+                symbol = rng.choice(BENCHMARK_SYMBOLS)
+                action = 'buy'
+                trade = lambda: app.buy_stock(username, symbol, rng.randint(1, 3))
+            
+            started = time.perf_counter()
+            success, message = trade()
+            results['trade'].append(time.perf_counter() - started)
+            results['actions'].append(action)
+            if not success:
+                results['errors'].append(message)
+        except Exception as e:
+            results['errors'].append(f'{type(e).__name__}: {e}')
+        
+        if think_time:
+            time.sleep(rng.uniform(0, think_time))
+
+def run_load_test(args):
+    counter = CallCounter()
+    install_backends(args, counter)
+    
+    usernames = [f'student{i:04d}' for i in range(args.users)]
+    for username in usernames:
+        app.create_portfolio(username)
+    
+    # המתנה לרענון המחירים ולבניית הקטלוג ברקע, כדי למדוד את המצב הרגיל ולא את ההתחלה הקרה
+    deadline = time.time() + 30
+    while time.time() < deadline and not (app.get_market_data().stats()['runs'] and app.get_instrument_catalog().stats()['built_at']):
+        time.sleep(0.05)
+    
+    calls_before = counter.snapshot()
+    results = {'trade': [], 'valuation': [], 'actions': [], 'errors': [], 'iterations': []}
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.users) as pool:
+        futures = [pool.submit(simulated_student, username, args.trades, args.think_time, random.Random(args.seed + i), results)
+                   for i, username in enumerate(usernames)]
+    elapsed = time.perf_counter() - started
+    # 📌 תלמיד שנפל מחוץ ללולאה (למשל ב-sleep) - גם הוא נספר, עם הסיבובים שלא הספיק
+    for username, future in zip(usernames, futures):
+        error = future.exception()
+        if error is not None:
+            missed = args.trades - results['iterations'].count(username)
+            results['errors'].extend([f'{type(error).__name__}: {error}'] * max(missed, 1))
+    
+    calls_after = counter.snapshot()
+    calls = {name: calls_after.get(name, 0) - calls_before.get(name, 0) for name in calls_after}
+    calls = {name: count for name, count in calls.items() if count}
+    trades = len(results['trade'])
+    attempts = args.users * args.trades
+    
+    rejected = [message for message in results['errors'] if message.startswith(REJECTION_PREFIXES)]
+    errors = {}
+    for message in results['errors']:
+        if message.startswith(REJECTION_PREFIXES):
+            continue
+        kind = message.split(':')[0][:60]
+        errors[kind] = errors.get(kind, 0) + 1
+    
+    return {
+        'benchmark': 'load',
+        'config': {key: value for key, value in vars(args).items() if key not in ('run', 'output')},
+        'elapsed_s': round(elapsed, 3),
+        'attempts': attempts,
+        'trades': trades,
+        'buys': results['actions'].count('buy'),
+        'sells': results['actions'].count('sell'),
+        'throughput_trades_per_s': round(trades / elapsed, 2) if elapsed else None,
+        'trade_latency': percentiles(results['trade']),
+        'valuation_latency': percentiles(results['valuation']),
+        'external_calls': calls,
+        'external_calls_per_trade': round(sum(calls.values()) / trades, 3) if trades else None,
+        'rejection_rate': round(len(rejected) / attempts, 4) if attempts else None,
+        'error_rate': round(sum(errors.values()) / attempts, 4) if attempts else None,
+        'errors': errors,
+        'market_gateway': app.get_market_provider().stats()
+    }
+
+# ============================================
+# מנוע הפקודות - אלפי פקודות ממתינות מול מחירים שזזים
+# ============================================
+
+class ManualQuotes:
+    """תמונת מחירים שהבדיקה מזיזה בעצמה - במקום MarketDataRefresher"""
+    
+    def __init__(self, prices):
+        self.prices = dict(prices)
+        self.runs = 0
+    
+    def quotes(self, symbols):
+        return {s: {'price': self.prices[s], 'prev_close': self.prices[s]} for s in symbols if s in self.prices}
+
+def run_orders_benchmark(args):
+    app.DATA_DIR = tempfile.mkdtemp(prefix='stock-benchmark-')
+    rng = random.Random(args.seed)
+    
+    # מספיק כסף ומניות כדי שכל פקודה שהופעלה תתבצע (ולא תידחה)
+    store = app.PortfolioStore(MemoryStorage())
+    usernames = [f'student{i:04d}' for i in range(args.users)]
+    for username in usernames:
+        stocks = {symbol: {'shares': args.orders, 'avg_price': 100.0} for symbol in BENCHMARK_SYMBOLS}
+        store.commit(username, {'cash': 1e9, 'stocks': stocks}, 0)
+    
+    market = ManualQuotes({symbol: 100.0 for symbol in BENCHMARK_SYMBOLS})
+    market.prices[app.FX_SYMBOL] = 3.7
+    book = app.OrderBook(os.path.join(app.DATA_DIR, 'orders.jsonl'))
+    
+    place_times = []
+    for _ in range(args.orders):
+        symbol = rng.choice(BENCHMARK_SYMBOLS)
+        started = time.perf_counter()
+        book.place(rng.choice(usernames), symbol, rng.choice(['buy', 'sell']), rng.choice(['limit', 'stop']),
+                   market.prices[symbol] * rng.uniform(0.8, 1.2), 1)
+        place_times.append(time.perf_counter() - started)
+    
+    # התהליכון של המנוע לא רץ כאן (interval ארוך) - הבדיקה קוראת ל-tick בעצמה אחרי כל תזוזת מחירים
+    matcher = app.OrderMatcher(book, store, market, interval=3600)
+    tick_times = []
+    for _ in range(args.ticks):
+        for symbol in BENCHMARK_SYMBOLS:
+            market.prices[symbol] *= float(np.exp(rng.gauss(0, args.volatility)))
+        market.runs += 1
+        started = time.perf_counter()
+        matcher.tick()
+        tick_times.append(time.perf_counter() - started)
+    
+    stats = matcher.stats()
+    return {
+        'benchmark': 'orders',
+        'config': {key: value for key, value in vars(args).items() if key not in ('run', 'output')},
+        'place_latency': percentiles(place_times),
+        'tick_latency': percentiles(tick_times),
+        'fills': stats['fills'],
+        'rejections': stats['rejections'],
+        'open_orders': stats['open'],
+        'fills_per_tick': round(stats['fills'] / args.ticks, 2) if args.ticks else None
+    }
+
+# ============================================
+# זיכרון - ייצוג התיקים וההיסטוריה בתהליך
+# ============================================
+
+def traced_size(build):
+    """כמה בתים נשארים מוקצים אחרי build() - (גודל, התוצאה, זמן בנייה בשניות)"""
+    gc.collect()
+    tracemalloc.start()
+    base = tracemalloc.get_traced_memory()[0]
+    start = time.perf_counter()
+    result = build()
+    elapsed = time.perf_counter() - start
+    gc.collect()
+    size = tracemalloc.get_traced_memory()[0] - base
+    tracemalloc.stop()
+    return size, result, elapsed
+
+def run_memory_benchmark(args):
+    """התיקים, העסקאות האחרונות ואינדקס היומן של כיתה - כמילונים (הייצוג הקודם) מול הייצוג הקומפקטי"""
+    rng = random.Random(args.seed)
+    symbols = BENCHMARK_SYMBOLS + [f'SYM{i}.TA' for i in range(args.symbols - len(BENCHMARK_SYMBOLS))]
+    usernames = [f'student{i}' for i in range(args.users)]
+    
+    # הנתונים כמו שהם מגיעים מהאחסון: JSON של אחזקות ושורות יומן (מחרוזות חדשות לכל שורה)
+    stored = {}
+    ledger_rows = {}
+    for username in usernames:
+        held = rng.sample(symbols, min(args.holdings, len(symbols)))
+        stored[username] = app.encode_stocks({symbol: {'shares': rng.randint(1, 50), 'avg_price': round(rng.uniform(20, 900), 2)}
+                                              for symbol in held})
+        ledger_rows[username] = json.dumps([
+            [username, f'2026-01-01T10:{i % 60:02d}:00', rng.choice(['buy', 'sell']), rng.choice(held),
+             rng.randint(1, 10), round(rng.uniform(20, 900), 2), 5.0, round(rng.uniform(20, 9000), 2)]
+            for i in range(app.LEDGER_RECENT_LIMIT)
+        ])
+    total_rows = args.users * args.ledger_rows
+    
+    def plain_portfolios():
+        return {u: {'cash': 10000.0, 'stocks': app.decode_stocks(stocks)} for u, stocks in stored.items()}
+    
+    def compact_portfolios():
+        return {u: app.compact_portfolio({'cash': 10000.0, 'stocks': app.decode_stocks(stocks)}) for u, stocks in stored.items()}
+    
+    def plain_recent():
+        return {u: deque((app.row_to_trade(row) for row in json.loads(rows)), maxlen=app.LEDGER_RECENT_LIMIT)
+                for u, rows in ledger_rows.items()}
+    
+    def compact_recent():
+        recent = {}
+        for u, rows in ledger_rows.items():
+            recent[u] = app.TradeHistory(app.LEDGER_RECENT_LIMIT)
+            for row in json.loads(rows):
+                recent[u].append(app.row_to_trade(row))
+        return recent
+    
+    def plain_index():
+        return {u: list(range(i + 2, total_rows + 2, args.users)) for i, u in enumerate(usernames)}
+    
+    def compact_index():
+        return {u: array('l', range(i + 2, total_rows + 2, args.users)) for i, u in enumerate(usernames)}
+    
+    report = {
+        'config': {key: value for key, value in vars(args).items() if key not in ('run', 'output')},
+        'sections': {}
+    }
+    totals = {'before': 0, 'after': 0}
+    for name, before, after in [('portfolios', plain_portfolios, compact_portfolios),
+                                ('recent_trades', plain_recent, compact_recent),
+                                ('ledger_index', plain_index, compact_index)]:
+        before_size, before_value, before_time = traced_size(before)
+        after_size, after_value, after_time = traced_size(after)
+        # 🛡️ הייצוג הקומפקטי חייב להחזיר בדיוק את אותם נתונים
+        if name == 'portfolios':
+            same = all(app.portfolio_row_values(after_value[u])[1] == stored[u] for u in usernames)
+        else:
+            same = all(list(after_value[u]) == list(before_value[u]) for u in usernames)
+        report['sections'][name] = {
+            'before_bytes': before_size,
+            'after_bytes': after_size,
+            'saved_pct': round(100 * (1 - after_size / before_size), 1) if before_size else 0.0,
+            'before_build_ms': round(before_time * 1000, 2),
+            'after_build_ms': round(after_time * 1000, 2),
+            'same_data': same
+        }
+        totals['before'] += before_size
+        totals['after'] += after_size
+        del before_value, after_value
+    
+    report['total'] = {
+        'before_bytes': totals['before'],
+        'after_bytes': totals['after'],
+        'before_per_student': totals['before'] // args.users,
+        'after_per_student': totals['after'] // args.users,
+        'saved_pct': round(100 * (1 - totals['after'] / totals['before']), 1)
+    }
+    return report
+
+# ============================================
+# קידוד עמודת האחזקות - JSON מול v1
+# ============================================
+
+def timed_per_cell(function, cells, rounds):
+    """זמן (מיקרו-שניות) להפעלת function על כל תא - הסבב המהיר מתוך rounds, כדי לנטרל רעש של המכונה"""
+    best = float('inf')
+    for _ in range(rounds):
+        start = time.perf_counter()
+        for cell in cells:
+            function(cell)
+        best = min(best, time.perf_counter() - start)
+    return best / len(cells) * 1e6
+
+def run_codec_benchmark(args):
+    """קידוד ופענוח של תאי אחזקות: JSON (הפורמט הישן) מול v1 - זמן לתא וגודל התא"""
+    rng = random.Random(args.seed)
+    symbols = BENCHMARK_SYMBOLS + [f'SYM{i}.TA' for i in range(max(0, args.symbols - len(BENCHMARK_SYMBOLS)))]
+    # מחיר ממוצע אמיתי הוא תוצאה של חילוק - מספר עם כל הספרות, לא מעוגל
+    portfolios = [
+        {symbol: {'shares': rng.randint(1, 200), 'avg_price': rng.uniform(20, 900) * 3.7}
+         for symbol in rng.sample(symbols, rng.randint(1, min(args.holdings, len(symbols))))}
+        for _ in range(args.portfolios)
+    ]
+    json_cells = [json.dumps(stocks, ensure_ascii=False) for stocks in portfolios]
+    v1_cells = [app.encode_stocks(stocks) for stocks in portfolios]
+    
+    def encode_json(stocks):
+        return json.dumps(stocks, ensure_ascii=False)
+    
+    formats = {
+        'json': (encode_json, json.loads, json_cells),
+        'v1': (app.encode_stocks, app.decode_stocks, v1_cells)
+    }
+    report = {
+        'config': {key: value for key, value in vars(args).items() if key not in ('run', 'output')},
+        'formats': {}
+    }
+    for name, (encode, decode, cells) in formats.items():
+        sizes = [len(cell.encode('utf-8')) for cell in cells]
+        report['formats'][name] = {
+            'encode_us': round(timed_per_cell(encode, portfolios, args.rounds), 3),
+            'decode_us': round(timed_per_cell(decode, cells, args.rounds), 3),
+            'avg_cell_bytes': round(sum(sizes) / len(sizes), 1),
+            'max_cell_bytes': max(sizes),
+            'round_trip_ok': all(decode(cell) == stocks for cell, stocks in zip(cells, portfolios))
+        }
+    
+    # תאים ישנים נקראים דרך decode_stocks - כמה עולה הבדיקה של הפורמט לפני json.loads
+    report['legacy_json_via_decode_stocks_us'] = round(timed_per_cell(app.decode_stocks, json_cells, args.rounds), 3)
+    before, after = report['formats']['json'], report['formats']['v1']
+    report['speedup'] = {
+        'encode': round(before['encode_us'] / after['encode_us'], 2),
+        'decode': round(before['decode_us'] / after['decode_us'], 2),
+        'cell_size': round(before['avg_cell_bytes'] / after['avg_cell_bytes'], 2)
+    }
+    return report
+
+# ============================================
+# הרצה
+# ============================================
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="בדיקות ביצועים לבורסת הכיתה")
+    commands = parser.add_subparsers(dest='command', required=True)
+    
+    load = commands.add_parser('load', help="בדיקת עומס: תלמידים מדומים שקונים ומוכרים במקביל")
+    load.add_argument('--users', type=int, default=30, help="מספר תלמידים במקביל")
+    load.add_argument('--trades', type=int, default=20, help="עסקאות לכל תלמיד")
+    load.add_argument('--think-time', type=float, default=0.0, help="המתנה מקסימלית (שניות) בין עסקאות")
+    load.add_argument('--storage', choices=['memory', 'sqlite'], default='memory', help="האחסון שנבדק")
+    load.add_argument('--storage-latency', type=float, default=0.0, help="השהיה (שניות) לכל קריאה לאחסון")
+    load.add_argument('--market-latency', type=float, default=0.0, help="השהיה (שניות) לכל קריאה לספק המחירים")
+    load.add_argument('--market-rate', type=float, default=0.0, help="הגבלת קצב לספק המחירים (קריאות לשנייה, 0 = בלי)")
+    load.add_argument('--seed', type=int, default=42)
+    load.add_argument('--output', help="קובץ לדוח JSON (ברירת מחדל: מסך)")
+    load.set_defaults(run=run_load_test)
+    
+    orders = commands.add_parser('orders', help="מנוע הפקודות: זמן בדיקה לכל עדכון מחיר עם אלפי פקודות ממתינות")
+    orders.add_argument('--orders', type=int, default=5000, help="מספר פקודות ממתינות")
+    orders.add_argument('--users', type=int, default=100, help="מספר תלמידים")
+    orders.add_argument('--ticks', type=int, default=200, help="מספר עדכוני מחיר")
+    orders.add_argument('--volatility', type=float, default=0.01, help="סטיית תקן של שינוי המחיר בכל עדכון")
+    orders.add_argument('--seed', type=int, default=42)
+    orders.add_argument('--output', help="קובץ לדוח JSON (ברירת מחדל: מסך)")
+    orders.set_defaults(run=run_orders_benchmark)
+    
+    memory = commands.add_parser('memory', help="זיכרון: תיקים, עסקאות אחרונות ואינדקס היומן - לפני ואחרי הייצוג הקומפקטי")
+    memory.add_argument('--users', type=int, default=500, help="מספר תלמידים")
+    memory.add_argument('--holdings', type=int, default=8, help="מניות שונות בכל תיק")
+    memory.add_argument('--symbols', type=int, default=60, help="כמה סימולים שונים בכיתה")
+    memory.add_argument('--ledger-rows', type=int, default=200, help="שורות ביומן לכל תלמיד")
+    memory.add_argument('--seed', type=int, default=42)
+    memory.add_argument('--output', help="קובץ לדוח JSON (ברירת מחדל: מסך)")
+    memory.set_defaults(run=run_memory_benchmark)
+    
+    codec = commands.add_parser('codec', help="עמודת האחזקות: קידוד/פענוח ב-JSON מול v1 וגודל התא")
+    codec.add_argument('--portfolios', type=int, default=1000, help="מספר תיקים")
+    codec.add_argument('--holdings', type=int, default=12, help="מקסימום מניות שונות בתיק")
+    codec.add_argument('--symbols', type=int, default=60, help="כמה סימולים שונים")
+    codec.add_argument('--rounds', type=int, default=20, help="כמה פעמים עוברים על כל התאים")
+    codec.add_argument('--seed', type=int, default=42)
+    codec.add_argument('--output', help="קובץ לדוח JSON (ברירת מחדל: מסך)")
+    codec.set_defaults(run=run_codec_benchmark)
+    
+    args = parser.parse_args(argv)
+    write_report(args.run(args), args.output)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,39 @@
+"""
+העתקת התיקים והעסקאות של כיתה מ-Google Sheets לקובץ SQLite - מריצים בלי Streamlit:
+    
+    python migrate.py                          # כיתת ברירת המחדל, לקובץ שמוגדר תחת [storage]
+    python migrate.py --class a1 --path data/a1.db
+
+ההגדרות (Service Account, [classes], [storage]) נקראות מ-.streamlit/secrets.toml כמו באפליקציה.
+התוכן הקיים בקובץ היעד יוחלף.
+"""
+
+import argparse
+import logging
+import sys
+
+from streamlit import config as streamlit_config
+
+# Streamlit מדפיס אזהרות כשמריצים את app.py בלי `streamlit run` - לא רלוונטי כאן
+streamlit_config.set_option('global.showWarningOnDirectExecution', False)
+logging.getLogger('streamlit.runtime.scriptrunner_utils.script_run_context').setLevel(logging.ERROR)
+
+import app
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="העתקת הנתונים של כיתה מ-Google Sheets ל-SQLite")
+    parser.add_argument('--class', dest='class_id', default=app.DEFAULT_CLASS, help="מזהה הכיתה (כמו תחת [classes])")
+    parser.add_argument('--path', help="קובץ ה-SQLite (ברירת מחדל: path תחת [storage])")
+    args = parser.parse_args(argv)
+    
+    path = args.path or app.get_sqlite_path(args.class_id)
+    try:
+        portfolio_count, trade_count = app.migrate_sheets_to_sqlite(path, args.class_id)
+    except Exception as e:
+        print(f"❌ שגיאה בהעתקה: {e}", file=sys.stderr)
+        return 1
+    print(f"✅ הועתקו {portfolio_count} תיקים ו-{trade_count} עסקאות ל-{path}")
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())